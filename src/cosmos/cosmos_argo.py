@@ -1,10 +1,15 @@
-from hera.workflows import Workflow, WorkflowStatus, Task
+from hera.workflows import Workflow, WorkflowStatus, Task, WorkflowsService, DAG, Resource
 from hera.workflows.models import WorkflowTemplateRef
 from hera.shared import GlobalConfig
 import time
+import re
+import hashlib
 
 from .cosmos_main import cosmos
 
+# Job label of the DAG workflow of a cycle (see Argo.submit_cycle_dag)
+dag_job_name = "cycle-dag"
+
 class Argo:
 
     def __init__(self):
@@ -37,37 +42,118 @@ class Argo:
             The tiling folder to use. This is the folder where the tiling (index and topobathy) files are stored.
         """
 
-        # Get the workflow template reference
-        wt_ref = WorkflowTemplateRef(name=workflow_name, cluster_scope=False)
+        w = make_template_workflow(workflow_name, job_name, subfolder, scenario, cycle,
+                                   webviewerfolder=webviewerfolder,
+                                   tilingfolder=tilingfolder)
 
-        # Replace underscores with dashes in the job name
-        mname = job_name.replace("_","-")
+        cosmos.log("Cloud Workflow started")
+        w.create()
 
-        # Gather the arguments
-        arguments={"subfolder": subfolder, "scenario": scenario, "cycle": cycle}
-        if webviewerfolder is not None:
-            arguments["webviewerfolder"] = webviewerfolder
-        if tilingfolder is not None:
-            arguments["tilingfolder"] = tilingfolder
+        return w
+    
+    def submit_cycle_dag(self, jobs, scenario, cycle):
+        """Submit all jobs of a cycle as one Argo DAG workflow.
 
-        # Create the workflow
-        w = Workflow(
-            generate_name=mname+"-",
-            workflow_template_ref=wt_ref,
-            arguments=arguments
-        )
+        Each job is a task in the DAG that creates a workflow from its workflow template (the same workflow
+        that submit_template_job would create), and waits for it to succeed. Tasks only start when the tasks
+        they depend on have succeeded, so nested models start as soon as their overall models are finished.
+        If a task fails, the workflows of the tasks that depend on it are never created. The DAG workflow
+        itself gets the job label dag_job_name, so that the job watcher knows when it has ended.
+        The service account of the workflow needs permission to create, get, list and watch workflows.
 
-        cosmos.log("Cloud Workflow started")
+        Parameters
+        ----------
+        jobs : list
+            List of dicts with the arguments of submit_template_job (workflow_name, job_name, subfolder,
+            webviewerfolder, tilingfolder) and dependencies (list with job names of the jobs it depends on).
+        scenario : str
+            The name of the scenario.
+        cycle : str
+            The name of the cycle.
+        """
+
+        with Workflow(
+            generate_name=task_name(scenario + "-" + cycle) + "-",
+            entrypoint="cycle",
+            labels=get_labels(scenario, cycle, dag_job_name)
+        ) as w:
+            templates = {}
+            for job in jobs:
+                manifest = make_template_workflow(job["workflow_name"], job["job_name"], job["subfolder"], scenario, cycle,
+                                                  webviewerfolder=job.get("webviewerfolder"),
+                                                  tilingfolder=job.get("tilingfolder"))
+                templates[job["job_name"]] = Resource(
+                    name=task_name(job["job_name"]),
+                    action="create",
+                    manifest=manifest,
+                    set_owner_reference=True,
+                    success_condition="status.phase == Succeeded",
+                    failure_condition="status.phase in (Failed, Error)"
+                )
+            with DAG(name="cycle"):
+                for job in jobs:
+                    dependencies = [task_name(name) for name in job["dependencies"] if name in templates]
+                    templates[job["job_name"]](name=task_name(job["job_name"]),
+                                               dependencies=dependencies if dependencies else None)
+
+        cosmos.log("Cloud DAG workflow with " + str(len(jobs)) + " jobs started")
         w.create()
 
         return w
-    
+
     def submit_single_job(model):
         with Workflow(model.name.replace('_', '-'), generate_name=True, workflow_template_ref="sfincs-workflow-xzv8r") as w:
             Task("sfincs-cpu-argo", image="deltares/sfincs-cpu:latest", command=["/bin/bash", "-c", "--"], args= ["chmod +x /data/run.sh && /data/run.sh"])
 
         return w.create()
 
+    def get_workflow_status(self, scenario, cycle):
+        """Get the status of all workflows of a cycle with a single request to the Argo server.
+
+        Parameters
+        ----------
+        scenario : str
+            The name of the scenario.
+        cycle : str
+            The name of the cycle.
+
+        Returns
+        -------
+        dict
+            Phase of the most recent workflow of each job (key is the job name as used in submit_template_job).
+            Returns None if the request failed.
+        """
+
+        labels = get_labels(scenario, cycle)
+        label_selector = ",".join([key + "=" + value for key, value in labels.items()])
+
+        try:
+            service = WorkflowsService(namespace=cosmos.config.cloud_config.namespace)
+            wf_list = service.list_workflows(label_selector=label_selector,
+                                             fields="items.metadata.name,items.metadata.labels,items.metadata.creationTimestamp,items.status.phase")
+        except BaseException as e:
+            cosmos.log("An error occurred while checking status !")
+            cosmos.log(str(e))
+            return None
+
+        status = {}
+        creation_time = {}
+        for wf in wf_list.items or []:
+            job = wf.metadata.labels.get("cosmos/job")
+            if job is None:
+                continue
+            # The same job may have been submitted more than once, use the latest
+            t = getattr(wf.metadata.creation_timestamp, "__root__", wf.metadata.creation_timestamp)
+            if job in creation_time and t is not None and creation_time[job] is not None and creation_time[job] > t:
+                continue
+            creation_time[job] = t
+            if wf.status and wf.status.phase:
+                status[job] = wf.status.phase
+            else:
+                status[job] = "Pending"
+
+        return status
+
     def get_task_status(workflow):
 
         status = "Unknown"
@@ -82,4 +168,56 @@ class Argo:
             cosmos.log("An error occurred while checking status !")
             cosmos.log(str(e))
 
-        return status
\ No newline at end of file
+        return status
+
+def get_labels(scenario, cycle, job_name=None):
+    """Kubernetes labels of a workflow (values can only contain alphanumeric characters, '-', '_' and '.')."""
+    labels = {}
+    labels["cosmos/scenario"] = label_value(scenario)
+    labels["cosmos/cycle"]    = label_value(cycle)
+    if job_name is not None:
+        labels["cosmos/job"]  = label_value(job_name)
+    return labels
+
+def label_value(value):
+    """Label values are at most 63 characters. Longer values are shortened with a hash of the full value, so that they remain unique."""
+    full_value = str(value)
+    value = re.sub(r"[^A-Za-z0-9_.-]", "-", full_value)
+    if len(value) > 63:
+        value = value[:54].strip("-_.") + "-" + hashlib.sha1(full_value.encode()).hexdigest()[:8]
+    return value.strip("-_.")
+
+def make_template_workflow(workflow_name, job_name, subfolder, scenario, cycle, webviewerfolder=None, tilingfolder=None):
+    """Make (but do not create) workflow from workflow template. See Argo.submit_template_job."""
+
+    # Get the workflow template reference
+    wt_ref = WorkflowTemplateRef(name=workflow_name, cluster_scope=False)
+
+    # Replace underscores with dashes in the job name
+    mname = job_name.replace("_","-")
+
+    # Gather the arguments
+    arguments={"subfolder": subfolder, "scenario": scenario, "cycle": cycle}
+    if webviewerfolder is not None:
+        arguments["webviewerfolder"] = webviewerfolder
+    if tilingfolder is not None:
+        arguments["tilingfolder"] = tilingfolder
+
+    # Create the workflow (labels are used to get the status of all workflows of this cycle at once)
+    w = Workflow(
+        generate_name=mname+"-",
+        workflow_template_ref=wt_ref,
+        arguments=arguments,
+        labels=get_labels(scenario, cycle, job_name)
+    )
+
+    return w
+
+def task_name(name):
+    """Names of templates and tasks can only contain lower case alphanumeric characters and '-' (at most 63,
+    longer names are shortened with a hash of the full name, so that they remain unique)."""
+    full_name = name
+    name = re.sub(r"[^a-z0-9-]", "-", name.lower())
+    if len(name) > 63:
+        name = name[:54].strip("-") + "-" + hashlib.sha1(full_name.encode()).hexdigest()[:8]
+    return name.strip("-")
@@ -51,6 +51,9 @@ class CoSMoS_BEWARE(Model):
         # Read in the BEWARE model
         input_file  = os.path.join(self.path, "input", "beware.inp")
         self.domain = BEWARE(input_file)        
+        if self.output_patterns is None:
+            # Files that move picks up
+            self.output_patterns = ["beware_his.nc"]
         self.domain.crs   = self.crs
         self.domain.type  = self.type
         self.domain.name  = self.name
@@ -99,6 +102,8 @@ class CoSMoS_BEWARE(Model):
         # Copy the correct run script to run_job.py
         pth = os.path.dirname(__file__)
         fo.copy_file(os.path.join(pth, "cosmos_run_beware.py"), os.path.join(self.job_path, "run_job_2.py"))
+        # Helper modules that are used by the run script
+        self.copy_job_helpers()
 
         # Write config.yml file to be used in job
         self.write_config_yml()
@@ -8,6 +8,8 @@ import os
 import datetime
 
 from .cosmos_main import cosmos
+from .cosmos_restart_catalogue import get_restart_catalogue, clear_restart_catalogues
+from .cosmos_input_cache import InputCache
 import cht_utils.fileops as fo
 
 def clean_up():
@@ -32,6 +34,9 @@ def clean_up():
         remove_job_list_folder()
         remove_older_restart_files()
 
+    # Results of removed cycles can no longer be reused
+    InputCache().prune()
+
 
 def remove_input_folders():
     for model in cosmos.scenario.model:
@@ -45,6 +50,7 @@ def remove_overall_model_folders():
 
 def remove_all_restart_folders():
     fo.rmdir(cosmos.scenario.restart_path)
+    clear_restart_catalogues()
 
 def remove_track_folder():
     fo.rmdir(cosmos.scenario.cycle_track_spw_path)
@@ -71,32 +77,17 @@ def remove_older_restart_files():
     # Remove restart files older than 3 days prior to the current cycle
     rstpath = cosmos.scenario.restart_path
     if os.path.exists(rstpath):
+        # Restart times in the catalogues do not have a time zone
+        tmin = cosmos.cycle.replace(tzinfo=None) - datetime.timedelta(hours=cosmos.config.run.prune_after_hours)
         all_models = fo.list_folders(os.path.join(rstpath,'*'), basename=True)
         for model in all_models:
-            # FLOW
-            restart_path_flow = os.path.join(rstpath, model, 'flow')
-            flow_restart_files = fo.list_files(restart_path_flow, full_path=False)
-            for file in flow_restart_files:
-                # The files are in the format modeltype.YYYYMMDD.HHMMSS.rst
-                if file.endswith('.rst'):
-                    tstr = file.replace('.rst', '')[-15:]  # Get the YYYYMMDDHHMMSS part
-                    t = datetime.datetime.strptime(tstr, "%Y%m%d.%H%M%S").replace(tzinfo=cosmos.cycle.tzinfo)
-                    if t < cosmos.cycle - datetime.timedelta(hours=cosmos.config.run.prune_after_hours):
-                        pth = os.path.join(restart_path_flow, file)
-                        cosmos.log(f"Removing old restart file : {pth}")
-                        os.remove(pth)
-            # WAVE
-            restart_path_wave = os.path.join(rstpath, model, 'wave')
-            wave_restart_files = fo.list_files(restart_path_wave, full_path=False)
-            for file in wave_restart_files:
-                # The files are in the format modeltype.YYYYMMDD.HHMMSS.rst
-                if file.endswith('.rst'):
-                    tstr = file.replace('.rst', '')[-15:]  # Get the YYYYMMDDHHMMSS part
-                    t = datetime.datetime.strptime(tstr, "%Y%m%d.%H%M%S").replace(tzinfo=cosmos.cycle.tzinfo)
-                    if t < cosmos.cycle - datetime.timedelta(hours=cosmos.config.run.prune_after_hours):
-                        pth = os.path.join(restart_path_wave, file)
-                        cosmos.log(f"Removing old restart file : {pth}")
-                        os.remove(pth)            
+            for restart_path in [os.path.join(rstpath, model, 'flow'), os.path.join(rstpath, model, 'wave')]:
+                if not os.path.exists(restart_path):
+                    continue
+                catalogue = get_restart_catalogue(restart_path)
+                for file in catalogue.older_than(tmin):
+                    cosmos.log(f"Removing old restart file : {os.path.join(restart_path, file)}")
+                    catalogue.remove(file)
 
 def remove_older_webviewer_cycles():
     # Remove older webviewer cycles, keeping only the latest 5 cycles
@@ -2,24 +2,47 @@ from .cosmos_main import cosmos
 import boto3
 import os
 import tarfile
-from botocore.exceptions import ClientError        
-from multiprocessing.pool import ThreadPool
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 import cht_utils.fileops as fo
 
+# Same transfer settings and folder transfers as the job scripts
+from .cosmos_s3 import multipart_threshold, max_concurrency, download_s3_folder, delete_s3_folder
+
 class Cloud:
     # Helper class for cloud functions
+    # All uploads and downloads of CoSMoS share one S3 client and one pool of transfer threads. The client
+    # is thread safe and keeps a pool of connections, so connections (and TLS sessions) are reused.
 
     def __init__(self):  
         self.ready               = True
+        nr_threads = cosmos.config.cloud_config.nr_transfer_threads
         # Create a session using your AWS credentials (or configure it in other ways)
         session = boto3.Session(
             aws_access_key_id=cosmos.config.cloud_config.access_key,
             aws_secret_access_key=cosmos.config.cloud_config.secret_key,
             region_name=cosmos.config.cloud_config.region
         )
-        # Create an S3 client
-        self.s3_client = session.client('s3')
+        # Create an S3 client (with enough connections for all transfer threads, and for the parts of multipart transfers)
+        self.s3_client = session.client('s3',
+                                        config=Config(max_pool_connections=nr_threads * max_concurrency,
+                                                      retries={"max_attempts": 5, "mode": "standard"}))
+        # Large files are transferred in parts, small files in one request without extra threads
+        self.large_file_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                                multipart_chunksize=16 * 1024 * 1024,
+                                                max_concurrency=max_concurrency)
+        self.small_file_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                                use_threads=False)
+        # Threads for transfers of folders (bounded, and created only once)
+        self.executor = ThreadPoolExecutor(max_workers=nr_threads)
+
+    def get_transfer_config(self, size):
+        # Transfer settings for a file of a given size (in bytes)
+        if size >= multipart_threshold:
+            return self.large_file_config
+        return self.small_file_config
 
     # def upload_folder(self, folder, bucket_name, subfolder):
     #     flist = fo.list_files(os.path.join(folder, "*"), full_path=True)
@@ -42,14 +65,14 @@ class Cloud:
 
     def upload_file(self, bucket_name, file, s3_folder, quiet=True):
         s3_key = os.path.join(s3_folder, os.path.basename(file)).replace('\\', '/')
-        self.s3_client.upload_file(file, bucket_name, s3_key)
+        self.s3_client.upload_file(file, bucket_name, s3_key, Config=self.get_transfer_config(os.path.getsize(file)))
         if not quiet:
             print("Uploaded " + os.path.basename(file))
 
     def download_file(self, bucket_name, s3_folder, file, local_folder, quiet=True):
         s3_key = os.path.join(s3_folder, os.path.basename(file)).replace('\\', '/')
         local_path = os.path.join(local_folder, os.path.basename(file))
-        self.s3_client.download_file(bucket_name, s3_key, file, local_path)
+        self.s3_client.download_file(bucket_name, s3_key, local_path, Config=self.large_file_config)
         if not quiet:
             print("Downloaded " + os.path.basename(file))
 
@@ -70,11 +93,14 @@ class Cloud:
         # Recursively list all files
         flist = list_all_files(local_folder)
         if parallel:
-            pool = ThreadPool()
-            pool.starmap(upf, [(file, local_folder, s3_folder, bucket_name, self.s3_client, quiet) for file in flist])
+            futures = [self.executor.submit(upf, file, local_folder, s3_folder, bucket_name, self.s3_client, quiet,
+                                            self.get_transfer_config(os.path.getsize(file))) for file in flist]
+            for future in futures:
+                future.result()
         else:
             for file in flist:
-                upf(file, local_folder, s3_folder, bucket_name, self.s3_client, quiet)
+                upf(file, local_folder, s3_folder, bucket_name, self.s3_client, quiet,
+                    self.get_transfer_config(os.path.getsize(file)))
         # flist = list_all_files(local_folder)
         # for file in flist:
         #     file1 = file.replace('\\','/')
@@ -84,25 +110,33 @@ class Cloud:
         #     if not quiet:
         #         print("Uploaded " + os.path.basename(file))
 
-    def download_folder(self, bucket_name, s3_folder, local_folder, quiet=True):
-        fo.mkdir(local_folder)
-        objects = self.s3_client.list_objects(Bucket=bucket_name, Prefix=s3_folder)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                s3_key = object['Key']
-                local_path = os.path.join(local_folder, os.path.basename(s3_key))
-                self.s3_client.download_file(bucket_name, s3_key, local_path)
-                if not quiet:
-                    print("Downloaded " + os.path.basename(s3_key))
+    def download_folder(self, bucket_name, s3_folder, local_folder, quiet=True,
+                        include=None, exclude=None, subfolders=True):
+        """Download files in an S3 folder to a local folder.
+
+        Objects are listed with pagination and downloaded concurrently (see cosmos_s3.download_s3_folder).
+        Files larger than the multipart threshold are downloaded in parts. Files are stored in
+        local_folder without their subfolder.
+
+        Parameters
+        ----------
+        include : list, optional
+            Only download files with names that match one of these patterns (e.g. ["*.nc"])
+        exclude : list, optional
+            Do not download files with names that match one of these patterns
+        subfolders : bool
+            Also download files in subfolders of s3_folder
+        """
+        nr_files = download_s3_folder(self.s3_client, bucket_name, s3_folder, local_folder,
+                                      include=include, exclude=exclude, subfolders=subfolders,
+                                      nr_threads=cosmos.config.cloud_config.nr_transfer_threads, quiet=quiet)
+        if not quiet:
+            print("Downloaded " + str(nr_files) + " files from " + s3_folder)
 
     def delete_folder(self, bucket_name, s3_folder):
-        if s3_folder[-1] != "/":
-             s3_folder = s3_folder + "/"
-#        objects = self.s3_client.list_objects(Bucket=bucket_name, Prefix=s3_folder, Delimiter="/")
-        objects = self.s3_client.list_objects(Bucket=bucket_name, Prefix=s3_folder)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                self.s3_client.delete_object(Bucket=bucket_name, Key=object['Key'])
+        """Delete all objects in an S3 folder (in concurrent batches, see cosmos_s3.delete_s3_folder)."""
+        delete_s3_folder(self.s3_client, bucket_name, s3_folder,
+                         nr_threads=cosmos.config.cloud_config.nr_transfer_threads)
 
     def list_folders(self, bucket_name, s3_folder):
         if s3_folder[-1] != "/":
@@ -144,16 +178,6 @@ class Cloud:
         # Clean up the downloaded .tgz file
         os.remove(local_tgz_path)
 
-    def check_file_exists(self, bucket_name, s3_key):
-        try:
-            self.s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-            return True
-        except ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                return False
-            else:
-                raise
-
     def check_folder_exists(self, bucket_name, s3_key):
         response = self.s3_client.list_objects_v2(Bucket=bucket_name, Prefix=s3_key, Delimiter='/')
         # Check if any items are returned
@@ -173,10 +197,10 @@ def list_all_files(src):
             lst.append(str(f))
     return lst        
 
-def upf(file, local_folder, s3_folder, bucket_name, s3_client, quiet):
+def upf(file, local_folder, s3_folder, bucket_name, s3_client, quiet, transfer_config=None):
     file1 = file.replace('\\','/')
     file1 = file1.replace(local_folder,'')
     s3_key = s3_folder + file1
-    s3_client.upload_file(file, bucket_name, s3_key)
+    s3_client.upload_file(file, bucket_name, s3_key, Config=transfer_config)
     if not quiet:
         print("Uploaded " + file)
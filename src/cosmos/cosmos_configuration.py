@@ -93,6 +93,8 @@ class CloudConfig:
         self.namespace  = "argo"
         # Token for accessing the argo installation
         self.token = None
+        # Number of files that are uploaded or downloaded at the same time (shared by all transfers)
+        self.nr_transfer_threads = 16
 
 class TrackEnsemble:
     def __init__(self):
@@ -132,6 +134,8 @@ class Run:
         self.delay           = 0  # hours to wait after cycle time before starting the run
         # Run all models in ensemble model by default
         self.ensemble_models = ["sfincs", "hurrywave", "delft3d", "xbeach", "beware"]
+        self.ensemble_nr_simultaneous_members = 0 # number of ensemble members that run at the same time (0 : as many as there are cores)
+        self.ensemble_threads_per_member = 0 # number of OpenMP threads per ensemble member (0 : cores divided over simultaneous members)
         self.spw_wind_field   = "parametric"
         self.dthis            = 600.0
         self.dtmap            = 21600.0
@@ -145,6 +149,19 @@ class Run:
         self.sfincs_docker    = False
         self.hurrywave_docker = False
         self.post_processing_script = None  # Custom post processing script to be run after each model loop
+        self.job_check_interval   = 0.5  # seconds between checks for finished.txt in running job folders
+        self.cloud_check_interval = 20.0 # seconds between checks of Argo workflow status
+        self.max_cores        = None # core budget for jobs in serial run mode (None uses all cores of this machine)
+        self.nr_preprocess_workers = 4 # number of models that are pre-processed and submitted at the same time
+        self.nr_postprocess_workers = 2 # number of models that are post-processed at the same time
+        self.cloud_dag        = False # submit all models of a cycle as one Argo DAG workflow (cloud mode, not with clusters)
+        self.skip_unchanged_models = False # skip simulations of which the inputs did not change since a previous run (not in cloud mode)
+        self.nr_tile_workers  = 0 # number of processes that make map tiles in a map_tiles job (0 : the cores of the job)
+        self.optimize_tiles   = False # remove fully transparent tiles and hard link identical tiles after making map tiles
+        self.tile_encoding    = "rgba" # PNG encoding of map tiles (options: rgba, palette)
+        self.stage_cache_min_size = 1.0 # input files larger than this (MB) are kept in the local cache of parallel nodes
+        self.link_static_inputs = False # hard link static model inputs and restart files into job folders instead of copying them (copy-on-write clones are used where possible)
+        self.stage_compress   = False # parallel nodes transfer small inputs and outputs as compressed archives (for slow links)
         # self.omp_num_threads  = 256
         
 class Configuration:
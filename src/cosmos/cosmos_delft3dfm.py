@@ -16,6 +16,7 @@ from cht_nesting.cht_nesting import nest1
 
 from .cosmos_main import cosmos
 from .cosmos_model import Model
+from .cosmos_restart_catalogue import get_restart_catalogue
 
 import hydrolib.core.dflowfm as hcdfm
 from cht_utils.misc_tools import findreplace
@@ -65,6 +66,12 @@ class CoSMoS_Delft3DFM(Model):
                 
         input_file  = os.path.join(self.input_path_flow, "flow.mdu")
         self.domain = Delft3DFM(input_file, crs=self.crs)
+        if self.static_inputs is None:
+            # Network files are never changed by pre-processing
+            self.static_inputs = ["*_net.nc"]
+        if self.output_patterns is None:
+            # Files that move picks up
+            self.output_patterns = ["flow/output/*.nc", "flow/output/*.dia", "wave/wav*.nc"]
 
         # Copy some attributes to the model domain (needed for nesting)
         self.domain.crs   = self.crs
@@ -233,6 +240,8 @@ class CoSMoS_Delft3DFM(Model):
         # Copy the correct run script to run_job.py
         pth = os.path.dirname(__file__)
         fo.copy_file(os.path.join(pth, "cosmos_run_delft3dfm.py"), os.path.join(self.job_path, "run_job_2.py"))
+        # Helper modules that are used by the run script
+        self.copy_job_helpers()
 
         # Write config.yml file to be used in job
         self.write_config_yml()
@@ -296,13 +305,13 @@ class CoSMoS_Delft3DFM(Model):
         # Restart files 
         # First rename the restart files
         joboutpath = os.path.join(job_path, "flow", "output")
+        catalogue = get_restart_catalogue(self.restart_flow_path)
         flist = fo.list_files(os.path.join(joboutpath, "*_rst.nc"))
         for rstfile0 in flist:
             dstr = rstfile0[-22:-14]
             tstr = rstfile0[-13:-7]
             rstfile1 = "delft3dfm." + dstr + "." + tstr + ".rst"            
-            fo.move_file(rstfile0,
-                         os.path.join(self.restart_flow_path, rstfile1))
+            catalogue.move_in(rstfile0, rstfile1)
         
         # Output & diag
         fo.move_file(os.path.join(joboutpath, "*.nc"), output_path)
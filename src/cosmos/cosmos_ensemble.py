@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Ensemble helpers for the job scripts (run_job_2.py).
+
+This module does not use the cosmos package, as the job containers in the cloud do not have it. It is
+copied (as cosmos_ensemble.py) into every job folder, next to the job script.
+"""
+
+import os
+import sys
+import fnmatch
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import cht_utils.fileops as fo
+# Staging helpers (cosmos_staging.py is copied next to the job script)
+from cosmos_staging import stage_file
+
+def read_ensemble_members():
+    with open('ensemble_members.txt') as f:
+        ensemble_members = f.readlines()
+    ensemble_members = [x.strip() for x in ensemble_members]
+    return ensemble_members
+
+def prepare_ensemble(config):
+    # In case of ensemble, make folders for each ensemble member and copy necessary scripts to these folders
+    # Read in the list of ensemble members
+    ensemble_members = read_ensemble_members()
+    for member in ensemble_members:
+        print('Making folder for ensemble member ' + member)
+        # Make folder for ensemble member and copy all input files
+        fo.mkdir(member)
+        fo.copy_file(os.path.join("base_input", "run_job_2.py"), member)
+        # Helper modules that are used by the run script
+        fo.copy_file(os.path.join("base_input", "cosmos_*.py"), member)
+        fo.copy_file(os.path.join("base_input", "config.yml"), member)
+        fo.copy_file(os.path.join("base_input", "ensemble_members.txt"), member)
+
+def copy_base_input(config):
+    # Copy base inputs to member folder (we're already in the member folder). Inputs are cloned where the
+    # file system supports it, and static inputs (never changed by members) are hard linked if possible.
+    src_path = os.path.join("..", "base_input")
+    link = config.get("link_static_inputs", False)
+    static_inputs = config.get("static_inputs", [])
+    for file_name in os.listdir(src_path):
+        src = os.path.join(src_path, file_name)
+        if not os.path.isfile(src) or not fnmatch.fnmatch(file_name, "*.*"):
+            continue
+        static = any(fnmatch.fnmatch(file_name, p) for p in static_inputs)
+        stage_file(src, file_name, link=link and static)
+
+def get_ensemble_threads(config, nr_members_total):
+    # Number of members that run simultaneously, and number of threads per member. Together, the members
+    # use the cores of this job (nr_cores in config.yml). If the job may use all cores (nr_cores = 0), the
+    # members use ensemble_nr_simultaneous_members x ensemble_threads_per_member cores (if both are given),
+    # or all cores of the computer.
+    nr_members = config.get("ensemble_nr_simultaneous_members", 0)
+    nr_threads = config.get("ensemble_threads_per_member", 0)
+    nr_cores   = config.get("nr_cores", 0)
+    if nr_cores <= 0:
+        if nr_members > 0 and nr_threads > 0:
+            nr_cores = nr_members * nr_threads
+        else:
+            nr_cores = os.cpu_count() or 1
+    if nr_members <= 0:
+        if nr_threads > 0:
+            nr_members = max(nr_cores // nr_threads, 1)
+        else:
+            nr_members = min(nr_members_total, nr_cores)
+    nr_members = max(min(nr_members, nr_members_total, nr_cores), 1)
+    if nr_threads <= 0 or nr_members * nr_threads > nr_cores:
+        nr_threads = max(nr_cores // nr_members, 1)
+    return nr_members, nr_threads
+
+def simulate_ensemble(config, ensemble_members, run_string, prepare_single):
+    # Prepare all members first (prepare_single works in the current folder, so this is done one by one), and then
+    # run the members simultaneously. Exits with a non-zero exit code if any member failed, so that the job does
+    # not merge the outputs of an incomplete ensemble.
+    curdir = os.getcwd()
+    for member in ensemble_members:
+        print('Preparing ensemble member ' + member)
+        os.chdir(member)
+        prepare_single(config, member=member)
+        os.chdir(curdir)
+    nr_members, nr_threads = get_ensemble_threads(config, len(ensemble_members))
+    print(f"Running {len(ensemble_members)} ensemble members, {nr_members} at a time with {nr_threads} threads each")
+    env = os.environ.copy()
+    env["OMP_NUM_THREADS"] = str(nr_threads)
+    if platform.system() == "Windows":
+        executable = None
+    else:
+        executable = "/bin/bash"
+    def run_member(member):
+        print('Running ensemble member ' + member)
+        p = subprocess.run(run_string, shell=True, cwd=os.path.join(curdir, member), env=env, executable=executable)
+        if p.returncode != 0:
+            print(f"Ensemble member {member} exited with code {p.returncode}")
+        return p.returncode
+    with ThreadPoolExecutor(max_workers=nr_members) as pool:
+        return_codes = list(pool.map(run_member, ensemble_members))
+    failed = [member for member, code in zip(ensemble_members, return_codes) if code != 0]
+    if failed:
+        print("Ensemble members failed : " + ", ".join(failed))
+        sys.exit(1)
@@ -11,6 +11,8 @@ import platform
 
 from .cosmos_main import cosmos
 from .cosmos_model import Model
+from .cosmos_staging import stage_file
+from .cosmos_restart_catalogue import get_restart_catalogue
 # from cht_utils.misc_tools import dict2yaml
 
 from cht_hurrywave import HurryWave
@@ -48,6 +50,12 @@ class CoSMoS_HurryWave(Model):
         
         # Now read in the domain data
         self.domain = HurryWave(path=os.path.join(self.path, "input"), load=True, read_grid_data=False)
+        if self.static_inputs is None:
+            # Grid files are never changed by pre-processing
+            self.static_inputs = ["hurrywave.ind", "hurrywave.msk", "hurrywave.dep"]
+        if self.output_patterns is None:
+            # Files that move picks up
+            self.output_patterns = ["hurrywave_map.nc", "hurrywave_his.nc", "hurrywave_sp2.nc", "*.txt", "hurrywave.*.rst"]
 
         # Copy some attributes to the model domain (needed for nesting)
         self.domain.crs = self.crs
@@ -180,7 +188,8 @@ class CoSMoS_HurryWave(Model):
                                self.wave_restart_file)
             dst = os.path.join(self.job_path,
                                "hurrywave.rst")
-            fo.copy_file(src, dst)
+            # Restart file is only read
+            stage_file(src, dst, link=cosmos.config.run.link_static_inputs)
             self.domain.input.variables.rstfile = "hurrywave.rst"
             self.domain.input.variables.tspinup = 0.0
 
@@ -195,6 +204,8 @@ class CoSMoS_HurryWave(Model):
         # Copy the correct run script to run_job.py
         pth = os.path.dirname(__file__)
         fo.copy_file(os.path.join(pth, "cosmos_run_hurrywave.py"), os.path.join(self.job_path, "run_job_2.py"))
+        # Helper modules that are used by the run script
+        self.copy_job_helpers()
 
         # Write config.yml file to be used in job
         self.write_config_yml()
@@ -254,7 +265,9 @@ class CoSMoS_HurryWave(Model):
         # Restart file used in simulation        
         fo.move_file(os.path.join(job_path, "hurrywave.rst"), input_path)
         # Restart files created during simulation
-        fo.move_file(os.path.join(self.job_path, "hurrywave.*.rst"), restart_path)
+        catalogue = get_restart_catalogue(restart_path)
+        for file_name in fo.list_files(os.path.join(self.job_path, "hurrywave.*.rst")):
+            catalogue.move_in(file_name)
         # Input
         fo.move_file(os.path.join(job_path, "*.*"), input_path)
 
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Skip simulations of which the inputs have not changed since a previous run.
+"""
+
+import os
+import hashlib
+import threading
+import toml
+
+from .cosmos_main import cosmos
+from .cosmos_staging import stage_file, get_file_hash
+from .cosmos_restart_catalogue import get_restart_catalogue
+from cht_utils.misc_tools import yaml2dict
+
+# Files in the job folder that are not model inputs
+exclude_files = ["config.yml", "run_job.bat", "run_job.sh", "running.txt", "started.txt", "finished.txt"]
+
+class InputCache:
+    """Keep track of the inputs and results of previous model runs.
+
+    After pre-processing, a hash is computed from all files in the job folder, the settings in config.yml
+    that affect the simulation, and the input hashes and output files (names, sizes and modification times)
+    of the models it is nested in. Boundary conditions are only made in the job itself, so a model can only
+    be skipped if its parents produced the very same outputs (i.e. they were skipped as well). For each model,
+    an index (cache/<model name>.toml in the scenario folder) refers from input hash to the output folder of
+    the run that used these inputs. The restart files that this run produced are kept in the restart sub folder
+    of the output folder. If the inputs have not changed and the outputs still exist, the outputs are staged
+    into the job folder, the restart files are put back in the restart folders, and the simulation step is
+    skipped. Map tiles and post-processing are still done for the current cycle.
+
+    Only used in serial and parallel mode, and not for ensemble models.
+
+    See Also
+    --------
+    cosmos.cosmos_model_loop.ModelLoop
+    """
+    def __init__(self):
+        self.path  = os.path.join(cosmos.scenario.path, "cache")
+        self.index = {}
+        self.lock  = threading.Lock()
+
+    def get_input_hash(self, model):
+        """Compute hash of the effective inputs of a model (after pre-processing).
+
+        The content hashes of the input files are kept between cycles (see cosmos_staging.get_file_hash),
+        so static inputs that are staged with their original modification time are only read once.
+        """
+
+        h = hashlib.sha256()
+
+        # Input files
+        for root, dirs, files in os.walk(model.job_path):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name in exclude_files:
+                    continue
+                full_name = os.path.join(root, file_name)
+                rel_path = os.path.relpath(full_name, model.job_path).replace("\\", "/")
+                h.update(rel_path.encode())
+                h.update(get_file_hash(full_name, (model.name, rel_path)).encode())
+
+        # Settings in config.yml, without cycle specific names and paths and without map settings
+        config = yaml2dict(os.path.join(model.job_path, "config.yml"))
+        for key in sorted(config.keys()):
+            if key in ["scenario", "cycle"]:
+                continue
+            value = config[key]
+            if isinstance(value, dict):
+                if "png_path" in value:
+                    # Map settings, maps are always made
+                    continue
+                value = {k: v for k, v in value.items() if k != "overall_path"}
+            h.update((key + "=" + str(value)).encode())
+
+        # Models that provide the boundary conditions
+        for parent in [model.flow_nested, model.wave_nested, model.bw_nested, model.tide_only_model]:
+            if parent:
+                if not parent.input_hash or not os.path.isdir(parent.cycle_output_path):
+                    # Parent was not hashed (e.g. after a resume), or has no outputs
+                    return None
+                h.update(parent.input_hash.encode())
+                for file_name in sorted(os.listdir(parent.cycle_output_path)):
+                    full_name = os.path.join(parent.cycle_output_path, file_name)
+                    if os.path.isfile(full_name):
+                        stat = os.stat(full_name)
+                        h.update((file_name + str(stat.st_size) + str(stat.st_mtime_ns)).encode())
+
+        return h.hexdigest()
+
+    def restore(self, model):
+        """Check if the inputs of a model have been used before. If so, link the outputs into the job folder.
+
+        Returns True if the simulation can be skipped.
+        """
+
+        model.input_hash = self.get_input_hash(model)
+        model.cached_restart_files = []
+        if not model.input_hash:
+            return False
+
+        with self.lock:
+            output_path = self.get_index(model).get(model.input_hash)
+        if not output_path or not os.path.exists(output_path) or not os.listdir(output_path):
+            return False
+        if not os.path.isdir(os.path.join(output_path, "restart")):
+            # Restart files of this run were not kept
+            return False
+
+        cosmos.log("Inputs of " + model.long_name + " have not changed, using results in " + output_path)
+        link = cosmos.config.run.link_static_inputs
+        for file_name in os.listdir(output_path):
+            src = os.path.join(output_path, file_name)
+            if not os.path.isfile(src) or file_name in exclude_files:
+                continue
+            # Outputs are not changed anymore
+            stage_file(src, os.path.join(model.job_path, file_name), link=link)
+
+        # Put restart files back (the next cycle needs them)
+        for kind, restart_path in [("flow", model.restart_flow_path), ("wave", model.restart_wave_path)]:
+            src_path = os.path.join(output_path, "restart", kind)
+            if not os.path.isdir(src_path):
+                continue
+            catalogue = get_restart_catalogue(restart_path)
+            for file_name in os.listdir(src_path):
+                dst = os.path.join(restart_path, file_name)
+                if not os.path.exists(dst):
+                    stage_file(os.path.join(src_path, file_name), dst, link=link)
+                catalogue.add(file_name)
+                model.cached_restart_files.append((kind, file_name))
+
+        return True
+
+    def get_restart_files(self, model):
+        """Return restart files in the restart folders of a model (call before moving the model)."""
+        return {"flow": set(get_restart_catalogue(model.restart_flow_path).files),
+                "wave": set(get_restart_catalogue(model.restart_wave_path).files)}
+
+    def store(self, model, restart_files):
+        """Store output folder (and new restart files) of a model that has just been moved.
+
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Model that has just been moved
+        restart_files : dict
+            Restart files before the model was moved (see get_restart_files)
+        """
+
+        if not model.input_hash:
+            return
+
+        # Keep the restart files that this run produced (or restored) with the outputs
+        new_files = []
+        for kind, restart_path in [("flow", model.restart_flow_path), ("wave", model.restart_wave_path)]:
+            for file_name in set(get_restart_catalogue(restart_path).files) - restart_files[kind]:
+                new_files.append((kind, file_name))
+        for kind, file_name in set(new_files + model.cached_restart_files):
+            restart_path = model.restart_flow_path if kind == "flow" else model.restart_wave_path
+            dst_path = os.path.join(model.cycle_output_path, "restart", kind)
+            os.makedirs(dst_path, exist_ok=True)
+            stage_file(os.path.join(restart_path, file_name), os.path.join(dst_path, file_name),
+                       link=cosmos.config.run.link_static_inputs)
+        os.makedirs(os.path.join(model.cycle_output_path, "restart"), exist_ok=True)
+
+        with self.lock:
+            index = self.get_index(model)
+            index[model.input_hash] = model.cycle_output_path
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                with open(os.path.join(self.path, model.name + ".toml"), "w") as fid:
+                    toml.dump(index, fid)
+            except Exception:
+                print("Could not write cache index of " + model.name)
+
+    def prune(self):
+        """Remove entries of which the output folder (or its restart files) no longer exists from all indices.
+
+        Called by the clean up, which removes older cycles.
+        """
+        if not os.path.isdir(self.path):
+            return
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(".toml"):
+                continue
+            full_name = os.path.join(self.path, file_name)
+            with self.lock:
+                try:
+                    index = toml.load(full_name)
+                except Exception:
+                    print("Could not read " + full_name)
+                    continue
+                pruned = {input_hash: output_path for input_hash, output_path in index.items()
+                          if os.path.isdir(os.path.join(output_path, "restart"))}
+                if len(pruned) == len(index):
+                    continue
+                cosmos.log("Removing " + str(len(index) - len(pruned)) + " entries from cache index " + file_name)
+                try:
+                    with open(full_name, "w") as fid:
+                        toml.dump(pruned, fid)
+                except Exception:
+                    print("Could not write " + full_name)
+                self.index.pop(file_name[:-5], None)
+
+    def get_index(self, model):
+        """Return index of a model (call with self.lock acquired)."""
+        if model.name not in self.index:
+            index = {}
+            file_name = os.path.join(self.path, model.name + ".toml")
+            if os.path.exists(file_name):
+                try:
+                    index = toml.load(file_name)
+                except Exception:
+                    print("Could not read " + file_name)
+            self.index[model.name] = index
+        return self.index[model.name]
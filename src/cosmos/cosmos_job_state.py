@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent job state of the models in a cycle.
+"""
+
+import os
+import sqlite3
+import datetime
+import threading
+
+from .cosmos_main import cosmos
+
+class JobState:
+    """Keep track of the status of all models in a cycle in a small SQLite database (job_state.db in the cycle folder).
+
+    Every status change of a model is stored, together with a time stamp. When CoSMoS is restarted,
+    the cycle is resumed from this database: finished models are not run again, models that were
+    still running in parallel mode (or of which the job has finished) are watched again, and models
+    that were moved but not yet post-processed are post-processed.
+
+    Parameters
+    ----------
+    path : str
+        Cycle path
+
+    See Also
+    --------
+    cosmos.cosmos_main_loop.MainLoop
+    cosmos.cosmos_model_loop.ModelLoop
+    """
+    def __init__(self, path):
+        self.file_name = os.path.join(path, "job_state.db")
+        self.new  = not os.path.exists(self.file_name)
+        # Status is updated from multiple threads
+        self.lock = threading.Lock()
+        self.db   = sqlite3.connect(self.file_name, check_same_thread=False)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS job (name TEXT PRIMARY KEY, status TEXT, job_path TEXT, time TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS transition (name TEXT, status TEXT, time TEXT)")
+            self.db.commit()
+
+    def set_status(self, model, status):
+        """Store status of a model.
+
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Model
+        status : str
+            New status of the model
+        """
+        tstr = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        job_path = getattr(model, "job_path", None)
+        with self.lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO job (name, status, job_path, time) VALUES (?, ?, ?, ?)",
+                                (model.name, status, job_path, tstr))
+                self.db.execute("INSERT INTO transition (name, status, time) VALUES (?, ?, ?)",
+                                (model.name, status, tstr))
+                self.db.commit()
+            except Exception as e:
+                print("Could not store status of " + model.name + " : " + str(e))
+
+    def get_status(self):
+        """Return dict with the last stored status of each model."""
+        with self.lock:
+            rows = self.db.execute("SELECT name, status FROM job").fetchall()
+        return {name: status for name, status in rows}
+
+    def resume(self, models):
+        """Set status of models to the stored status.
+
+        Models that were being pre-processed, or that failed, will run again.
+        In cloud mode, and in serial mode if the job did not finish, models that were running will be submitted again.
+
+        Parameters
+        ----------
+        models : list
+            List with models of the scenario
+        """
+        status = self.get_status()
+        for model in models:
+            if model.name not in status:
+                continue
+            if status[model.name] == "finished":
+                model.status = "finished"
+                model.run_simulation = False
+            elif status[model.name] == "simulation_finished":
+                # Model was moved, but not yet post-processed
+                model.status = "simulation_finished"
+            elif status[model.name] == "running" and cosmos.config.run.run_mode != "cloud":
+                if not os.path.exists(model.job_path):
+                    continue
+                if os.path.exists(os.path.join(model.job_path, "finished.txt")):
+                    # Job finished while CoSMoS was not running, the job watcher will pick it up
+                    cosmos.log("Resuming finished model " + model.long_name)
+                    model.status = "running"
+                elif cosmos.config.run.run_mode == "parallel":
+                    # Job is still claimed by (or queued for) a worker node, the job watcher will pick it up
+                    cosmos.log("Resuming running model " + model.long_name)
+                    model.status = "running"
+                else:
+                    # In serial mode, the job was a sub process of the previous CoSMoS run, and
+                    # nothing will report that it has finished. Run it again.
+                    cosmos.log("Model " + model.long_name + " was running, but has not finished. It will run again.")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Watch submitted jobs and report finished ones to the model loop.
+"""
+
+import os
+import threading
+
+from .cosmos_main import cosmos
+
+try:
+    from .cosmos_argo import label_value, dag_job_name
+except Exception:
+    print("Argo not available")
+
+try:
+    # Optional, gives instant notification on local file systems
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+class JobWatcher:
+    """Watch running models and put them on the completion queue as soon as they are finished.
+
+    In serial and parallel mode, the job folders are watched for finished.txt. If the watchdog
+    package is available, file system events are used. A light-weight polling thread, that only
+    looks at the job folders of running models, is always active as well, because file system
+    events are not reliable on network shares. In cloud mode, the status of the Argo workflows
+    of all running models is obtained with one request (see Argo.get_workflow_status). Models in
+    the DAG workflow of the cycle that have no workflow when the DAG workflow has ended (because
+    a model they depend on failed, or their workflow could not be created) have failed.
+
+    Parameters
+    ----------
+    completion_queue : queue.Queue
+        Queue on which finished models are put. The model loop blocks on this queue.
+
+    See Also
+    --------
+    cosmos.cosmos_model_loop.ModelLoop
+    """
+    def __init__(self, completion_queue):
+        self.completion_queue = completion_queue
+        self.model            = {}   # Watched models (key is job path)
+        self.watch            = {}   # Watchdog watches (key is job path)
+        self.lock             = threading.Lock()
+        self.stop_event       = threading.Event()
+        self.thread           = None
+        self.observer         = None
+        if cosmos.config.run.run_mode == "cloud":
+            self.interval = cosmos.config.run.cloud_check_interval
+        else:
+            self.interval = cosmos.config.run.job_check_interval
+
+    def start(self):
+        """Start watching."""
+        self.stop_event.clear()
+        if Observer is not None and cosmos.config.run.run_mode != "cloud":
+            self.observer = Observer()
+            self.observer.start()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        self.stop_event.set()
+        if self.observer is not None:
+            try:
+                self.observer.stop()
+            except Exception:
+                pass
+            self.observer = None
+        with self.lock:
+            self.model = {}
+            self.watch = {}
+
+    def add(self, model):
+        """Start watching a model that has just been submitted.
+
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Running model
+        """
+        with self.lock:
+            self.model[model.job_path] = model
+            if self.observer is not None:
+                try:
+                    self.watch[model.job_path] = self.observer.schedule(FinishedFileHandler(self),
+                                                                        model.job_path,
+                                                                        recursive=False)
+                except Exception:
+                    # Folder can not be watched (e.g. on some network shares), polling will pick it up
+                    pass
+        if cosmos.config.run.run_mode != "cloud":
+            # Job may already have finished before we started watching
+            self.check(model)
+
+    def remove(self, model):
+        """Stop watching a model.
+
+        Returns True if the model was still being watched.
+        """
+        with self.lock:
+            if model.job_path not in self.model:
+                return False
+            self.model.pop(model.job_path)
+            watch = self.watch.pop(model.job_path, None)
+            if watch is not None and self.observer is not None:
+                try:
+                    self.observer.unschedule(watch)
+                except Exception:
+                    pass
+        return True
+
+    def notify(self, model):
+        """Put model on the completion queue (only once)."""
+        if self.remove(model):
+            self.completion_queue.put(model)
+
+    def check(self, model):
+        """Check if model has finished and notify model loop if it has."""
+        try:
+            if os.path.exists(os.path.join(model.job_path, "finished.txt")):
+                self.notify(model)
+        except Exception:
+            print("An error occurred when checking job status!")
+
+    def check_cloud(self, models):
+        """Check status of the Argo workflows of all running models with a single request."""
+        status = cosmos.argo.get_workflow_status(cosmos.scenario.name, cosmos.cycle_string)
+        if status is None:
+            # Request failed, try again next time
+            return
+        dag_phase = status.get(label_value(dag_job_name))
+        for model in models:
+            phase = status.get(label_value(model.name))
+            if phase is None and model.cloud_dag and dag_phase in ["Succeeded", "Failed", "Error"]:
+                cosmos.log("Workflow of " + model.long_name + " was not started by the DAG workflow (status " + dag_phase + ")")
+                model.exit_code = 1
+                self.notify(model)
+                continue
+            if phase in ["Succeeded", "Failed", "Error"]:
+                if phase != "Succeeded":
+                    cosmos.log("Workflow of " + model.long_name + " ended with status " + phase)
+                    model.exit_code = 1
+                self.notify(model)
+
+    def poll(self):
+        """Check running models until the watcher is stopped."""
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                models = list(self.model.values())
+            if not models:
+                continue
+            if cosmos.config.run.run_mode == "cloud":
+                self.check_cloud(models)
+            else:
+                for model in models:
+                    self.check(model)
+
+class FinishedFileHandler(FileSystemEventHandler):
+    """Notify job watcher when finished.txt appears in a job folder."""
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        self.handle(event.src_path)
+
+    def on_moved(self, event):
+        # run_job.bat and run_job.sh move running.txt to finished.txt
+        self.handle(event.dest_path)
+
+    def handle(self, path):
+        if os.path.basename(path) != "finished.txt":
+            return
+        with self.watcher.lock:
+            model = self.watcher.model.get(os.path.dirname(path))
+        if model is not None:
+            self.watcher.notify(model)
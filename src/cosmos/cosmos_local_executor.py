@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Run jobs as local processes (serial run mode).
+"""
+
+import os
+import platform
+import subprocess
+import threading
+import time
+
+from .cosmos_main import cosmos
+
+class LocalExecutor:
+    """Run jobs as sub processes on the machine where CoSMoS is running.
+
+    Jobs are started without blocking the model loop. Multiple jobs run at the same time, as long as
+    the total number of cores they need fits in the core budget (run.max_cores in the configuration,
+    defaults to all cores of the machine). The number of cores of a job is the number of MPI processes
+    (nr_mpi_processes) or OpenMP threads (omp_num_threads) of the model. Models with omp_num_threads=-1
+    use all cores, and therefore run on their own. Ensemble jobs need the number of simultaneous
+    members times the number of threads per member (all cores if these are not set). A job that needs more cores than the budget is
+    started as soon as nothing else is running.
+
+    When a job finishes, the model is put on the completion queue of the model loop. The exit code
+    of the job is stored in model.exit_code.
+
+    Parameters
+    ----------
+    completion_queue : queue.Queue
+        Queue on which finished models are put
+
+    See Also
+    --------
+    cosmos.cosmos_model_loop.ModelLoop
+    cosmos.cosmos_model.Model.submit_job
+    """
+    def __init__(self, completion_queue):
+        self.completion_queue = completion_queue
+        self.max_cores = cosmos.config.run.max_cores
+        if not self.max_cores:
+            self.max_cores = os.cpu_count() or 1
+        self.cores_in_use = 0
+        self.pending      = []  # Models waiting for free cores
+        self.process      = {}  # Running processes (key is model name)
+        self.lock         = threading.Lock()
+
+    def submit(self, model):
+        """Add job to the queue and start it when there are enough free cores.
+
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Model for which run_job.bat or run_job.sh has been written in the job folder
+        """
+        with self.lock:
+            self.pending.append(model)
+        self.start_pending()
+
+    def get_nr_cores(self, model):
+        """Return number of cores that the job of a model needs."""
+        nr_cores = model.get_nr_cores()
+        if not nr_cores:
+            # Use all cores
+            nr_cores = self.max_cores
+        return min(nr_cores, self.max_cores)
+
+    def start_pending(self):
+        """Start pending jobs (in the order they were submitted) as long as they fit in the core budget."""
+        with self.lock:
+            while self.pending:
+                model = self.pending[0]
+                nr_cores = self.get_nr_cores(model)
+                if self.process and self.cores_in_use + nr_cores > self.max_cores:
+                    # Wait for running jobs to finish
+                    break
+                self.pending.pop(0)
+                self.cores_in_use += nr_cores
+                try:
+                    self.process[model.name] = self.launch(model)
+                except Exception as e:
+                    cosmos.log("Error: could not start job " + model.long_name + " : " + str(e))
+                    self.cores_in_use -= nr_cores
+                    model.exit_code = -1
+                    self.completion_queue.put(model)
+                    continue
+                thread = threading.Thread(target=self.wait, args=(model, nr_cores), daemon=True)
+                thread.start()
+
+    def launch(self, model):
+        """Start run_job script in the job folder of a model."""
+        cosmos.log("Starting " + model.long_name + " on local machine ...")
+        model.run_start_time = time.time()
+        if platform.system().lower() == "windows":
+            return subprocess.Popen(["cmd", "/c", "run_job.bat"], cwd=model.job_path)
+        else:
+            return subprocess.Popen(["bash", "run_job.sh"], cwd=model.job_path)
+
+    def wait(self, model, nr_cores):
+        """Wait for job to finish, report it to the model loop and start next jobs."""
+        proc = self.process[model.name]
+        model.exit_code = proc.wait()
+        if model.exit_code != 0:
+            cosmos.log("Job " + model.long_name + " exited with code " + str(model.exit_code))
+        with self.lock:
+            self.process.pop(model.name, None)
+            self.cores_in_use -= nr_cores
+        self.completion_queue.put(model)
+        self.start_pending()
+
+    def stop(self):
+        """Remove pending jobs and terminate running jobs."""
+        with self.lock:
+            self.pending = []
+            for proc in self.process.values():
+                try:
+                    proc.terminate()
+                except Exception:
+                    pass
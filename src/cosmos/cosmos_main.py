@@ -7,6 +7,7 @@ Created on Mon May 10 12:18:09 2021
 
 import os
 import datetime
+import threading
 
 import cht_utils.fileops as fo
 
@@ -44,6 +45,10 @@ class CoSMoS:
     
     def __init__(self):
         os.environ['HDF5_DISABLE_VERSION_CHECK'] = '2'
+        # Models are pre-processed and post-processed in multiple threads
+        self.log_lock = threading.Lock()
+        # Job state database of the current cycle
+        self.job_state = None
 
     def initialize(self, main_path, config_file="config.toml"):
         """Initialize CoSMoS configuration based on configuration file and input arguments.
@@ -145,9 +150,10 @@ class CoSMoS:
         print(message)
         log_file = os.path.join(self.config.path.main, "cosmos.log")
         tstr = "[" + datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S") + " UTC] "
-        with open(log_file, 'a') as f:
-            f.write(tstr + message + "\n")
-            f.close()
+        with self.log_lock:
+            with open(log_file, 'a') as f:
+                f.write(tstr + message + "\n")
+                f.close()
 
     def make_webviewer(self, scenario_name:str, cycle = None):   
         """Just make webviewer
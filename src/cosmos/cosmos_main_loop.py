@@ -21,6 +21,8 @@ from .cosmos_cloud import Cloud
 from .cosmos_tsunami import CoSMoS_Tsunami
 from .cosmos_webviewer import WebViewer
 from .cosmos_clean_up import clean_up
+from .cosmos_job_state import JobState
+from .cosmos_restart_catalogue import get_restart_catalogue
 from cht_utils.misc_tools import dict2yaml
 
 try:
@@ -185,6 +187,11 @@ class MainLoop:
         #     # Run cleaning cycle
         #     clean_up()
 
+        # Job state of previous cycle should no longer be updated
+        if cosmos.job_state:
+            cosmos.job_state.close()
+            cosmos.job_state = None
+
         # Create scenario cycle paths
         fo.mkdir(cosmos.scenario.cycle_path)
         fo.mkdir(cosmos.scenario.cycle_models_path)
@@ -334,15 +341,25 @@ class MainLoop:
                 model.status = "finished"
             return
 
-        # Get list of models that have already finished and set their status to finished
-        finished_list = os.listdir(cosmos.scenario.cycle_job_list_path)
+        # From here on, all status changes of the models are stored in the job state database
+        cosmos.job_state = JobState(cosmos.scenario.cycle_path)
+        if cosmos.job_state.new:
+            # No job state yet (e.g. cycle was started with an older version of CoSMoS)
+            # Get list of models that have already finished and set their status to finished
+            finished_list = os.listdir(cosmos.scenario.cycle_job_list_path)
+            for model in cosmos.scenario.model:
+                for file_name in finished_list:
+                    model_name = file_name.split(".")[0]
+                    if model.name.lower() == model_name.lower():
+                        model.status = "finished"
+                        model.run_simulation = False
+                        break
+        else:
+            # Resume cycle
+            cosmos.job_state.resume(cosmos.scenario.model)
+        # Store initial status of all models
         for model in cosmos.scenario.model:
-            for file_name in finished_list:
-                model_name = file_name.split(".")[0]
-                if model.name.lower() == model_name.lower():
-                    model.status = "finished"
-                    model.run_simulation = False
-                    break
+            cosmos.job_state.set_status(model, model.status)
 
         # Can run_models be False?
         if self.run_models:
@@ -586,67 +603,16 @@ def get_start_and_stop_times():
 
 def check_for_wave_restart_files(model):
     """Check if there are wave restart files."""
-    restart_time = None
-    restart_file = None
-
-    path = model.restart_wave_path
-
-    if os.path.exists(path):
-        restart_list = os.listdir(path)
-        times = []
-        files = []
-        for file_name in restart_list:
-            tstr = file_name[-19:-4]
-            t = datetime.datetime.strptime(tstr, "%Y%m%d.%H%M%S")
-            times.append(t)
-            files.append(file_name)
-
-        # Now find the last time that is greater than the start time
-        # and smaller than
-        for it, t in enumerate(times):
-            if (
-                t
-                > model.wave_start_time
-                - datetime.timedelta(hours=model.wave_spinup_time)
-                and t <= model.wave_start_time
-            ):
-                restart_time = t
-                restart_file = files[it]
-    else:
-        fo.mkdir(path)
-
-    return restart_time, restart_file
+    # Find the last restart time after the start time minus spin-up time, and not after the start time
+    catalogue = get_restart_catalogue(model.restart_wave_path)
+    return catalogue.find(model.wave_start_time - datetime.timedelta(hours=model.wave_spinup_time),
+                          model.wave_start_time,
+                          include_t0=False)
 
 
 def check_for_flow_restart_files(model):
     """Check if there are flow restart files."""
-    restart_time = None
-    restart_file = None
-
-    path = model.restart_flow_path
-
-    if os.path.exists(path):
-        restart_list = os.listdir(path)
-        times = []
-        files = []
-        for file_name in restart_list:
-            tstr = file_name[-19:-4]
-            t = datetime.datetime.strptime(tstr, "%Y%m%d.%H%M%S")
-            times.append(t)
-            files.append(file_name)
-
-        # Now find the last time that is greater than the start time
-        # and smaller than
-        for it, t in enumerate(times):
-            if (
-                t
-                >= model.flow_start_time
-                - datetime.timedelta(hours=model.flow_spinup_time)
-                and t <= model.flow_start_time
-            ):
-                restart_time = t
-                restart_file = files[it]
-    else:
-        fo.mkdir(path)
-
-    return restart_time, restart_file
+    # Find the last restart time from the start time minus spin-up time up to the start time
+    catalogue = get_restart_catalogue(model.restart_flow_path)
+    return catalogue.find(model.flow_start_time - datetime.timedelta(hours=model.flow_spinup_time),
+                          model.flow_start_time)
@@ -2,28 +2,27 @@
 # This is only used in the cloud
 
 import os
-import boto3
 #from bulkboto3 import BulkBoto3
 import tarfile
 import shutil
 from PIL import Image
 import numpy as np
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from cht_utils.misc_tools import yaml2dict
+# S3 helpers (cosmos_s3.py is copied next to this script)
+from cosmos_s3 import get_s3_client, get_nr_transfer_threads
+# Map tile helpers (cosmos_tiles.py is copied next to this script)
+from cosmos_tiles import save_palette_png
 
 
 # Helper class for cloud functions, note this is a copy of necessary functionalities of cosmos_cloud
 class Cloud:
     def __init__(self, config):  
-        # Create a session using your AWS credentials (or configure it in other ways)
-        session = boto3.Session(
-            aws_access_key_id=config["cloud"]["access_key"],
-            aws_secret_access_key=config["cloud"]["secret_key"],
-            region_name=config["cloud"]["region"]
-        )
-        # Create an S3 client
-        self.s3_client = session.client('s3')
+        # S3 client (shared by all threads, with a pool of connections that are reused)
+        self.s3_client = get_s3_client(config)
+        # Number of files that are transferred at the same time
+        self.nr_threads = get_nr_transfer_threads(config)
 
         # entrypoint_url = "https://eu-west-1.console.aws.amazon.com/s3/home?region=eu-west-1"
         # self.bulkboto_agent = BulkBoto3(
@@ -65,8 +64,11 @@ class Cloud:
 #                print("Uploaded " + os.path.basename(file))
 
         if parallel:
-            pool = ThreadPool()
-            pool.starmap(upf, [(file, local_folder, s3_folder, bucket_name, self.s3_client, quiet) for file in flist])
+            # Bounded pool of threads, that is closed when all files have been uploaded
+            with ThreadPoolExecutor(max_workers=self.nr_threads) as pool:
+                futures = [pool.submit(upf, file, local_folder, s3_folder, bucket_name, self.s3_client, quiet) for file in flist]
+                for future in futures:
+                    future.result()
         else:
             for file in flist:
                 upf(file, local_folder, s3_folder, bucket_name, self.s3_client, quiet)
@@ -84,40 +86,24 @@ class Cloud:
 
     def download_and_extract_tgz(self, bucket_name, s3_folder, local_folder):
         """
-        Download and extract a .tgz file from S3.
+        Download and extract a .tgz file from S3. The archive is extracted while it is being downloaded
+        (streamed from the response body), so it is never written to local disk.
+        Returns False if the file does not exist.
         """
-        local_tgz_path = os.path.join('/tmp', os.path.basename(s3_folder))
-        print("local_tgz_path: ", local_tgz_path)
-        
-        # Download the .tgz file
+        from botocore.exceptions import ClientError        
         try:
-            print("Downloading {} to {}".format(s3_folder, local_tgz_path))
-            self.s3_client.download_file(bucket_name, s3_folder, local_tgz_path)
-        except Exception as e:
+            response = self.s3_client.get_object(Bucket=bucket_name, Key=s3_folder)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return False
             raise Exception("Failed to download {}: {}".format(s3_folder, e))
-        
-        # Extract the .tgz file
         try:
-            with tarfile.open(local_tgz_path, "r:gz") as tar:
-                print("Extracting {} to {}".format(local_tgz_path, local_folder))
+            print("Downloading and extracting {} to {}".format(s3_folder, local_folder))
+            with tarfile.open(fileobj=response["Body"], mode="r|gz") as tar:
                 tar.extractall(path=local_folder)
         except Exception as e:
-            raise Exception("Failed to extract {}: {}".format(local_tgz_path, e))
-        
-        # Clean up the downloaded .tgz file
-        print("Removing {}".format(local_tgz_path))
-        os.remove(local_tgz_path)
-
-    def check_file_exists(self, bucket_name, s3_key):
-        from botocore.exceptions import ClientError        
-        try:
-            self.s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-            return True
-        except ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                return False
-            else:
-                raise
+            raise Exception("Failed to download and extract {}: {}".format(s3_folder, e))
+        return True
 
 def upf(file, local_folder, s3_folder, bucket_name, s3_client, quiet):
     file1 = file.replace('\\','/')
@@ -140,42 +126,86 @@ def list_all_files(src):
     return lst  
 
 # Helper functions, these should be put into cht_tiling?
-def merge_images(image1_path, image2_path, output_path):
+def merge_tile(sources, output_path, tile_encoding="rgba"):
     """
-    Merge two images by overlaying image2 on image1 and save the result.
+    Merge all model contributions to one tile and save the result. Sources are in model order: empty (zero)
+    pixels of a tile are filled by the first next tile with data in that pixel. Every source tile is decoded
+    once and the merged tile is encoded once.
     """
-    with Image.open(image1_path) as img1, Image.open(image2_path) as img2:
-        rgb1  = np.array(img1) # existing image
-        rgb2 = np.array(img2)  # new image
-        isum = np.sum(rgb1, axis=2) # sum of the existing image
-        # replace the existing image with the new image where the existing image is zero
-        rgb1[isum==0,:] = rgb2[isum==0,:] 
-        im = Image.fromarray(rgb1)
-        im.save(output_path)
-
-def merge_model_tiles(model_tiles, merged_tiles):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if len(sources) == 1:
+        # Nothing to merge
+        shutil.move(sources[0], output_path)
+        return
+    layers = []
+    for src_path in sources:
+        # Tiles may be palette PNGs
+        with Image.open(src_path) as im:
+            layers.append(np.array(im.convert("RGBA")))
+    rgba = np.stack(layers)
+    # Index of first layer with data in each pixel
+    ilayer = np.argmax(np.sum(rgba, axis=3) > 0, axis=0)
+    merged = np.take_along_axis(rgba, ilayer[None, :, :, None], axis=0)[0]
+    if tile_encoding == "palette" and save_palette_png(merged, output_path):
+        return
+    im = Image.fromarray(merged)
+    im.save(output_path)
+
+def merge_tile_list(tile_list, tile_encoding="rgba"):
+    """
+    Merge a list of tiles (called in worker processes). Each item is a tuple with the source tiles and the output path.
+    """
+    for sources, output_path in tile_list:
+        merge_tile(sources, output_path, tile_encoding=tile_encoding)
+    return len(tile_list)
+
+def merge_model_tiles(model_folders, merged_tiles, tile_encoding="rgba", nr_workers=None):
     """
-    Process tiles from multiple models and merge them if they already exist in the shared directory.
+    Merge tiles from multiple models into the shared directory. model_folders is an iterable of model folders in
+    model order, e.g. a generator that yields each folder as soon as it has been downloaded. The tiles of a model
+    are merged into the shared directory (in ranges of tiles, with a process pool) as soon as its folder is
+    available, while the folders of the next models are still being downloaded. Tiles of earlier models have
+    priority: only the empty (zero) pixels of a merged tile are filled by the tiles of later models.
+    Model folders are removed once their tiles have been merged.
     """
-    for root, _, files in os.walk(model_tiles):
-        for file in files:
-            if file.endswith('.png'):
-                # Construct the full file paths
-                src_path = os.path.join(root, file)
-                relative_path = os.path.relpath(src_path, model_tiles)
-                dest_path = os.path.join(merged_tiles, relative_path)
-
-                # Ensure the destination directory exists
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-
-                # if file exist, merge, else move
-                if os.path.exists(dest_path):
-                    # Merge images if destination file already exists
-                    merge_images(dest_path, src_path, dest_path)
+    if not nr_workers:
+        nr_workers = os.cpu_count() or 1
+    pool = None
+    if nr_workers > 1:
+        pool = ProcessPoolExecutor(max_workers=nr_workers)
+    nr_tiles = 0
+    try:
+        for model_tiles in model_folders:
+            # Contributions of this model to each tile (merged with the tiles of the models before it)
+            tile_list = []
+            for root, _, files in os.walk(model_tiles):
+                for file in files:
+                    if file.endswith('.png'):
+                        src_path = os.path.join(root, file)
+                        output_path = os.path.join(merged_tiles, os.path.relpath(src_path, model_tiles))
+                        if os.path.exists(output_path):
+                            tile_list.append(([output_path, src_path], output_path))
+                        else:
+                            tile_list.append(([src_path], output_path))
+            if tile_list:
+                print("Merging " + str(len(tile_list)) + " tiles of " + model_tiles)
+                nr_tiles += len(tile_list)
+                if pool is None:
+                    merge_tile_list(tile_list, tile_encoding)
                 else:
-                    # Move the file if it does not exist
-                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                    shutil.move(src_path, dest_path)
+                    # Split in ranges of tiles (several per worker, to balance the load)
+                    nr_ranges = min(nr_workers * 4, len(tile_list))
+                    range_size = -(-len(tile_list) // nr_ranges)
+                    tile_ranges = [tile_list[i:i + range_size] for i in range(0, len(tile_list), range_size)]
+                    # All tiles of this model must be merged before the tiles of the next model
+                    futures = [pool.submit(merge_tile_list, tile_range, tile_encoding) for tile_range in tile_ranges]
+                    for future in futures:
+                        future.result()
+            shutil.rmtree(model_tiles, ignore_errors=True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print("Merged " + str(nr_tiles) + " tiles with " + str(nr_workers) + " processes")
 
 def merge_tiles(config, quiet=True):
     """Merge tiles for a specific variable from individual models into a shared directory."""
@@ -197,13 +227,12 @@ def merge_tiles(config, quiet=True):
     output_s3_bucket = config["cloud"]["output_s3_bucket"]
     output_s3_prefix = webviewer_folder + "/{}/{}".format(scenario, cycle)
 
-    # first make a list of all models within this scenario with the specific variable
+    # first make a list of all models within this scenario (models without tiles for this variable are
+    # skipped when downloading, so there is no separate request to check if the file exists)
     s3_keys = []
     for folder in cloud.list_folders(s3_bucket, "{}/models".format(scenario)):
         s3_key = "{}/models/".format(scenario) + folder + "/tiles/{}.tgz".format(variable)
-        # check if the s3 key exists
-        if cloud.check_file_exists(s3_bucket, s3_key):
-            s3_keys.append(s3_key)
+        s3_keys.append(s3_key)
 
     # Ensure local directories exist and are empty
     shutil.rmtree(local_extract_path, ignore_errors=True)
@@ -211,28 +240,35 @@ def merge_tiles(config, quiet=True):
     os.makedirs(local_extract_path, exist_ok=True)
     os.makedirs(shared_directory, exist_ok=True)
     
-    # Download and extract each .tgz file
-    for s3_key in s3_keys:
-        print("s3key: ", s3_key)
+    # Download and extract all .tgz files at the same time (into a separate folder for each model)
+    def download_and_extract(s3_key):
         # create a tmp directory for each model and download
-        tmp_dir = os.path.join(local_extract_path, os.path.splitext(os.path.basename(s3_key))[0])
-        print("tmp_dir: ", tmp_dir)
+        tmp_dir = os.path.join(local_extract_path, s3_key.split("/")[-3])
         try:
-            cloud.download_and_extract_tgz(s3_bucket, s3_key, tmp_dir)
+            if not cloud.download_and_extract_tgz(s3_bucket, s3_key, tmp_dir):
+                return None
         except Exception as e:
             print("Failed to download and extract {}: {}".format(s3_key, e))
-            continue
+            return None
         if not quiet:
             print("Downloaded and extracted {}".format(s3_key))
+        return tmp_dir
 
-        # Process the tiles (merge model tiles with existing tiles in shared directory)
-        print("merging model tiles from " + tmp_dir + " to " + shared_directory)
-        merge_model_tiles(tmp_dir, shared_directory)
-        if not quiet:
-            print("Processed tiles from {}".format(s3_key))
+    def downloaded_folders(futures):
+        # Model folders in model order, each as soon as it (and the folders of the models before it) has been downloaded
+        for future in futures:
+            tmp_dir = future.result()
+            if tmp_dir:
+                yield tmp_dir
+
+    # Process the tiles (merge tiles of all models into the shared directory, while the next models are downloaded)
+    print("merging model tiles from " + local_extract_path + " to " + shared_directory)
+    with ThreadPoolExecutor(max_workers=cloud.nr_threads) as pool:
+        futures = [pool.submit(download_and_extract, s3_key) for s3_key in s3_keys]
+        merge_model_tiles(downloaded_folders(futures), shared_directory, tile_encoding=config.get("tile_encoding", "rgba"))
 
-        # Clean up the extracted directory
-        shutil.rmtree(tmp_dir)
+    # Clean up the extracted directories
+    shutil.rmtree(local_extract_path, ignore_errors=True)
     
     if not quiet:
         print("Merged tiles for variable {} in scenario {}".format(variable, scenario))
@@ -242,9 +278,12 @@ def merge_tiles(config, quiet=True):
     cloud.upload_folder(output_s3_bucket, shared_directory, output_s3_prefix, quiet=quiet)
     # cloud.bulk_upload_folder(output_s3_bucket, shared_directory, output_s3_prefix, num_threads=8)
 
-# Read config file (config.yml)
-config = yaml2dict("config.yml")
+if __name__ == "__main__":
+    # Guard is needed for the process pool that merges the tiles
+
+    # Read config file (config.yml)
+    config = yaml2dict("config.yml")
 
-print("Running merge_tiles.py")
+    print("Running merge_tiles.py")
 
-merge_tiles(config, quiet=True)
\ No newline at end of file
+    merge_tiles(config, quiet=True)
@@ -17,15 +17,21 @@ import toml
 import geopandas as gpd
 import shapely
 import platform
+import json
+import tarfile
 
 from .cosmos_main import cosmos
 from .cosmos_cluster import cluster_dict as cluster
 from .cosmos_stations import read_station_set
+from .cosmos_staging import get_file_hash
 
 from cht_nesting import nest2
 import cht_utils.fileops as fo
 from cht_utils.misc_tools import dict2yaml
 
+# Helper modules that are copied next to the run script (run_job_2.py) in every job folder
+job_helpers = ["cosmos_s3.py", "cosmos_tiles.py", "cosmos_ensemble.py", "cosmos_staging.py"]
+
 class Model:
     """Read generic model data from toml file, prepare model run paths, and submit jobs.
 
@@ -87,6 +93,29 @@ class Model:
         self.role               = "generic"  # can be "generic", "floodmap", "large_scale". Based on the role, we can set some predefined actions. This happens e.g. in cosmos_sfincs.py
         self.resolution         = -999.0
         self.omp_num_threads    = -1 # Use -1 to use max number available
+        self.nr_mpi_processes   = None # Number of MPI processes (only for models that run with MPI)
+        self.memory             = None # Memory (GB) that a job needs (used by parallel worker nodes, None means unknown)
+        self.static_inputs      = None # File name patterns of inputs that are never changed in the job folder (these can be linked rather than copied)
+        self.output_patterns    = None # File name patterns of the outputs that parallel worker nodes copy back (None means all new or changed files)
+        self.exit_code          = None
+        self.input_hash         = None
+        self.cached             = False # True if simulation is skipped, because inputs have not changed
+        self.cached_restart_files = [] # Restart files that were put back when the simulation was skipped
+        self.run_start_time     = None # Time at which the job process was started (if known)
+        self.cloud_dag          = False # True if job is submitted as part of the DAG workflow of the cycle
+        self.cloud_job_arguments = None
+        self._status            = None
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        if cosmos.job_state:
+            # Store status, so that the cycle can be resumed after a restart
+            cosmos.job_state.set_status(self, status)
 
     def read_generic(self):
         """Read model attributes from model.toml file.
@@ -269,10 +298,26 @@ class Model:
         config["run_mode"] = cosmos.config.run.run_mode
         config["event_mode"] = cosmos.config.run.event_mode
         config["vertical_reference_level_difference_with_msl"] = self.vertical_reference_level_difference_with_msl
+        # Number of processes that make map tiles (0 means use the cores of the job)
+        config["nr_tile_workers"] = cosmos.config.run.nr_tile_workers
+        # Number of cores of the job (0 means all cores of the node)
+        nr_cores = self.get_nr_cores() or 0
+        if cosmos.config.run.run_mode == "serial" and cosmos.config.run.max_cores:
+            nr_cores = min(nr_cores or cosmos.config.run.max_cores, cosmos.config.run.max_cores)
+        config["nr_cores"] = nr_cores
+        # Remove empty tiles and link identical tiles
+        config["optimize_tiles"] = cosmos.config.run.optimize_tiles
+        config["tile_encoding"] = cosmos.config.run.tile_encoding
+        # Static inputs that ensemble members may link from base_input
+        config["link_static_inputs"] = cosmos.config.run.link_static_inputs
+        config["static_inputs"] = self.static_inputs or []
 
         ## INPUT for nesting
         if self.ensemble:
             config["spw_path"] = cosmos.scenario.cycle_track_ensemble_spw_path
+            # Ensemble members that run at the same time (0 means use all cores of the node)
+            config["ensemble_nr_simultaneous_members"] = cosmos.config.run.ensemble_nr_simultaneous_members
+            config["ensemble_threads_per_member"] = cosmos.config.run.ensemble_threads_per_member
         if cosmos.config.run.run_mode == "cloud":
             config["cloud"] = {}
             config["cloud"]["host"] = cosmos.config.cloud_config.host
@@ -281,6 +326,8 @@ class Model:
             config["cloud"]["region"] = cosmos.config.cloud_config.region
             config["cloud"]["token"] = cosmos.config.cloud_config.token
             config["cloud"]["namespace"] = cosmos.config.cloud_config.namespace
+            # Number of files that are transferred at the same time
+            config["cloud"]["nr_transfer_threads"] = cosmos.config.cloud_config.nr_transfer_threads
         if self.flow_nested:
             # Water level forcing
             config["flow_nested"] = {}
@@ -456,6 +503,13 @@ class Model:
 
         dict2yaml(os.path.join(self.job_path, "config.yml"), config)
 
+    def copy_job_helpers(self):
+        """Copy the helper modules that are used by the run script to the job folder.
+        """
+        pth = os.path.dirname(__file__)
+        for file_name in job_helpers:
+            fo.copy_file(os.path.join(pth, file_name), os.path.join(self.job_path, file_name))
+
     def submit_job(self):
 
         # And now actually kick off this job
@@ -480,6 +534,8 @@ class Model:
             fo.copy_file(os.path.join(self.job_path, "base_input", "ensemble_members.txt"), self.job_path)
             # Copy run_job_2.py to job folder
             fo.copy_file(os.path.join(self.job_path, "base_input", "run_job_2.py"), self.job_path)
+            for file_name in job_helpers:
+                fo.copy_file(os.path.join(self.job_path, "base_input", file_name), self.job_path)
             # Copy config.yml to job folder
             fo.copy_file(os.path.join(self.job_path, "base_input", "config.yml"), self.job_path)
         
@@ -499,15 +555,21 @@ class Model:
                     fid.write(r"call %CONDAPATH%\Scripts\activate.bat "+ cosmos.config.conda.env + "\n")
                 else:
                     fid.write(r"call %CONDAPATH%\Scripts\activate.bat cosmos" + "\n")
+                # Time (seconds since epoch) at which the job actually started (used for expected runtimes)
+                fid.write('python -c "import time; print(time.time())" > started.txt\n')
                 if self.ensemble:
                     fid.write("python run_job_2.py prepare_ensemble\n")
                     fid.write("python run_job_2.py simulate\n")
+                    # Only merge the outputs if all ensemble members ran successfully
+                    fid.write("if not errorlevel 1 (\n")
                     fid.write("python run_job_2.py merge_ensemble\n")
                     if not self.type == "beware":
                         fid.write("python run_job_2.py map_tiles\n")   
                     fid.write("python run_job_2.py clean_up\n")   
+                    fid.write(")\n")
                 else:
-                    fid.write("python run_job_2.py simulate\n")
+                    if not self.cached:
+                        fid.write("python run_job_2.py simulate\n")
                     if not self.type == "beware":
                         fid.write("python run_job_2.py map_tiles\n")   
                 fid.write("move running.txt finished.txt\n")
@@ -518,17 +580,22 @@ class Model:
                 fid = open(os.path.join(self.job_path, "run_job.sh"), "w")
                 fid.write("#!/bin/bash\n")
                 fid.write("date > running.txt\n")
+                # Time (seconds since epoch) at which the job actually started (used for expected runtimes)
+                fid.write("date +%s > started.txt\n")
                 fid.write("conda init\n")
                 fid.write(f"conda activate {cosmos.config.conda.env}\n")
                 if self.ensemble:
                     fid.write("python run_job_2.py prepare_ensemble\n")
-                    fid.write("python run_job_2.py simulate\n")
+                    # Only merge the outputs if all ensemble members ran successfully
+                    fid.write("if python run_job_2.py simulate; then\n")
                     fid.write("python run_job_2.py merge_ensemble\n")
                     if not self.type == "beware":
                         fid.write("python run_job_2.py map_tiles\n")   
                     fid.write("python run_job_2.py clean_up\n")
+                    fid.write("fi\n")
                 else:
-                    fid.write("python run_job_2.py simulate\n")
+                    if not self.cached:
+                        fid.write("python run_job_2.py simulate\n")
                     if not self.type == "beware":
                         fid.write("python run_job_2.py map_tiles\n")
                 fid.write("mv running.txt finished.txt\n")
@@ -537,25 +604,8 @@ class Model:
         # Run batch file (bat or sh) and python run_job_2.py are ready. Now actually submit the job.  
         if cosmos.config.run.run_mode == "serial":
             # Model needs to be run in serial mode (local on the job path of a windows machine) or on same HPC node as CoSMoS
-            if platform_name == "windows":
-                cosmos.log("Writing tmp.bat in " + os.getcwd() + " ...")
-                fid = open("tmp.bat", "w")
-                fid.write(self.job_path[0:2] + "\n")
-                fid.write("cd " + self.job_path + "\n")
-                fid.write("call run_job.bat\n")
-                fid.write("exit\n")
-                fid.close()
-                os.system('start tmp.bat')
-            else:
-                # Run on HPC node
-                cosmos.log("Running on HPC node ...")
-                fid = open("tmp.sh", "w")
-                fid.write("#!/bin/bash\n")
-                fid.write("cd " + self.job_path + "\n")
-                fid.write("source ./run_job.sh\n")
-                fid.write("exit\n")
-                fid.close()
-                os.system("source ./tmp.sh")
+            # The local executor starts the job as soon as there are enough free cores, and reports back to the model loop when it is finished
+            cosmos.model_loop.executor.submit(self)
             
         elif cosmos.config.run.run_mode == "cloud":
             cosmos.log("Ready to submit to Argo - " + self.long_name + " ...")
@@ -576,8 +626,7 @@ class Model:
                 cosmos.cloud.upload_folder("cosmos-scenarios",
                                             os.path.join(self.job_path, "base_input"),
                                             s3key + "/base_input")
-            cosmos.log("Submitting template job : " + self.workflow_name)
-            self.cloud_job = cosmos.argo.submit_template_job(
+            self.cloud_job_arguments = dict(
                 workflow_name=self.workflow_name, 
                 job_name=self.name, 
                 subfolder=s3key,
@@ -586,6 +635,12 @@ class Model:
                 webviewerfolder=webviewerfolder,
                 tilingfolder=tilesfolder
                 )
+            if self.cloud_dag:
+                # Job will be submitted as part of the DAG workflow of the cycle
+                cosmos.log("Job for " + self.long_name + " will be submitted in cycle DAG")
+            else:
+                cosmos.log("Submitting template job : " + self.workflow_name)
+                self.cloud_job = cosmos.argo.submit_template_job(**self.cloud_job_arguments)
 
 
         elif cosmos.config.run.run_mode == "parallel":
@@ -594,15 +649,87 @@ class Model:
             # Make directory in jobs folder (if non-existent) 
             os.makedirs(os.path.join(cosmos.config.path.jobs, cosmos.scenario.name), exist_ok=True)
                         
+            # Write list of inputs, so that WCP nodes only copy what they do not have yet
+            self.write_staging_manifest()
+
             # write file name containing job path to jobs folder
+            # (first to a temporary file, so that WCP nodes never pick up a file that is only partly written)
             file_name = os.path.join(cosmos.config.path.jobs, cosmos.scenario.name, f"{self.name}_{cosmos.cycle_string}.txt")
-            fid = open(file_name, "w")
-            fid.write(self.job_path)
+            # The job ticket also contains the cores and memory that the job needs, so that nodes only take jobs that fit
+            fid = open(file_name + ".tmp", "w")
+            fid.write(self.job_path + "\n")
+            fid.write("nr_cores=" + str(self.get_nr_cores() or 0) + "\n")
+            fid.write("memory=" + str(self.memory or 0) + "\n")
             fid.close()
+            os.replace(file_name + ".tmp", file_name)
 
         else:
             print("No run mode defined, should be either serial, parallel or cloud")
 
+    def write_staging_manifest(self):
+        """Write staging.json with the inputs and output patterns of the job (used by parallel worker nodes).
+
+        Input files larger than run.stage_cache_min_size get a content hash, so that nodes can keep them in
+        their local cache (the hash is only computed again when the size or modification time of the file has
+        changed). With run.stage_compress, the other files are also put in staged_inputs.tar.gz.
+
+        See Also
+        --------
+        cosmos.cosmos_run_parallel.CosmosRunParallel
+        """
+        min_size = cosmos.config.run.stage_cache_min_size * 1024**2
+        compress = cosmos.config.run.stage_compress
+        files = {}
+        small_files = []
+        for root, dirs, file_names in os.walk(self.job_path):
+            for file_name in file_names:
+                if file_name in ["staging.json", "staged_inputs.tar.gz"]:
+                    continue
+                full_name = os.path.join(root, file_name)
+                rel_path = os.path.relpath(full_name, self.job_path).replace("\\", "/")
+                size = os.path.getsize(full_name)
+                files[rel_path] = {"size": size}
+                if size >= min_size:
+                    files[rel_path]["sha256"] = get_file_hash(full_name, (self.name, rel_path))
+                else:
+                    small_files.append(rel_path)
+        if compress:
+            with tarfile.open(os.path.join(self.job_path, "staged_inputs.tar.gz"), "w:gz") as tar:
+                for rel_path in small_files:
+                    tar.add(os.path.join(self.job_path, rel_path), arcname=rel_path)
+        manifest = {"files": files,
+                    "output_patterns": self.output_patterns or ["*"],
+                    "compress": compress}
+        with open(os.path.join(self.job_path, "staging.json"), "w") as fid:
+            json.dump(manifest, fid, indent=1)
+
+    def unpack_staged_outputs(self):
+        """Extract outputs that a parallel worker node has copied back as staged_outputs.tar.gz."""
+        file_name = os.path.join(self.job_path, "staged_outputs.tar.gz")
+        if os.path.exists(file_name):
+            with tarfile.open(file_name, "r:gz") as tar:
+                tar.extractall(self.job_path)
+            os.remove(file_name)
+        # Input archive does not need to be kept
+        file_name = os.path.join(self.job_path, "staged_inputs.tar.gz")
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def get_nr_cores(self):
+        """Return number of cores that the job of this model needs (None if it uses all cores of the machine)."""
+        if self.ensemble:
+            # Ensemble members run simultaneously, see simulate_ensemble in the run_job script
+            nr_members = cosmos.config.run.ensemble_nr_simultaneous_members
+            nr_threads = cosmos.config.run.ensemble_threads_per_member
+            if nr_members > 0 and nr_threads > 0:
+                return nr_members * nr_threads
+            return None
+        if self.nr_mpi_processes:
+            return self.nr_mpi_processes
+        if self.omp_num_threads and self.omp_num_threads > 0:
+            return self.omp_num_threads
+        return None
+
     def set_paths(self):
         """Set model paths (input, output, figures, restart, job).
 
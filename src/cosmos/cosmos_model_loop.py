@@ -4,18 +4,18 @@ Created on Mon May 10 14:29:24 2021
 
 @author: ormondt
 """
-import time
-import sched
 import os
-import platform
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from .cosmos_main import cosmos
 from .cosmos_cluster import cluster_dict as cluster
+from .cosmos_job_watcher import JobWatcher
+from .cosmos_local_executor import LocalExecutor
+from .cosmos_scheduler import Scheduler
+from .cosmos_input_cache import InputCache
+from .cosmos_staging import stage_folder
 
-try:
-    from .cosmos_argo import Argo
-except Exception:
-    print("Argo not available")
 import cht_utils.fileops as fo
 
 class ModelLoop():
@@ -24,7 +24,7 @@ class ModelLoop():
     Parameters
     ----------
     start : func
-        Start running model loop with scheduler
+        Start running model loop, driven by the job watcher
     run : func
         Run model loop
     stop : func
@@ -44,34 +44,98 @@ class ModelLoop():
         pass
         
     def start(self):
-        """Start cosmos_model_loop.run with scheduler.
+        """Start cosmos_model_loop.run and repeat it every time a job finishes.
+
+        Finished jobs are detected by the job watcher, which puts them on the
+        completion queue. The model loop blocks on this queue, so that it
+        reacts as soon as a job finishes, rather than at fixed intervals.
 
         See Also
         -------
         cosmos.cosmos_model_loop.ModelLoop.run
+        cosmos.cosmos_job_watcher.JobWatcher
         """
 
         self.status = "running"
-        while self.status == "running":        
-            # This will be repeated until the status of the model loop changes to "done" 
-            self.scheduler = sched.scheduler(time.time,
-                                              time.sleep)
-            if cosmos.config.run.run_mode == "cloud":
-                dt = 20.0 # Execute the next model loop 1 second from now
-            else:                
-                dt = 1.0 # Execute the next model loop 1 second from now
-            self.scheduler.enter(dt, 1, self.run, ())
-            self.scheduler.run()
+
+        # Build dependency graph of the models in this cycle
+        self.scheduler = Scheduler()
+        self.scheduler.build()
+
+        # Results of previous runs with the same inputs
+        self.input_cache = InputCache()
+
+        self.completion_queue = queue.Queue()
+        self.job_watcher = JobWatcher(self.completion_queue)
+        self.job_watcher.start()
+        if cosmos.config.run.run_mode == "serial":
+            # Jobs are run as sub processes that report back when they are finished
+            self.executor = LocalExecutor(self.completion_queue)
+
+        # Models that are ready to run are pre-processed and submitted in worker threads
+        self.preprocess_pool = ThreadPoolExecutor(max_workers=max(cosmos.config.run.nr_preprocess_workers, 1))
+        # Finished models are post-processed in the background, so that this never delays dispatching of other models
+        self.postprocess_pool = ThreadPoolExecutor(max_workers=max(cosmos.config.run.nr_postprocess_workers, 1))
+
+        # Models that were resumed from the job state database
+        for model in cosmos.scenario.model:
+            if model.status == "running":
+                # Still running, wait for it to finish
+                self.job_watcher.add(model)
+            elif model.status == "simulation_finished":
+                # Moved, but not yet post-processed
+                self.postprocess_pool.submit(self.post_process, model)
+
+        # In cloud DAG mode, all models are submitted at once as one Argo workflow
+        self.cloud_dag = cosmos.config.run.run_mode == "cloud" and cosmos.config.run.cloud_dag
+        if self.cloud_dag and cluster:
+            # Which models run in a cluster is decided here, after the overall models have finished
+            cosmos.log("Cloud DAG mode can not be used with clusters. Models will be submitted one by one.")
+            self.cloud_dag = False
+        if self.cloud_dag:
+            self.submit_cycle_dag()
+
+        finished_list = []
+        while self.status == "running":
+            # This will be repeated until the status of the model loop changes to "done"
+            self.run(finished_list)
+            if self.status != "running":
+                break
+            # Wait for the next job to finish (the timeout is just a safety net)
+            try:
+                finished_list = [self.completion_queue.get(timeout=60.0)]
+            except queue.Empty:
+                finished_list = []
+            # Jobs that finished at (almost) the same time are handled in one go
+            while True:
+                try:
+                    finished_list.append(self.completion_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is only used to wake up the model loop (post-processing done, or stop requested)
+            finished_list = [model for model in finished_list if model is not None]
 
     def stop(self):
         """Stop cosmos_model_loop.
         """
-        self.scheduler.cancel()
+        self.status = "stopped"
+        self.job_watcher.stop()
+        self.preprocess_pool.shutdown(wait=False)
+        self.postprocess_pool.shutdown(wait=False)
+        if cosmos.config.run.run_mode == "serial":
+            self.executor.stop()
+        # Wake up model loop
+        self.completion_queue.put(None)
 
-    def run(self):
+    def run(self, finished_list):
         """ Run all cosmos models defined in the scenario file.
 
-        - Check for finished simulations and move them to scenario folder
+        Parameters
+        ----------
+        finished_list : list
+            Models that have finished since the previous call (reported by the job watcher)
+
+        - Move finished simulations to scenario folder
         - Make waiting list, prepare input and submit these models
         - Post process models from Step 1 (time series data)
         - Check if all models are finished. If true: make webviewer 
@@ -84,15 +148,23 @@ class ModelLoop():
         cosmos.cosmos_sfincs.CoSMoS_SFINCS.post_process
         """
 
-        # First check for finished simulations (returns a list with model objects that just finished)
-        finished_list = check_for_finished_simulations()
-    
         # If there are simulations ready ...
         for model in finished_list:    
+            if model.exit_code:
+                # Job could not be started or did not finish properly (only known for local jobs)
+                cosmos.log("Model " + model.long_name + " failed!")
+                model.status = "failed"
+                if self.cloud_dag:
+                    # Nested models in the DAG workflow will not run
+                    for mdl in self.scheduler.get_descendants(model):
+                        if mdl.status == "running" and self.job_watcher.remove(mdl):
+                            mdl.status = "failed"
             # First move data from all finished simulations
             # (so that pre-processing of next model can commence)
             # Post-processing will happen later
             if not model.status == 'failed':
+                # Only successful runs are used for the expected runtimes
+                self.scheduler.finished(model)
                 if cosmos.config.run.run_mode == "cloud":
                     # Download job folder from cloud storage (ideally we do not need to do this, but then extraction of time series data needs to be done in the cloud as well)
                     # Alternatively, we could just download the his file for local post-processing
@@ -100,6 +172,9 @@ class ModelLoop():
                     cosmos.cloud.download_folder("cosmos-scenarios",
                                                  subfolder,
                                                  model.job_path)
+                elif cosmos.config.run.run_mode == "parallel":
+                    # Outputs may have been copied back as an archive
+                    model.unpack_staged_outputs()
                 # Moving files to input, output and restart folders
                 cosmos.log("Moving model " + model.long_name)
                 # First make folders
@@ -107,16 +182,63 @@ class ModelLoop():
                 fo.mkdir(model.cycle_output_path)
                 # fo.mkdir(model.cycle_figures_path)
                 fo.mkdir(model.cycle_post_path)
+                if cosmos.config.run.skip_unchanged_models:
+                    restart_files = self.input_cache.get_restart_files(model)
                 # Call model specific move function (this will move new restart files to restart folder, inputs to input folder, and outputs to output folder)
                 model.move()
+                if cosmos.config.run.skip_unchanged_models:
+                    self.input_cache.store(model, restart_files)
                 model.status = "simulation_finished"
     
-        # Now prepare new models ready to run (returns a list with model objects that are ready to run)        
-        waiting_list = update_waiting_list()
+        # Now prepare new models ready to run (returns a list with model objects that are ready to run)
+        # Nested models can already start once their parents have been moved        
+        waiting_list = update_waiting_list(self.scheduler)
 
-        # Pre process all waiting simulations
+        # Pre process and submit all waiting simulations (in worker threads)
         for model in waiting_list:
-            
+            # Set status here, so that the model is not picked up again in the next model loop
+            model.status = "pre_processing"
+            self.preprocess_pool.submit(self.pre_process_and_submit, model)
+
+        # Now do post-processing on simulations that were finished (in the background)
+        for model in finished_list:
+            if model.status == "failed":
+                continue
+            self.postprocess_pool.submit(self.post_process, model)
+        
+        # Now check if all simulations are completely finished    
+        all_finished = True
+        for model in cosmos.scenario.model:
+            if model.status != "failed" and model.status != "finished":
+                all_finished = False
+
+        if all_finished:
+            cosmos.log("All models finished!")
+            self.status = "done"
+            # Stop watching before finishing, as this may start the next cycle
+            self.job_watcher.stop()
+            self.preprocess_pool.shutdown()
+            self.postprocess_pool.shutdown()
+            cosmos.main_loop.finish()
+
+        else:
+            # Do another model loop 
+            pass
+
+    def pre_process_and_submit(self, model):
+        """Make job folder, pre-process and submit model (runs in worker thread).
+
+        If anything goes wrong, the model is set to failed and put on the completion queue,
+        so that the model loop can deal with its nested models.
+
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Model that is ready to run
+        """
+
+        try:
+
             cosmos.log("Pre-processing " + model.long_name + " ...")
             
             # Make job path and copy inputs
@@ -126,162 +248,170 @@ class ModelLoop():
             fo.mkdir(model.restart_flow_path)
             fo.mkdir(model.restart_wave_path)
 
-            # Copy base inputs to job folder
-            src = os.path.join(model.path, "input", "*")
-            fo.copy_file(src, model.job_path)
+            # Copy base inputs to job folder (static inputs are linked if possible)
+            count = stage_folder(os.path.join(model.path, "input"),
+                                 model.job_path,
+                                 static_inputs=model.static_inputs,
+                                 link=cosmos.config.run.link_static_inputs)
+            if count.get("copy", 0) < sum(count.values()):
+                cosmos.log("Staged inputs in " + model.job_path + " : " + ", ".join(str(n) + " " + m for m, n in count.items()))
 
             # Do some pre-processing (meteo and nesting step 1)
             model.pre_process()  # Adjust model input (this happens in model.job_path)
 
+            # Check if this model has run before with exactly the same inputs
+            model.cached = False
+            if cosmos.config.run.skip_unchanged_models and cosmos.config.run.run_mode != "cloud" and not model.ensemble:
+                model.cached = self.input_cache.restore(model)
+
             # And submit the job
+            self.scheduler.submitted(model)
             model.submit_job()
 
-        # Now do post-processing on simulations that were finished
-        for model in finished_list:
-            # For now, only extract time series data
-            cosmos.log("Post-processing " + model.long_name + " ...")
+            if cosmos.config.run.run_mode != "serial":
+                # Job watcher will let us know when it is finished
+                self.job_watcher.add(model)
+
+        except Exception as e:
+            cosmos.log("An error occured while pre-processing or submitting " + model.long_name + " : " + str(e))
+            model.status = "failed"
+            self.completion_queue.put(model)
+
+    def submit_cycle_dag(self):
+        """Pre-process and upload all waiting models, and submit them as one Argo DAG workflow.
+
+        Dependencies in the DAG follow the dependency graph of the scheduler. The job watcher
+        keeps track of the workflows of the individual models, so moving and post-processing
+        work the same as when models are submitted one by one.
 
+        Models with a tide-only model need its map file when they are pre-processed (for the storm
+        surge maps). These models, and the models that depend on them, are left out of the DAG, and
+        are submitted one by one once the tide-only model has finished.
+        """
+
+        # Scheduler order is a topological order, so parents are always checked first
+        models   = []
+        excluded = []
+        for model in self.scheduler.order:
+            if model.status != "waiting":
+                continue
+            if model.tide_only_model is not None and model.tide_only_model.status not in ["simulation_finished", "finished"]:
+                excluded.append(model.name)
+            elif any(parent.name in excluded for parent in self.scheduler.parents[model.name]):
+                excluded.append(model.name)
+            else:
+                models.append(model)
+        if excluded:
+            cosmos.log("Models that are submitted after their tide-only model has finished : " + ", ".join(excluded))
+        if not models:
+            return
+
+        # Pre-process and upload all models (in worker threads)
+        futures = []
+        for model in models:
+            model.status = "pre_processing"
+            model.cloud_dag = True
+            futures.append(self.preprocess_pool.submit(self.pre_process_and_submit, model))
+        wait(futures)
+
+        # Parents are always added first
+        jobs  = []
+        names = []
+        for model in models:
+            if model.status != "running":
+                # Pre-processing failed (model is already on the completion queue)
+                continue
+            okay = True
+            dependencies = []
+            for parent in self.scheduler.parents[model.name]:
+                if parent.name in names:
+                    dependencies.append(parent.name)
+                elif parent.status not in ["simulation_finished", "finished"]:
+                    # Parent failed
+                    okay = False
+            if not okay:
+                self.job_watcher.remove(model)
+                model.status = "failed"
+                self.completion_queue.put(model)
+                continue
+            job = dict(model.cloud_job_arguments)
+            job.pop("scenario")
+            job.pop("cycle")
+            job["dependencies"] = dependencies
+            jobs.append(job)
+            names.append(model.name)
+
+        if jobs:
             try:
-                model.post_process()
-                cosmos.log("Post-processing " + model.long_name + " done.")
+                self.cloud_job = cosmos.argo.submit_cycle_dag(jobs, cosmos.scenario.name, cosmos.cycle_string)
             except Exception as e:
-                print("An error occured while post-processing : " + model.name)
-                print(f"Error: {e}")
+                cosmos.log("An error occured while submitting the DAG workflow : " + str(e))
+                for model in models:
+                    if model.name in names and self.job_watcher.remove(model):
+                        model.status = "failed"
+                        self.completion_queue.put(model)
 
-            model.status = "finished"
-            
-            # Write finished file
-            #later change to if cosmos.config.run_mode == "parallel":            
-            try: 
-                finished_file_name = os.path.join(model.cycle_output_path, "finished.txt")
-                fid = open(finished_file_name, 'r')
-                pcname = fid.read().splitlines()[1]
-                fid.close()
-                
-                cosmos.log(model.long_name + " was run by " + pcname)
-                
-                file_name = os.path.join(cosmos.scenario.cycle_job_list_path,
-                         model.name + ".finished")            
-                fid = open(file_name, "w")
-                fid.write("finished by " + pcname)
-                fid.close()
-                             
-            except Exception as e:
-                file_name = os.path.join(cosmos.scenario.cycle_job_list_path,
-                                         model.name + ".finished")            
-                fid = open(file_name, "w")
-                fid.write("finished")
-                fid.close()
-        
-        # Now check if all simulations are completely finished    
-        all_finished = True
-        for model in cosmos.scenario.model:
-            if model.status != "failed" and model.status != "finished":
-                all_finished = False
+    def post_process(self, model):
+        """Post-process model and write finished file (runs in worker thread).
 
-        if all_finished:
-            cosmos.log("All models finished!")
-            self.status = "done"
-            cosmos.main_loop.finish()
+        When done, the model status is set to finished and the model loop is woken up,
+        so that it can check whether all models are finished.
 
-        else:
-            # Do another model loop 
-            pass
+        Parameters
+        ----------
+        model : cosmos.cosmos_model.Model
+            Model that has been moved
+        """
 
-def check_for_finished_simulations():
-    """Check if there are finished simulations to be post-processed.
-    """    
-    finished_list = []
-    
-    for model in cosmos.scenario.model:
-        try:
-            if model.status == "running":
-                if cosmos.config.run.run_mode == "cloud":
-                    #TODO: Implement handling of failed workflow. What happens
-                    #      when a workflow fails?
-                    if Argo.get_task_status(model.cloud_job) != "Running":
-                        finished_list.append(model)
-                else:
-                    file_name = os.path.join(model.job_path,
-                                            "finished.txt")
-                    if os.path.exists(file_name):
-                        finished_list.append(model)
-        except:
-            print("An error occurred when checking job status!")                
-                              
-    return finished_list
-
-def update_waiting_list():
-    """Check which models can be run next according to their status and prioritization level.
-    """
-    # Check which models need to run next
-    
-    waiting_list = []
-    priorities   = []
-    running      = False
+        # For now, only extract time series data
+        cosmos.log("Post-processing " + model.long_name + " ...")
 
-    # Check for all clusters if they are ready to run 
-    for cl in cluster.values():
-        cl.check_ready_to_run()
-            
-    for model in cosmos.scenario.model:
+        try:
+            model.post_process()
+            cosmos.log("Post-processing " + model.long_name + " done.")
+        except Exception as e:
+            print("An error occured while post-processing : " + model.name)
+            print(f"Error: {e}")
 
-        if model.status == "waiting":
-            # This model is waiting
+        # Write finished file
+        #later change to if cosmos.config.run_mode == "parallel":            
+        try: 
+            finished_file_name = os.path.join(model.cycle_output_path, "finished.txt")
+            fid = open(finished_file_name, 'r')
+            pcname = fid.read().splitlines()[1]
+            fid.close()
             
-            okay = True
+            cosmos.log(model.long_name + " was run by " + pcname)
             
-            if model.flow_nested:
-                if model.flow_nested.status != "finished":
-                    okay = False
-                if model.flow_nested.status == "failed":
-                    model.status = "failed"
-            if model.wave_nested:
-                if model.wave_nested.status != "finished":
-                    okay = False
-                if model.wave_nested.status == "failed":
-                    model.status = "failed"
-            if model.bw_nested:
-                if model.bw_nested.status != "finished":
-                    okay = False
-                if model.bw_nested.status == "failed":
-                    model.status = "failed"
-            if model.tide_only_model:
-                # We always first want to run the tide only model first!
-                if model.tide_only_model.status != "finished":
-                    okay = False
-                if model.tide_only_model.status == "failed":
-                    model.status = "failed"
-                    
-            if okay and model.cluster:
-                # Model appears ready to run, and is member of a cluster
-                # if not model.peak_boundary_twl:
-                #     #  Peak boundary data has not yet been determined
-                #     model.get_peak_boundary_conditions()
-                if not cluster[model.cluster].ready:
-                    # This model sits in a cluster that is not ready to run
-                    okay = False
-                                                
-            if okay:
-                waiting_list.append(model)
-                priorities.append(model.priority)
+            file_name = os.path.join(cosmos.scenario.cycle_job_list_path,
+                     model.name + ".finished")            
+            fid = open(file_name, "w")
+            fid.write("finished by " + pcname)
+            fid.close()
+                         
+        except Exception as e:
+            file_name = os.path.join(cosmos.scenario.cycle_job_list_path,
+                                     model.name + ".finished")            
+            fid = open(file_name, "w")
+            fid.write("finished")
+            fid.close()
 
-        if model.status == "running":
-            # There are model(s) running
-            running = True
+        model.status = "finished"
 
-    if waiting_list:
-        
-        # Sort waiting list according to prioritization
-        waiting_list.sort(key=lambda x: priorities, reverse = True)
-        if cosmos.config.run.run_mode == "serial":
-            # Only put first job in waiting list
-            waiting_list = waiting_list[:1]        
-            if running:
-                # There is already a model running. Wait for it to finish.
-                waiting_list = []
-        elif cosmos.config.run.run_mode == "parallel":
-            # Put all jobs at certain priority level in waiting list
-            waiting_list = waiting_list[:]        
+        # Wake up model loop
+        self.completion_queue.put(None)
+
+def update_waiting_list(scheduler):
+    """Check which models can be run next according to their dependencies and critical path.
+
+    Parameters
+    ----------
+    scheduler : cosmos.cosmos_scheduler.Scheduler
+        Scheduler with dependency graph of this cycle
+    """
+
+    # Models that are ready to run, sorted in critical path order
+    # In serial mode, the local executor makes sure that the jobs fit in the core budget
+    waiting_list = scheduler.get_ready_models()
 
     return waiting_list
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Catalogue of the restart files in the restart folders of a scenario.
+"""
+
+import os
+import bisect
+import datetime
+import shutil
+import threading
+
+# Catalogues of all restart folders (key is path)
+catalogues = {}
+catalogues_lock = threading.Lock()
+
+class RestartCatalogue:
+    """Sorted list of the restart files (and their times) in a restart folder.
+
+    The folder is only scanned once, when the catalogue is made. After that, the catalogue is
+    updated when restart files are moved in (move_in) or removed (remove), and lookups are done
+    with a binary search. Restart file names end with the restart time (e.g. sfincs.20240101.120000.rst).
+
+    Parameters
+    ----------
+    path : str
+        Restart folder (made if it does not exist)
+
+    See Also
+    --------
+    cosmos.cosmos_restart_catalogue.get_restart_catalogue
+    """
+    def __init__(self, path):
+        self.path  = path
+        self.times = []
+        self.files = []
+        self.lock  = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        """Read restart files in the restart folder."""
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for file_name in os.listdir(self.path):
+            t = get_restart_file_time(file_name)
+            if t is not None:
+                entries.append((t, file_name))
+        entries.sort()
+        with self.lock:
+            self.times = [e[0] for e in entries]
+            self.files = [e[1] for e in entries]
+
+    def add(self, file_name):
+        """Add restart file (which is already in the restart folder) to the catalogue."""
+        t = get_restart_file_time(file_name)
+        if t is None:
+            return
+        with self.lock:
+            if file_name in self.files:
+                return
+            i = bisect.bisect_right(self.times, t)
+            self.times.insert(i, t)
+            self.files.insert(i, file_name)
+
+    def move_in(self, src, file_name=None):
+        """Move restart file into the restart folder (as file_name, default is the same name) and add it."""
+        if file_name is None:
+            file_name = os.path.basename(src)
+        dst = os.path.join(self.path, file_name)
+        if os.path.exists(dst):
+            os.remove(dst)
+        shutil.move(src, dst)
+        self.add(file_name)
+
+    def remove(self, file_name):
+        """Remove restart file from the restart folder and the catalogue."""
+        with self.lock:
+            if file_name in self.files:
+                i = self.files.index(file_name)
+                self.times.pop(i)
+                self.files.pop(i)
+        pth = os.path.join(self.path, file_name)
+        if os.path.exists(pth):
+            os.remove(pth)
+
+    def find(self, t0, t1, include_t0=True):
+        """Return time and name of the last restart file between t0 and t1 (None, None if there is none)."""
+        with self.lock:
+            i = bisect.bisect_right(self.times, t1) - 1
+            if i < 0:
+                return None, None
+            t = self.times[i]
+            file_name = self.files[i]
+        if t < t0 or (t == t0 and not include_t0):
+            return None, None
+        if not os.path.exists(os.path.join(self.path, file_name)):
+            # File was removed by something else, read the folder again
+            self.scan()
+            return self.find(t0, t1, include_t0=include_t0)
+        return t, file_name
+
+    def older_than(self, t):
+        """Return names of the restart files with a time before t."""
+        with self.lock:
+            return self.files[:bisect.bisect_left(self.times, t)]
+
+def get_restart_file_time(file_name):
+    """Return time of restart file (None if the file name does not end with a time)."""
+    if not file_name.endswith(".rst"):
+        return None
+    try:
+        return datetime.datetime.strptime(file_name[-19:-4], "%Y%m%d.%H%M%S")
+    except ValueError:
+        return None
+
+def get_restart_catalogue(path):
+    """Return catalogue of a restart folder (made the first time it is needed)."""
+    with catalogues_lock:
+        if path not in catalogues:
+            catalogues[path] = RestartCatalogue(path)
+        return catalogues[path]
+
+def clear_restart_catalogues():
+    """Forget all catalogues (e.g. after the restart folders have been removed)."""
+    with catalogues_lock:
+        catalogues.clear()
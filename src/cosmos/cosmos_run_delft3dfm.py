@@ -15,35 +15,12 @@ from cht_utils.prob_maps import merge_nc_map
 from cht_tiling import TiledWebMap
 from cht_delft3dfm.delft3dfm import Delft3DFM
 from cht_nesting import nest2
+# S3 helpers (cosmos_s3.py is copied next to this script)
+from cosmos_s3 import get_s3_client, get_nr_transfer_threads, download_s3_folder, delete_s3_folder
+# Ensemble helpers (cosmos_ensemble.py is copied next to this script)
+from cosmos_ensemble import read_ensemble_members, prepare_ensemble, copy_base_input
 #from cht_utils.argo import Argo
 
-def read_ensemble_members():
-    with open('ensemble_members.txt') as f:
-        ensemble_members = f.readlines()
-    ensemble_members = [x.strip() for x in ensemble_members]
-    return ensemble_members
-
-def get_s3_client(config):
-    # Create an S3 client
-    session = boto3.Session(
-        aws_access_key_id=config["cloud"]["access_key"],
-        aws_secret_access_key=config["cloud"]["secret_key"],
-        region_name=config["cloud"]["region"]
-    )
-    return session.client('s3')
-
-def prepare_ensemble(config):
-    # In case of ensemble, make folders for each ensemble member and copy necessary scripts to these folders
-    # Read in the list of ensemble members
-    ensemble_members = read_ensemble_members()
-    for member in ensemble_members:
-        print('Making folder for ensemble member ' + member)
-        # Make folder for ensemble member and copy all input files
-        fo.mkdir(member)            
-        fo.copy_file(os.path.join("base_input", "run_job_2.py"), member)
-        fo.copy_file(os.path.join("base_input", "config.yml"), member)
-        fo.copy_file(os.path.join("base_input", "ensemble_members.txt"), member)
-
 def prepare_single(config, member=None):
     # Copying, nesting, spiderweb
     # We're already in the correct folder
@@ -59,23 +36,14 @@ def prepare_single(config, member=None):
         else:
             s3_key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/"
         local_file_path = f'/input/'  # Replace with the local path where you want to save the file
-        objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3_key)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                key = object['Key']
-                # Only download files in main folder, not in subfolders
-                if key[-1] == "/":
-                    continue
-                if "/" in key.replace(s3_key, ""):
-                    continue
-                local_path = os.path.join(local_file_path, os.path.basename(key))
-                print("Copying " + key + " to " + local_path) 
-                s3_client.download_file(bucket_name, key, local_path)
+        # Only download files in main folder, not in subfolders
+        download_s3_folder(s3_client, bucket_name, s3_key, local_file_path,
+                           nr_threads=get_nr_transfer_threads(config))
     else:
         if config["ensemble"]:
             # Copy from input folder
             # We're already in the right member path
-            fo.copy_file(os.path.join("..", "base_input", "*.*"), ".")
+            copy_base_input(config)
 
     # Copy spiderweb file
     if config["ensemble"]:
@@ -182,9 +150,8 @@ def clean_up(config):
             for member in ensemble_members:
                 s3key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/" + member
                 # Delete folder from S3
-                objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3key)
-                for object in objects['Contents']:
-                    s3_client.delete_object(Bucket=bucket_name, Key=object['Key'])
+                delete_s3_folder(s3_client, bucket_name, s3key,
+                                 nr_threads=get_nr_transfer_threads(config))
         else:
             for member in ensemble_members:
                 try:
@@ -4,7 +4,6 @@ import os
 import pandas as pd  
 import numpy as np
 import sys
-import boto3
 import datetime
 import platform
 
@@ -16,33 +15,12 @@ from cht_utils.prob_maps import merge_nc_map
 from cht_tiling import TiledWebMap
 from cht_hurrywave.hurrywave import HurryWave
 from cht_nesting import nest2
-
-def read_ensemble_members():
-    with open('ensemble_members.txt') as f:
-        ensemble_members = f.readlines()
-    ensemble_members = [x.strip() for x in ensemble_members]
-    return ensemble_members
-
-def get_s3_client(config):
-    # Create an S3 client
-    session = boto3.Session(
-        aws_access_key_id=config["cloud"]["access_key"],
-        aws_secret_access_key=config["cloud"]["secret_key"],
-        region_name=config["cloud"]["region"]
-    )
-    return session.client('s3')
-
-def prepare_ensemble(config):
-    # In case of ensemble, make folders for each ensemble member and copy necessary scripts to these folders
-    # Read in the list of ensemble members
-    ensemble_members = read_ensemble_members()
-    for member in ensemble_members:
-        print('Making folder for ensemble member ' + member)
-        # Make folder for ensemble member and copy all input files
-        fo.mkdir(member)            
-        fo.copy_file(os.path.join("base_input", "run_job_2.py"), member)
-        fo.copy_file(os.path.join("base_input", "config.yml"), member)
-        fo.copy_file(os.path.join("base_input", "ensemble_members.txt"), member)
+# S3 helpers (cosmos_s3.py is copied next to this script)
+from cosmos_s3 import get_s3_client, get_nr_transfer_threads, download_s3_folder, delete_s3_folder
+# Ensemble helpers (cosmos_ensemble.py is copied next to this script)
+from cosmos_ensemble import read_ensemble_members, prepare_ensemble, copy_base_input, simulate_ensemble
+# Map tile helpers (cosmos_tiles.py is copied next to this script)
+from cosmos_tiles import TileRenderer
 
 def prepare_single(config, member=None):
     # Copying, nesting, spiderweb
@@ -59,23 +37,14 @@ def prepare_single(config, member=None):
         else:
             s3_key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/"
         local_file_path = f'/input/'  # Replace with the local path where you want to save the file
-        objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3_key)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                key = object['Key']
-                # Only download files in main folder, not in subfolders
-                if key[-1] == "/":
-                    continue
-                if "/" in key.replace(s3_key, ""):
-                    continue
-                local_path = os.path.join(local_file_path, os.path.basename(key))
-                print("Copying " + key + " to " + local_path) 
-                s3_client.download_file(bucket_name, key, local_path)
+        # Only download files in main folder, not in subfolders
+        download_s3_folder(s3_client, bucket_name, s3_key, local_file_path,
+                           nr_threads=get_nr_transfer_threads(config))
     else:
         if config["ensemble"]:
             # Copy from input folder
             # We're already in the right member path
-            fo.copy_file(os.path.join("..", "base_input", "*.*"), ".")
+            copy_base_input(config)
 
     # Copy spiderweb file
     if config["ensemble"]:
@@ -164,6 +133,9 @@ def merge_ensemble(config):
 
 def map_tiles(config):
 
+    # Tiles are made in parallel while the data is being read
+    renderer = TileRenderer(config)
+
     # Make flood map tiles
     if "hm0_map" in config:
 
@@ -220,14 +192,13 @@ def map_tiles(config):
                                             config["hm0_map"]["name"],
                                             pathstr[it])                                            
 
-                    twm = TiledWebMap(png_path,
-                                      data=hm0max,
-                                      type="rgba",
-                                      parameter="hm0",
-                                      color_values=color_values,
-                                      index_path=index_path,
-                                      quiet=False)
-                    twm.make()
+                    renderer.submit(dict(png_path=png_path,
+                                         data=hm0max,
+                                         type="rgba",
+                                         parameter="hm0",
+                                         color_values=color_values,
+                                         index_path=index_path,
+                                         quiet=False))
 
                 # Full simulation        
                 hm0max = hw.read_hm0max(time_range=[t0 + dt1, t1 + dt1],
@@ -241,18 +212,20 @@ def map_tiles(config):
                                         config["hm0_map"]["name"],
                                         pathstr[-1]) 
 
-                twm = TiledWebMap(png_path,
-                                  data=hm0max,
-                                  type="rgba",
-                                  parameter="hm0",
-                                  color_values=color_values,
-                                  index_path=index_path,
-                                  quiet=False)
-                twm.make()
+                renderer.submit(dict(png_path=png_path,
+                                     data=hm0max,
+                                     type="rgba",
+                                     parameter="hm0",
+                                     color_values=color_values,
+                                     index_path=index_path,
+                                     quiet=False))
 
             except Exception as e:
                 print("An error occured while making wave map tiles: {}".format(str(e)))
 
+    # Wait until all tiles have been made
+    renderer.close()
+
 def clean_up(config):
     if config["ensemble"]:
         # Remove all ensemble members 
@@ -267,9 +240,8 @@ def clean_up(config):
             for member in ensemble_members:
                 s3key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/" + member
                 # Delete folder from S3
-                objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3key)
-                for object in objects['Contents']:
-                    s3_client.delete_object(Bucket=bucket_name, Key=object['Key'])
+                delete_s3_folder(s3_client, bucket_name, s3key,
+                                 nr_threads=get_nr_transfer_threads(config))
         else:
             for member in ensemble_members:
                 try:
@@ -279,75 +251,71 @@ def clean_up(config):
                     print(error)
                     print("Directory can not be removed : " + member)
 
-# SFINCS job script
+# HURRYWAVE job script
 
-member_name = None
-option = sys.argv[1]
+if __name__ == "__main__":
+    # Guard is needed for the process pool that makes the tiles
 
-print("Running run_job.py")
-print("Option: " + option)
+    member_name = None
+    option = sys.argv[1]
 
-# Read config file (config.yml)
-config = yaml2dict("config.yml")
+    print("Running run_job.py")
+    print("Option: " + option)
 
-# Check if member is specified
-member = None
-if len(sys.argv) == 3:
-    member = sys.argv[2]
-    print("Member: " + member)
+    # Read config file (config.yml)
+    config = yaml2dict("config.yml")
 
-if option == "prepare_ensemble":
-    # Prepare folders
-    prepare_ensemble(config)
+    # Check if member is specified
+    member = None
+    if len(sys.argv) == 3:
+        member = sys.argv[2]
+        print("Member: " + member)
 
-elif option == "simulate":
-    # Never called in cloud mode
-    # Make run string (platform dependent)
-    if platform.system() == "Windows":
-        run_string = "call run_simulation.bat"
-    else:
-        run_string = "source ./run_simulation.sh"
-    if config["ensemble"]:
-        # Read in the list of ensemble members
-        ensemble_members = read_ensemble_members()
-        # Loop through members
-        curdir = os.getcwd()
-        for member in ensemble_members:
-            print('Running ensemble member ' + member)
-            os.chdir(member)
-            # Run the Hurrywave model
-            prepare_single(config, member=member)
+    if option == "prepare_ensemble":
+        # Prepare folders
+        prepare_ensemble(config)
+
+    elif option == "simulate":
+        # Never called in cloud mode
+        # Make run string (platform dependent)
+        if platform.system() == "Windows":
+            run_string = "call run_simulation.bat"
+        else:
+            run_string = "source ./run_simulation.sh"
+        if config["ensemble"]:
+            # Read in the list of ensemble members
+            ensemble_members = read_ensemble_members()
+            # Run members simultaneously
+            simulate_ensemble(config, ensemble_members, run_string, prepare_single)
+        else:
+            prepare_single(config)
             os.system(run_string)
-            os.chdir(curdir)
-    else:
-        prepare_single(config)
-        os.system(run_string)
-
-elif option == "prepare_single":
-    # Only occurs in cloud mode (running single is done in workflow)
-    prepare_single(config, member=member)
-
-# elif option == "simulate_single":
-#     # Only called in cloud mode (should move this back to container?)
-#     # Kick off cosmos-sfincs workflow (which runs this script with prepare_single, and then runs the sfincs docker)
-#     # So effectively, it does the same as run consecutively running prepare_single and run_single
-#     subfolder = config["scenario"] + "/" + "models" + "/" + config["model"]
-#     if config["ensemble"]:
-#         subfolder += "/" + member
-#     print("Submitting member in " + subfolder)    
-#     w = Argo(config["cloud"]["host"], "sfincs-workflow")
-#     w.submit_job(bucket_name="cosmos-scenarios",
-#                  subfolder=subfolder,
-#                  member=member)
-
-elif option == "merge_ensemble":
-    # Merge his and map files from ensemble members
-    merge_ensemble(config)
-
-elif option == "map_tiles":
-    # Make map tiles
-    map_tiles(config)
-
-elif option == "clean_up":
-    # Remove all ensemble members
-    clean_up(config)
+
+    elif option == "prepare_single":
+        # Only occurs in cloud mode (running single is done in workflow)
+        prepare_single(config, member=member)
+
+    # elif option == "simulate_single":
+    #     # Only called in cloud mode (should move this back to container?)
+    #     # Kick off cosmos-sfincs workflow (which runs this script with prepare_single, and then runs the sfincs docker)
+    #     # So effectively, it does the same as run consecutively running prepare_single and run_single
+    #     subfolder = config["scenario"] + "/" + "models" + "/" + config["model"]
+    #     if config["ensemble"]:
+    #         subfolder += "/" + member
+    #     print("Submitting member in " + subfolder)    
+    #     w = Argo(config["cloud"]["host"], "sfincs-workflow")
+    #     w.submit_job(bucket_name="cosmos-scenarios",
+    #                  subfolder=subfolder,
+    #                  member=member)
+
+    elif option == "merge_ensemble":
+        # Merge his and map files from ensemble members
+        merge_ensemble(config)
+
+    elif option == "map_tiles":
+        # Make map tiles
+        map_tiles(config)
+
+    elif option == "clean_up":
+        # Remove all ensemble members
+        clean_up(config)
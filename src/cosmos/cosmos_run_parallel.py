@@ -9,18 +9,71 @@ import sched
 import os
 import socket
 import shutil
+import platform
+import subprocess
+import json
+import hashlib
+import tarfile
+import fnmatch
+import threading
+import signal
 
-import psutil
 from random import random
+
+try:
+    import psutil
+except ImportError:
+    print("psutil not available, memory of worker node is not checked")
+    psutil = None
    
 class CosmosRunParallel:
+    """Worker that runs CoSMoS jobs on a node (parallel run mode).
+
+    Jobs are .txt files (containing the job path) in the shared jobs folder. A node claims a job by
+    moving (renaming) the job file into its own folder claimed/<node> in the jobs folder. Renaming is
+    atomic, so a job can only be claimed by one node. Next to the claimed job file, the node keeps a
+    lease file with the original location of the job file. The node updates the modification time of
+    its lease files (heartbeat) as long as it is alive. When the job has finished, the claimed job
+    file and the lease are removed. If a lease has not been updated for lease_timeout seconds (e.g.
+    because the node died), any other node puts the job back in the jobs folder.
+
+    A node runs several jobs at the same time, as long as the cores and memory that they need (written
+    in the job file by Model.submit_job) fit in the free capacity of the node. A job that needs all cores
+    (nr_cores=0) only runs when nothing else is running. The node keeps track of its own job processes.
+    Works on Windows (run_job.bat) and Linux (run_job.sh).
+
+    If the job folder contains staging.json (written by Model.write_staging_manifest), only the inputs
+    that are not yet on the node are copied. Large input files are kept in a local cache (cache folder in
+    local_path), with their content hash as file name. After the job has finished, only new or changed files
+    that match the output patterns of the model are copied back (on a separate thread, so that the node
+    keeps checking its jobs during the copy). Optionally, small inputs and the outputs are transferred as compressed
+    archives. The least recently used files are removed from the cache when it is larger than cache_size.
+    Several workers on one computer may share the cache.
+
+    Parameters
+    ----------
+    lease_timeout : float
+        Seconds after the last heartbeat after which a job is re-queued. The leases are updated on a separate
+        thread (every lease_timeout / 10 seconds), so that they are kept alive while inputs are being copied.
+    max_cores : int, optional
+        Number of cores that jobs on this node may use (default is all cores)
+    max_memory : float, optional
+        Memory (GB) that jobs on this node may use (default is the total memory of the node, if psutil is available)
+    cache_size : float
+        Maximum size (GB) of the local cache with input files
+    """
     
-    def __init__(self):
-        running = 0
-        for i in psutil.process_iter():
-           if "cmd.exe" in i.name():
-               running = running + 1
-        self.running = running
+    def __init__(self, lease_timeout=600.0, max_cores=None, max_memory=None, cache_size=50.0):
+        self.max_cores = max_cores or os.cpu_count() or 1
+        if max_memory is None and psutil is not None:
+            max_memory = psutil.virtual_memory().total / 1024**3
+        self.max_memory = max_memory
+        # Jobs running on this node (key is model name)
+        self.jobs = {}
+        # Name of this node (with process id, so that several workers can run on one computer)
+        self.node = socket.gethostname() + "_" + str(os.getpid())
+        self.lease_timeout = lease_timeout
+        self.cache_size = cache_size
     
     def start(self, job_path, local_path, scenario):    
 
@@ -31,6 +84,14 @@ class CosmosRunParallel:
             self.job_path = job_path
         
         self.local_path = local_path
+        self.cache_path = os.path.join(local_path, "cache")
+        # Folder with claimed jobs of all nodes, and of this node
+        self.claimed_path = os.path.join(self.job_path, "claimed")
+        self.node_path = os.path.join(self.claimed_path, self.node)
+        # Keep leases of the jobs of this node alive, also while run is busy copying inputs
+        self.stop_heartbeat = threading.Event()
+        heartbeat_thread = threading.Thread(target=self.keep_alive, daemon=True)
+        heartbeat_thread.start()
         attempts = 0
         while self.status == "searching":
             # This will be repeated until the status of the model loop changes to "done" 
@@ -48,104 +109,469 @@ class CosmosRunParallel:
             else:
                 # First check whether we still want to continue running, or want to kill all simulations
                 if os.path.exists(os.path.join(job_path, "kill_all.txt")):
-                    os.system('taskkill /fi "WINDOWTITLE eq Running CoSMoS"')
+                    self.kill_all()
+                    time.sleep(10)
                 else:
                     attempts = 0
                     self.scheduler.enter(dt,1,self.run,())
                     self.scheduler.run()
+        self.stop_heartbeat.set()
             
     def stop(self):
         self.scheduler.cancel()
+        self.stop_heartbeat.set()
 
-    def run(self):
-        #first check whether something is running already
-        running = 0
-        for i in psutil.process_iter():
+    def claim(self, job_file):
+        """Claim a job by moving the job file into the claimed folder of this node.
+
+        Returns the name of the claimed job file, or None if another node claimed the job first.
+        """
+        os.makedirs(self.node_path, exist_ok=True)
+        claimed_file = os.path.join(self.node_path, os.path.basename(job_file))
+        lease_file = os.path.splitext(claimed_file)[0] + ".lease"
+        # Write lease first, so that a claimed job always has a lease
+        with open(lease_file, "w") as fid:
+            fid.write(job_file + "\n")
+            fid.write(self.node + "\n")
+        try:
+            os.replace(job_file, claimed_file)
+        except OSError:
+            # Job was claimed by another node
+            os.remove(lease_file)
+            return None
+        return claimed_file
+
+    def release(self, claimed_file, job_file):
+        """Put a claimed job back in the jobs folder."""
+        try:
+            os.replace(claimed_file, job_file)
+        except OSError as e:
+            print("Could not re-queue job {} : {}".format(claimed_file, str(e)))
+        lease_file = os.path.splitext(claimed_file)[0] + ".lease"
+        if os.path.exists(lease_file):
+            os.remove(lease_file)
+
+    def heartbeat(self):
+        """Update the leases of the jobs of this node (finished jobs remove their own claimed job file and lease)."""
+        if not os.path.exists(self.node_path):
+            return
+        for file_name in os.listdir(self.node_path):
+            if file_name.endswith(".lease"):
+                try:
+                    os.utime(os.path.join(self.node_path, file_name))
+                except OSError:
+                    pass
+
+    def keep_alive(self):
+        """Update the leases of this node until the worker stops (runs on a separate thread)."""
+        interval = max(self.lease_timeout / 10.0, 1.0)
+        while not self.stop_heartbeat.wait(interval):
+            self.heartbeat()
+
+    def requeue_expired(self):
+        """Put jobs of which the lease has expired back in the jobs folder."""
+        if not os.path.exists(self.claimed_path):
+            return
+        now = time.time()
+        for node in os.listdir(self.claimed_path):
+            if node == self.node:
+                continue
+            node_path = os.path.join(self.claimed_path, node)
+            if not os.path.isdir(node_path):
+                continue
+            for file_name in os.listdir(node_path):
+                if not file_name.endswith(".lease"):
+                    continue
+                lease_file = os.path.join(node_path, file_name)
+                claimed_file = os.path.splitext(lease_file)[0] + ".txt"
+                try:
+                    if now - os.path.getmtime(lease_file) < self.lease_timeout:
+                        continue
+                    with open(lease_file, "r") as fid:
+                        job_file = fid.readline().strip()
+                    if os.path.exists(claimed_file):
+                        # Only one node can move the job file back
+                        os.replace(claimed_file, job_file)
+                        print("Lease of " + file_name + " on " + node + " expired, job has been re-queued")
+                    os.remove(lease_file)
+                except OSError:
+                    # Other node was first
+                    continue
+
+    def read_ticket(self, file_name):
+        """Read job file. Returns job path, number of cores (0 is all cores) and memory (GB, 0 is unknown)."""
+        with open(file_name, "r") as fid:
+            lines = fid.read().splitlines()
+        ticket = {"nr_cores": 0, "memory": 0.0}
+        for line in lines[1:]:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                ticket[key.strip()] = float(value)
+        return lines[0].strip(), int(ticket["nr_cores"]), ticket["memory"]
+
+    def fits(self, nr_cores, memory):
+        """Check if a job fits in the free capacity of this node."""
+        if not self.jobs:
+            # Always run a job when nothing else is running
+            return True
+        if nr_cores <= 0 or nr_cores > self.max_cores:
+            # Job needs all cores
+            return False
+        cores_in_use = sum(job["nr_cores"] for job in self.jobs.values())
+        if cores_in_use + nr_cores > self.max_cores:
+            return False
+        if self.max_memory and memory > 0:
+            memory_in_use = sum(job["memory"] for job in self.jobs.values())
+            if memory_in_use + memory > self.max_memory:
+                return False
+        return True
+
+    def update_jobs(self):
+        """Remove jobs of which the process has finished.
+
+        With delta staging, the outputs are first copied back on a separate thread, so that the node keeps
+        checking its jobs during the copy. The job is removed once the copy has finished.
+        """
+        for model_name in list(self.jobs.keys()):
+            job = self.jobs[model_name]
+            if job["process"].poll() is None:
+                continue
+            if job["manifest"] is not None:
+                if job["stage_out"] is None:
+                    print("Finished " + model_name)
+                    job["stage_out"] = threading.Thread(target=self.finish_job, args=(job,))
+                    job["stage_out"].start()
+                    continue
+                if job["stage_out"].is_alive():
+                    continue
+            else:
+                print("Finished " + model_name)
+            self.jobs.pop(model_name)
+
+    def finish_job(self, job):
+        """Copy outputs of a job back, and remove its local folder, claim, lease and script (called on a separate thread)."""
+        try:
+            self.stage_out(job)
+        except Exception as e:
+            print("Could not copy results of {} : {}".format(job["model_name"], str(e)))
+        shutil.rmtree(job["local_job_path"], ignore_errors=True)
+        # Job is done, remove claim, lease and script
+        for file_name in [job["claimed_file"], os.path.splitext(job["claimed_file"])[0] + ".lease", job["script_file"]]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def kill_all(self):
+        """Terminate all jobs running on this node, and remove their local folders, claims, leases and scripts.
+
+        Every job runs in its own process group (see launch), so that the model executables that the job
+        script started are terminated as well. The killed jobs are not re-queued.
+        """
+        for model_name, job in list(self.jobs.items()):
+            process = job["process"]
+            if process.poll() is None:
+                try:
+                    if platform.system() == "Windows":
+                        # Terminate the whole process tree of the job script
+                        subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    else:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    process.wait(timeout=30)
+                except Exception as e:
+                    print("Could not terminate {} : {}".format(model_name, str(e)))
+            if job["stage_out"] is not None:
+                job["stage_out"].join()
+            shutil.rmtree(job["local_job_path"], ignore_errors=True)
+            for file_name in [job["claimed_file"], os.path.splitext(job["claimed_file"])[0] + ".lease", job["script_file"]]:
+                if os.path.exists(file_name):
+                    try:
+                        os.remove(file_name)
+                    except OSError:
+                        pass
+            print("Killed " + model_name)
+            self.jobs.pop(model_name)
+        if platform.system() == "Windows":
+            # Jobs that were started by workers of older versions
+            os.system('taskkill /fi "WINDOWTITLE eq Running CoSMoS"')
+
+    def read_manifest(self, model_path):
+        """Read staging.json in job folder (None if the job folder does not have one)."""
+        file_name = os.path.join(model_path, "staging.json")
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, "r") as fid:
+            return json.load(fid)
+
+    def stage_in(self, model_path, local_job_path, manifest):
+        """Copy job folder from the jobs folder to this node. Returns False if this failed."""
+        for attempt in range(2):
             try:
-                if "cmd.exe" in i.name():
-                    running = running + 1
+                if manifest is None:
+                    shutil.copytree(model_path, local_job_path, dirs_exist_ok = True)
+                else:
+                    self.stage_in_delta(model_path, local_job_path, manifest)
             except Exception as e:
-                print(str(e))
-            
-        if running == self.running:
+                print("Could not copy model from {} : {}".format(model_path, str(e)))
+            if os.path.exists(local_job_path) and os.listdir(local_job_path):
+                return True
+            time.sleep(5)
+        return False
+
+    def stage_in_delta(self, model_path, local_job_path, manifest):
+        """Copy inputs in staging.json to this node, using the local cache for large files."""
+        os.makedirs(local_job_path, exist_ok=True)
+        os.makedirs(self.cache_path, exist_ok=True)
+        if manifest["compress"]:
+            # Small files are in one archive
+            archive = os.path.join(model_path, "staged_inputs.tar.gz")
+            with tarfile.open(archive, "r:gz") as tar:
+                tar.extractall(local_job_path)
+        nr_cached = 0
+        for rel_path, props in manifest["files"].items():
+            dst = os.path.join(local_job_path, *rel_path.split("/"))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            src = os.path.join(model_path, *rel_path.split("/"))
+            if "sha256" in props:
+                cache_file = os.path.join(self.cache_path, props["sha256"])
+                fsrc = self.open_cached(cache_file, props["size"])
+                if fsrc is not None:
+                    nr_cached += 1
+                else:
+                    # Copy to temporary file first, so that the cache never contains partly copied files
+                    tmp_file = cache_file + "." + self.node + ".tmp"
+                    shutil.copyfile(src, tmp_file)
+                    os.replace(tmp_file, cache_file)
+                    fsrc = self.open_cached(cache_file, props["size"])
+                if fsrc is None:
+                    # Removed from the cache by another worker right away
+                    shutil.copyfile(src, dst)
+                else:
+                    # Copy (rather than link), so that the job cannot change the file in the cache
+                    with fsrc, open(dst, "wb") as fdst:
+                        shutil.copyfileobj(fsrc, fdst, 16 * 1024 * 1024)
+            elif not manifest["compress"]:
+                shutil.copy2(src, dst)
+        print("Staged " + os.path.basename(local_job_path) + " (" + str(nr_cached) + " files from local cache)")
+        self.prune_cache()
+
+    def stage_out(self, job):
+        """Copy new or changed files that match the output patterns back to the jobs folder. finished.txt is copied last."""
+        local_job_path = job["local_job_path"]
+        model_path = job["model_path"]
+        manifest = job["manifest"]
+        patterns = manifest["output_patterns"]
+        exclude = ["finished.txt", "staging.json", "staged_inputs.tar.gz", "staged_outputs.tar.gz"]
+        outputs = []
+        for root, dirs, files in os.walk(local_job_path):
+            for file_name in files:
+                full_name = os.path.join(root, file_name)
+                rel_path = os.path.relpath(full_name, local_job_path).replace("\\", "/")
+                if rel_path in exclude:
+                    continue
+                if rel_path in manifest["files"] and os.path.getmtime(full_name) <= job["staged_time"]:
+                    # Input that has not changed
+                    continue
+                if rel_path != "started.txt" and not any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(file_name, p) for p in patterns):
+                    continue
+                outputs.append(rel_path)
+        if manifest["compress"]:
+            archive = os.path.join(self.local_path, job["model_name"] + "_outputs.tar.gz")
+            with tarfile.open(archive, "w:gz") as tar:
+                for rel_path in outputs:
+                    tar.add(os.path.join(local_job_path, *rel_path.split("/")), arcname=rel_path)
+            # The archive is extracted by CoSMoS before the model is moved
+            shutil.copyfile(archive, os.path.join(model_path, "staged_outputs.tar.gz"))
+            os.remove(archive)
+        else:
+            for rel_path in outputs:
+                dst = os.path.join(model_path, *rel_path.split("/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(local_job_path, *rel_path.split("/")), dst)
+        # CoSMoS picks up the job once finished.txt exists
+        finished_file = os.path.join(local_job_path, "finished.txt")
+        if os.path.exists(finished_file):
+            with open(finished_file, "a") as fid:
+                fid.write(socket.gethostname() + "\n")
+            shutil.copyfile(finished_file, os.path.join(model_path, "finished.tmp"))
+            os.replace(os.path.join(model_path, "finished.tmp"), os.path.join(model_path, "finished.txt"))
+        print("Copied " + str(len(outputs)) + " output files of " + job["model_name"])
+
+    def open_cached(self, cache_file, size):
+        """Open a file in the cache for reading (None if it is not in the cache).
+
+        The open file can still be read when another worker removes it from the cache (see prune_cache).
+        """
+        try:
+            fid = open(cache_file, "rb")
+        except OSError:
+            return None
+        if os.fstat(fid.fileno()).st_size != size:
+            fid.close()
+            return None
+        try:
+            # Mark as recently used
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return fid
+
+    def prune_cache(self):
+        """Remove least recently used files from the cache until it is smaller than cache_size.
+
+        Other workers on this computer may use the same cache. A file is therefore first renamed (which is
+        atomic) and then removed. Workers that open the file after the rename copy it into the cache again,
+        and workers that opened it before can still read it (on Windows, an open file cannot be renamed,
+        and is kept).
+        """
+        files = []
+        for file_name in os.listdir(self.cache_path):
+            if "." in file_name:
+                # Temporary file of another worker
+                continue
+            full_name = os.path.join(self.cache_path, file_name)
             try:
-                # Get a list of all .txt files recursively
-                model_name_list = []
-                job_path_list = []
-
-                for dirpath, dirnames, filenames in os.walk(self.job_path):
-                    for filename in filenames:
-                        if filename.endswith('.txt'):
-                            model_name_list.append(filename)
-                            job_path_list.append(os.path.join(dirpath, filename))
-            except:
-                time.sleep(10)
-                return None
-            
-            for ijob, job_path in enumerate(job_path_list):
-                model_name = model_name_list[ijob].split('.')[0]
+                files.append((os.path.getmtime(full_name), os.path.getsize(full_name), full_name))
+            except OSError:
+                # Removed by another worker
+                continue
+        total_size = sum(f[1] for f in files)
+        for mtime, size, full_name in sorted(files):
+            if total_size <= self.cache_size * 1024**3:
+                break
+            removed_file = full_name + "." + self.node + ".removed"
+            try:
+                os.replace(full_name, removed_file)
+            except OSError:
+                # File is being copied by another job, or was removed by another worker
+                continue
+            total_size -= size
+            try:
+                os.remove(removed_file)
+            except OSError:
+                pass
 
-                if os.path.exists(job_path):
-                    try:
-                        fid = open(job_path, "r")
-                        model_path = fid.read()
-                        fid.close()
-                        os.remove(job_path)
-                    except:
-                        # model is already been copied to another instance
-                        continue
-                    
-                    # Copy remote folder to local copy
-                    try:
-                        shutil.copytree(os.path.join(model_path), os.path.join(self.local_path, model_name), dirs_exist_ok = True)
-                    except Exception as e: 
-                        os.mkdir(os.path.join(self.local_path, model_name))
-                        print("Could not find model on p-drive,  {}".format(str(e)))
-                     
-                    # Check if folder exists
-                    if not os.path.exists(os.path.join(self.local_path, model_name)):
-                        time.sleep(5)
-                        try:
-                            shutil.copytree(os.path.join(model_path), os.path.join(self.local_path, model_name), dirs_exist_ok = True)
-                        except Exception as e:
-                            print("Retry to copy files failed, sending .txt file to jobs folder op p-drive and removing on locally.")
-                            file_name = os.path.join(job_path)
-                            fid = open(file_name, "w")
-                            fid.write(model_path)
-                            fid.close()
-                            return
-                        
-                    # Check if folder is empty
-                    files_local = os.listdir(os.path.join(self.local_path, model_name))
-                    if len(files_local) == 0:
-                        time.sleep(5)
-                        try:
-                            shutil.copytree(os.path.join(model_path), os.path.join(self.local_path, model_name), dirs_exist_ok = True)
-                        except Exception as e:
-                            print("Retry to copy files failed, sending .txt file to jobs folder op p-drive and removing locally.")
-                            file_name = os.path.join(job_path)
-                            fid = open(file_name, "w")
-                            fid.write(model_path)
-                            fid.close()
-                            return
-  
-                    fid = open("tmp.bat", "w")
-                    fid.write(self.local_path[0:2] + "\n")
-                    fid.write("cd " + os.path.join(self.local_path, model_name) + "\n")
-                    fid.write("call run_job.bat\n")
-                    fid.write("move finished.txt finished_local.txt" + " \n")
-                    fid.write("echo " + socket.gethostname() + ">> finished_local.txt"  + " \n" )
-                    fid.write("xcopy " + os.path.join(self.local_path, model_name) + " " + os.path.join(model_path) + " /E /Q /Y" + "\n")
-                    fid.write(model_path[0:2] + "\n")
-                    fid.write("cd " + os.path.join(model_path) + "\n")
-                    fid.write("move finished_local.txt finished.txt" + " \n")
-                    fid.write("rmdir " + os.path.join(self.local_path, model_name) + " /s /q" + "\n")
-                    fid.write("exit\n")
-                    fid.close()
-                        
-                    os.system('start tmp.bat')
-                    print("Running " + model_name)
-                    break
+    def write_script(self, model_name, model_path, local_job_path, claimed_file, delta=False):
+        """Write script that runs the job, copies the results back and removes the claim of the job.
 
+        With delta staging, the script only runs the job (results are copied back by update_jobs).
+        """
+        lease_file = os.path.splitext(claimed_file)[0] + ".lease"
+        if platform.system() == "Windows":
+            file_name = os.path.join(self.local_path, model_name + ".bat")
+            fid = open(file_name, "w")
+            fid.write(local_job_path[0:2] + "\n")
+            fid.write("cd " + local_job_path + "\n")
+            fid.write("call run_job.bat\n")
+            if delta:
+                fid.write("exit\n")
+                fid.close()
+                return file_name
+            fid.write("move finished.txt finished_local.txt" + " \n")
+            fid.write("echo " + socket.gethostname() + ">> finished_local.txt"  + " \n" )
+            fid.write("xcopy " + local_job_path + " " + model_path + " /E /Q /Y" + "\n")
+            fid.write(model_path[0:2] + "\n")
+            fid.write("cd " + model_path + "\n")
+            fid.write("move finished_local.txt finished.txt" + " \n")
+            fid.write("rmdir " + local_job_path + " /s /q" + "\n")
+            # Job is done, remove claim and lease
+            fid.write("del /q " + claimed_file + " " + lease_file + "\n")
+            fid.write("exit\n")
+            fid.close()
+        else:
+            file_name = os.path.join(self.local_path, model_name + ".sh")
+            fid = open(file_name, "w")
+            fid.write("cd " + local_job_path + "\n")
+            fid.write("bash run_job.sh\n")
+            if delta:
+                fid.close()
+                return file_name
+            fid.write("mv finished.txt finished_local.txt\n")
+            fid.write("echo " + socket.gethostname() + " >> finished_local.txt\n")
+            fid.write("cp -r " + local_job_path + "/. " + model_path + "\n")
+            fid.write("cd " + model_path + "\n")
+            fid.write("mv finished_local.txt finished.txt\n")
+            fid.write("rm -rf " + local_job_path + "\n")
+            # Job is done, remove claim and lease
+            fid.write("rm -f " + claimed_file + " " + lease_file + "\n")
+            fid.close()
+        return file_name
+
+    def launch(self, script_file):
+        """Start job script (without waiting for it to finish) in a new process group, so that kill_all can terminate the job with everything it started."""
+        if platform.system() == "Windows":
+            return subprocess.Popen(["cmd", "/c", script_file],
+                                    creationflags=subprocess.CREATE_NEW_CONSOLE | subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            return subprocess.Popen(["bash", script_file], start_new_session=True)
+
+    def run(self):
+        # Re-queue jobs of nodes that stopped (leases of this node are kept alive by keep_alive)
+        self.requeue_expired()
+
+        # Check which jobs on this node have finished
+        self.update_jobs()
+
+        try:
+            # Get a list of all .txt files recursively
+            model_name_list = []
+            job_path_list = []
+
+            for dirpath, dirnames, filenames in os.walk(self.job_path):
+                # Skip claimed jobs
+                if "claimed" in dirnames:
+                    dirnames.remove("claimed")
+                for filename in filenames:
+                    if filename.endswith('.txt') and filename != "kill_all.txt":
+                        model_name_list.append(filename)
+                        job_path_list.append(os.path.join(dirpath, filename))
+        except:
+            time.sleep(10)
+            return None
 
+        # Start jobs as long as they fit in the free capacity of this node
+        for ijob, job_path in enumerate(job_path_list):
+            model_name = model_name_list[ijob].split('.')[0]
+
+            if model_name in self.jobs or not os.path.exists(job_path):
+                continue
+
+            try:
+                # Check if job fits before claiming it
+                model_path, nr_cores, memory = self.read_ticket(job_path)
+            except Exception:
+                # Job was claimed by another node, or the file is not a job ticket
+                continue
+            if not self.fits(nr_cores, memory):
+                continue
+
+            claimed_file = self.claim(job_path)
+            if claimed_file is None:
+                # model is already been claimed by another instance
+                continue
+
+            # Copy remote folder to local copy
+            local_job_path = os.path.join(self.local_path, model_name)
+            try:
+                manifest = self.read_manifest(model_path)
+            except Exception as e:
+                print("Could not read staging.json of {} : {}".format(model_name, str(e)))
+                manifest = None
+            if not self.stage_in(model_path, local_job_path, manifest):
+                print("Retry to copy files failed, sending .txt file to jobs folder and removing locally.")
+                shutil.rmtree(local_job_path, ignore_errors=True)
+                self.release(claimed_file, job_path)
+                continue
 
+            script_file = self.write_script(model_name, model_path, local_job_path, claimed_file, delta=manifest is not None)
+            self.jobs[model_name] = {"process": self.launch(script_file),
+                                     "nr_cores": nr_cores if nr_cores > 0 else self.max_cores,
+                                     "memory": memory,
+                                     "model_name": model_name,
+                                     "model_path": model_path,
+                                     "local_job_path": local_job_path,
+                                     "claimed_file": claimed_file,
+                                     "manifest": manifest,
+                                     "script_file": script_file,
+                                     "staged_time": time.time(),
+                                     "stage_out": None}
+            print("Running " + model_name + " (" + str(len(self.jobs)) + " jobs running on " + self.node + ")")
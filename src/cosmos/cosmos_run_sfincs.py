@@ -1,13 +1,13 @@
 # Run SFINCS model ensemble (including some pre and post processing)
 
 import os
-import boto3
 import datetime
 import pandas as pd  
 import numpy as np
 import xarray as xr
 import sys
 import platform
+import warnings
 
 import cht_utils.fileops as fo
 from cht_utils.misc_tools import yaml2dict
@@ -16,35 +16,14 @@ from cht_utils.prob_maps import merge_nc_map
 from cht_tiling import TiledWebMap
 from cht_sfincs import SFINCS
 from cht_nesting import nest2
+# S3 helpers (cosmos_s3.py is copied next to this script)
+from cosmos_s3 import get_s3_client, get_nr_transfer_threads, download_s3_folder, delete_s3_folder
+# Ensemble helpers (cosmos_ensemble.py is copied next to this script)
+from cosmos_ensemble import read_ensemble_members, prepare_ensemble, copy_base_input, simulate_ensemble
+# Map tile helpers (cosmos_tiles.py is copied next to this script)
+from cosmos_tiles import TileRenderer
 #from cht_utils.argo import Argo
 
-def read_ensemble_members():
-    with open('ensemble_members.txt') as f:
-        ensemble_members = f.readlines()
-    ensemble_members = [x.strip() for x in ensemble_members]
-    return ensemble_members
-
-def get_s3_client(config):
-    # Create an S3 client
-    session = boto3.Session(
-        aws_access_key_id=config["cloud"]["access_key"],
-        aws_secret_access_key=config["cloud"]["secret_key"],
-        region_name=config["cloud"]["region"]
-    )
-    return session.client('s3')
-
-def prepare_ensemble(config):
-    # In case of ensemble, make folders for each ensemble member and copy necessary scripts to these folders
-    # Read in the list of ensemble members
-    ensemble_members = read_ensemble_members()
-    for member in ensemble_members:
-        print('Making folder for ensemble member ' + member)
-        # Make folder for ensemble member and copy all input files
-        fo.mkdir(member)            
-        fo.copy_file(os.path.join("base_input", "run_job_2.py"), member)
-        fo.copy_file(os.path.join("base_input", "config.yml"), member)
-        fo.copy_file(os.path.join("base_input", "ensemble_members.txt"), member)
-
 def prepare_single(config, member=None):
     # Copying, nesting, spiderweb
     # We're already in the correct folder
@@ -60,23 +39,14 @@ def prepare_single(config, member=None):
         else:
             s3_key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/"
         local_path = f'/input/'  # Replace with the local path where you want to save the file
-        objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3_key)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                key = object['Key']
-                # Only download files in main folder, not in subfolders
-                if key[-1] == "/":
-                    continue
-                if "/" in key.replace(s3_key, ""):
-                    continue
-                local_file_path = os.path.join(local_path, os.path.basename(key))
-                print("Copying " + key + " to " + local_path) 
-                s3_client.download_file(bucket_name, key, local_file_path)
+        # Only download files in main folder, not in subfolders
+        download_s3_folder(s3_client, bucket_name, s3_key, local_path,
+                           nr_threads=get_nr_transfer_threads(config))
     else:
         if config["ensemble"]:
             # Copy from input folder
             # We're already in the right member path
-            fo.copy_file(os.path.join("..", "base_input", "*.*"), ".")
+            copy_base_input(config)
 
     # Copy spiderweb file
     if config["ensemble"]:
@@ -258,8 +228,81 @@ def merge_ensemble(config):
     # Copy restart files from the first ensemble member (restart files are the same for all members)
     fo.copy_file(os.path.join(folder_path, ensemble_members[0], 'sfincs.*.rst'), folder_path)    
 
+def read_interval_maxima(file_name, varname, time_ranges, max_chunk_size=2.5e8,
+                         subtract_file_name=None, subtract_varname="zs"):
+    # Read maximum of variable (e.g. zsmax or zs) over several time ranges, reading the file only once.
+    # Time ranges are inclusive (same time selection as sf.output.read_zsmax). The file is read in
+    # chunks of time steps of at most max_chunk_size bytes, so memory does not scale with the number of
+    # time steps. Yields the index of each time range and its maximum (None if there is no output in a range) as
+    # soon as the range has been read, so that only the maxima of the ranges in the current chunk are kept in memory.
+    # If subtract_file_name is given (e.g. tide-only simulation), subtract_varname in that file is subtracted
+    # from varname at the same times before taking the maximum (time steps that are not in both files are skipped).
+    ds = xr.open_dataset(file_name)
+    da = ds[varname]
+    times = pd.to_datetime(ds[da.dims[0]].values)
+    if subtract_file_name:
+        ds_sub = xr.open_dataset(subtract_file_name)
+        da_sub = ds_sub[subtract_varname]
+        times_sub = pd.DatetimeIndex(pd.to_datetime(ds_sub[da_sub.dims[0]].values))
+    # Indices of first and last+1 time step in each range
+    ranges = []
+    for time_range in time_ranges:
+        ind = np.where((times >= time_range[0]) & (times <= time_range[1]))[0]
+        if len(ind) > 0:
+            ranges.append([ind[0], ind[-1] + 1])
+        else:
+            ranges.append(None)
+    maxima = {}
+    for ir, r in enumerate(ranges):
+        if r is None:
+            yield ir, None
+    if not any(ranges):
+        ds.close()
+        if subtract_file_name:
+            ds_sub.close()
+        return
+    it0 = min([r[0] for r in ranges if r])
+    it1 = max([r[1] for r in ranges if r])
+    # Number of time steps per chunk
+    nbytes = da.dtype.itemsize * int(np.prod(da.shape[1:]))
+    chunk_size = max(int(max_chunk_size // max(nbytes, 1)), 1)
+    for i0 in range(it0, it1, chunk_size):
+        i1 = min(i0 + chunk_size, it1)
+        chunk = da[i0:i1].values
+        if subtract_file_name:
+            # Matching time steps in the other file
+            isub = times_sub.get_indexer(times[i0:i1])
+            chunk = chunk.astype(float)
+            chunk[isub < 0] = np.nan
+            if np.any(isub >= 0):
+                chunk[isub >= 0] -= da_sub.isel({da_sub.dims[0]: isub[isub >= 0]}).values
+        for ir, r in enumerate(ranges):
+            if r is None:
+                continue
+            j0 = max(r[0], i0)
+            j1 = min(r[1], i1)
+            if j0 >= j1:
+                continue
+            with warnings.catch_warnings():
+                # All-NaN slices (dry cells) are expected
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                zmax = np.nanmax(chunk[j0 - i0:j1 - i0], axis=0)
+            if ir not in maxima:
+                maxima[ir] = zmax
+            else:
+                maxima[ir] = np.fmax(maxima[ir], zmax)
+            if r[1] <= i1:
+                # Range is complete
+                yield ir, maxima.pop(ir)
+    ds.close()
+    if subtract_file_name:
+        ds_sub.close()
+
 def map_tiles(config):
 
+    # Tiles are made in parallel while the data is being read
+    renderer = TileRenderer(config)
+
     # Make flood map tiles
     if "flood_map" in config:
 
@@ -305,55 +348,33 @@ def map_tiles(config):
                 varname = "zsmax"    
 
             try:
-                # Inundation map over dt-hour increments                    
-                for it, t in enumerate(requested_times):
+                # Maximum over dt-hour increments and over full simulation (reading the map file only once)
+                time_ranges = [[t - dt + dt1, t + dt1] for t in requested_times]
+                time_ranges.append([t0 + dt1, t1 + dt1])
+                # Inundation map over dt-hour increments, and full simulation
+                for it, zsmax in read_interval_maxima(zsmax_file, varname, time_ranges):
+
+                    if zsmax is None:
+                        print("No output found for " + pathstr[it])
+                        continue
 
-                    zsmax = sf.output.read_zsmax(zsmax_file=zsmax_file,
-                                                 time_range=[t - dt + dt1, t + dt1],
-                                                 varname=varname)
                     # Difference between MSL and NAVD88 (used in topo data)
                     zsmax += config["vertical_reference_level_difference_with_msl"]
 
-                    # zsmax = np.transpose(zsmax)
-
                     png_path = os.path.join(flood_map_path,
                                             config["scenario"],
                                             config["cycle"],
                                             config["flood_map"]["name"],
                                             pathstr[it])                                            
 
-                    twm = TiledWebMap(png_path,
-                                      data=zsmax,
-                                      type="rgba",
-                                      parameter="flood_map",
-                                      zbmax=0.5,
-                                      color_values=color_values,
-                                      index_path=index_path,
-                                      topo_path=topo_path)
-                    twm.make()
-
-                # Full simulation        
-                zsmax = sf.output.read_zsmax(zsmax_file=zsmax_file,
-                                             time_range=[t0 + dt1, t1 + dt1],
-                                             varname=varname)
-                zsmax += config["vertical_reference_level_difference_with_msl"]
-                # zsmax = np.transpose(zsmax)
-
-                png_path = os.path.join(flood_map_path,
-                                        config["scenario"],
-                                        config["cycle"],
-                                        config["flood_map"]["name"],
-                                        pathstr[-1]) 
-
-                twm = TiledWebMap(png_path,
-                                    data=zsmax,
-                                    type="rgba",
-                                    parameter="flood_map",
-                                    zbmax=0.5,
-                                    color_values=color_values,
-                                    index_path=index_path,
-                                    topo_path=topo_path)
-                twm.make()
+                    renderer.submit(dict(png_path=png_path,
+                                         data=zsmax,
+                                         type="rgba",
+                                         parameter="flood_map",
+                                         zbmax=0.5,
+                                         color_values=color_values,
+                                         index_path=index_path,
+                                         topo_path=topo_path))
 
             except Exception as e:
                 print("An error occured while making flood map tiles: " + str(e))
@@ -417,14 +438,17 @@ def map_tiles(config):
             try:
                 color_values = config["water_level_map"]["color_map"]["contours"]
 
-                # Water level map over dt-hour increments                    
-                for it, t in enumerate(requested_times):
+                # Maximum over dt-hour increments and over full simulation (reading the map file only once)
+                time_ranges = [[t - dt + dt1, t + dt1] for t in requested_times]
+                time_ranges.append([t0 + dt1, t1 + dt1])
+                # Water level map over dt-hour increments, and full simulation
+                for it, zsmax in read_interval_maxima(zsmax_file, varname, time_ranges):
+
+                    if zsmax is None:
+                        print("No output found for " + pathstr[it])
+                        continue
 
-                    zsmax = sf.output.read_zsmax(zsmax_file=zsmax_file,
-                                          time_range=[t - dt + dt1, t + dt1],
-                                          varname=varname)
                     zsmax += water_level_correction
-                    # zsmax = np.transpose(zsmax)
 
                     png_path = os.path.join(water_level_map_path,
                                             config["scenario"],
@@ -432,39 +456,14 @@ def map_tiles(config):
                                             config["water_level_map"]["name"],
                                             pathstr[it]) 
                     
-                    twm = TiledWebMap(png_path,
-                                      data=zsmax,
-                                      type="rgba",
-                                      parameter="water_level",
-                                      zbmax=zbmax,
-                                      color_values=color_values,
-                                      index_path=index_path,
-                                      topo_path=topo_path)
-                    twm.make()
-
-                # Full simulation        
-                zsmax = sf.output.read_zsmax(zsmax_file=zsmax_file,
-                                             time_range=[t0 + dt1, t1 + dt1],
-                                             varname=varname)
-
-                zsmax += water_level_correction
-                # zsmax = np.transpose(zsmax)
-
-                png_path = os.path.join(water_level_map_path,
-                                        config["scenario"],
-                                        config["cycle"],
-                                        config["water_level_map"]["name"],
-                                        pathstr[-1]) 
-
-                twm = TiledWebMap(png_path,
-                                    data=zsmax,
-                                    type="rgba",
-                                    parameter="water_level",
-                                    zbmax=zbmax,
-                                    color_values=color_values,
-                                    index_path=index_path,
-                                    topo_path=topo_path)
-                twm.make()
+                    renderer.submit(dict(png_path=png_path,
+                                         data=zsmax,
+                                         type="rgba",
+                                         parameter="water_level",
+                                         zbmax=zbmax,
+                                         color_values=color_values,
+                                         index_path=index_path,
+                                         topo_path=topo_path))
                             
             except Exception as e:
                 print("An error occured while making flood map tiles: {}".format(str(e)))
@@ -532,22 +531,20 @@ def map_tiles(config):
 
                 color_values = config["storm_surge_map"]["color_map"]["contours"]
 
-                # Water level map over dt-hour increments                    
-                for it, t in enumerate(requested_times):
+                # Maximum surge (water level minus tide-only water level) over dt-hour increments and
+                # over full simulation (both map files are opened only once and read in chunks)
+                time_ranges = [[t - dt, t] for t in requested_times]
+                time_ranges.append([t0, t1])
+                storm_surge_list = read_interval_maxima(zsmax_file, varname, time_ranges,
+                                                        subtract_file_name=zsmax_file_tide_only,
+                                                        subtract_varname="zs")
 
-                    # Rather than using sf.output.read_zsmax, we read the file here with xarray
-                    ds = xr.open_dataset(zsmax_file)
-                    ds_tide_only = xr.open_dataset(zsmax_file_tide_only)
-                    # Now from read the data array "zs" within the time range
-                    zsmax = ds[varname].sel(time=slice(t - dt, t))
-                    # Same for tide only
-                    zsmax_tide_only = ds_tide_only["zs"].sel(time=slice(t - dt, t))                    
-                    ds.close()
-                    ds_tide_only.close()
+                # Storm surge map over dt-hour increments, and full simulation
+                for it, storm_surge in storm_surge_list:
 
-                    storm_surge = zsmax - zsmax_tide_only
-                    # And now take max over time
-                    storm_surge = storm_surge.max(dim="time").values
+                    if storm_surge is None:
+                        print("No output found for " + pathstr[it])
+                        continue
 
                     png_path = os.path.join(storm_surge_map_path,
                                             config["scenario"],
@@ -555,47 +552,14 @@ def map_tiles(config):
                                             config["storm_surge_map"]["name"],
                                             pathstr[it]) 
                     
-                    twm = TiledWebMap(png_path,
-                                      data=storm_surge,
-                                      type="rgba",
-                                      parameter="storm_surge",
-                                      zbmax=zbmax,
-                                      color_values=color_values,
-                                      index_path=index_path,
-                                      topo_path=topo_path)
-                    twm.make()
-
-                # Full simulation        
-
-                # Rather than using sf.output.read_zsmax, we read the file here with xarray
-                ds = xr.open_dataset(zsmax_file)
-                ds_tide_only = xr.open_dataset(zsmax_file_tide_only)
-                # Now from read the data array "zs" within the time range
-                zsmax = ds[varname].sel(time=slice(t0, t1))
-                # Same for tide only
-                zsmax_tide_only = ds_tide_only["zs"].sel(time=slice(t0, t1))                    
-                ds.close()
-                ds_tide_only.close()
-
-                storm_surge = zsmax - zsmax_tide_only
-                # And now take max over time
-                storm_surge = storm_surge.max(dim="time").values
-
-                png_path = os.path.join(storm_surge_map_path,
-                                        config["scenario"],
-                                        config["cycle"],
-                                        config["storm_surge_map"]["name"],
-                                        pathstr[-1]) 
-
-                twm = TiledWebMap(png_path,
-                                    data=storm_surge,
-                                    type="rgba",
-                                    parameter="storm_surge",
-                                    zbmax=zbmax,
-                                    color_values=color_values,
-                                    index_path=index_path,
-                                    topo_path=topo_path)
-                twm.make()
+                    renderer.submit(dict(png_path=png_path,
+                                         data=storm_surge,
+                                         type="rgba",
+                                         parameter="storm_surge",
+                                         zbmax=zbmax,
+                                         color_values=color_values,
+                                         index_path=index_path,
+                                         topo_path=topo_path))
                             
             except Exception as e:
                 print("An error occured while making flood map tiles: {}".format(str(e)))
@@ -653,17 +617,19 @@ def map_tiles(config):
                 # only show values above 1.0 mm
                 cumprcp[np.where(cumprcp<1.0)] = np.nan
 
-                twm = TiledWebMap(png_path,
-                                    data=cumprcp,
-                                    type="rgba",
-                                    parameter="precipitation",
-                                    color_values=color_values,
-                                    index_path=index_path)
-                twm.make()
+                renderer.submit(dict(png_path=png_path,
+                                     data=cumprcp,
+                                     type="rgba",
+                                     parameter="precipitation",
+                                     color_values=color_values,
+                                     index_path=index_path))
                             
             except Exception as e:
                 print("An error occured while making precipitation map tiles: {}".format(str(e)))
 
+    # Wait until all tiles have been made
+    renderer.close()
+
 def clean_up(config):
     if config["ensemble"]:
         # Remove all ensemble members 
@@ -681,13 +647,9 @@ def clean_up(config):
                 # List of files to keep
                 keep_files = ["sfincs_his.nc", "sfincs_map.nc"]
 
-                # List all objects in the S3 folder
-                objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3key)
-
                 # Delete all files except those in keep_files list
-                for object in objects['Contents']:
-                    if object['Key'].split('/')[-1] not in keep_files:
-                        s3_client.delete_object(Bucket=bucket_name, Key=object['Key'])
+                delete_s3_folder(s3_client, bucket_name, s3key, keep_files=keep_files,
+                                 nr_threads=get_nr_transfer_threads(config))
 
         else:
             for member in ensemble_members:
@@ -700,75 +662,71 @@ def clean_up(config):
 
 # SFINCS job script
 
-member_name = None
-option = sys.argv[1]
-#option = "merge_ensemble"
-#option = "map_tiles"
+if __name__ == "__main__":
+    # Guard is needed for the process pool that makes the tiles
 
-print("Running run_job.py")
-print("Option: " + option)
+    member_name = None
+    option = sys.argv[1]
+    #option = "merge_ensemble"
+    #option = "map_tiles"
 
-# Read config file (config.yml)
-config = yaml2dict("config.yml")
+    print("Running run_job.py")
+    print("Option: " + option)
 
-# Check if member is specified
-member = None
-if len(sys.argv) == 3:
-    member = sys.argv[2]
-    print("Member: " + member)
+    # Read config file (config.yml)
+    config = yaml2dict("config.yml")
 
-if option == "prepare_ensemble":
-    # Prepare folders
-    prepare_ensemble(config)
+    # Check if member is specified
+    member = None
+    if len(sys.argv) == 3:
+        member = sys.argv[2]
+        print("Member: " + member)
 
-elif option == "simulate":
-    # Never called in cloud mode where this is done in a workflow
-    # Make the run string (platform dependent)
-    if platform.system() == "Windows":
-        run_string = "call run_simulation.bat"
-    else:
-        run_string = "source ./run_simulation.sh"
-    if config["ensemble"]:
-        # Read in the list of ensemble members
-        ensemble_members = read_ensemble_members()
-        # Loop through members
-        curdir = os.getcwd()
-        for member in ensemble_members:
-            print('Running ensemble member ' + member)
-            os.chdir(member)
-            # Run the SFINCS model
-            prepare_single(config, member=member)
+    if option == "prepare_ensemble":
+        # Prepare folders
+        prepare_ensemble(config)
+
+    elif option == "simulate":
+        # Never called in cloud mode where this is done in a workflow
+        # Make the run string (platform dependent)
+        if platform.system() == "Windows":
+            run_string = "call run_simulation.bat"
+        else:
+            run_string = "source ./run_simulation.sh"
+        if config["ensemble"]:
+            # Read in the list of ensemble members
+            ensemble_members = read_ensemble_members()
+            # Run members simultaneously
+            simulate_ensemble(config, ensemble_members, run_string, prepare_single)
+        else:
+            prepare_single(config)
             os.system(run_string)
-            os.chdir(curdir)
-    else:
-        prepare_single(config)
-        os.system(run_string)
-
-elif option == "prepare_single":
-    # Only occurs in cloud mode (running single is done in workflow)
-    prepare_single(config, member=member)
-
-# elif option == "simulate_single":
-#     # Only called in cloud mode (should move this back to container?)
-#     # Kick off cosmos-sfincs workflow (which runs this script with prepare_single, and then runs the sfincs docker)
-#     # So effectively, it does the same as run consecutively running prepare_single and run_single
-#     subfolder = config["scenario"] + "/" + "models" + "/" + config["model"]
-#     if config["ensemble"]:
-#         subfolder += "/" + member
-#     print("Submitting member in " + subfolder)    
-#     w = Argo(config["cloud"]["host"], "sfincs-workflow")
-#     w.submit_job(bucket_name="cosmos-scenarios",
-#                  subfolder=subfolder,
-#                  member=member)
-
-elif option == "merge_ensemble":
-    # Merge his and map files from ensemble members
-    merge_ensemble(config)
-
-elif option == "map_tiles":
-    # Make flood map tiles
-    map_tiles(config)
 
-elif option == "clean_up":
-    # Remove all ensemble members
-    clean_up(config)
+    elif option == "prepare_single":
+        # Only occurs in cloud mode (running single is done in workflow)
+        prepare_single(config, member=member)
+
+    # elif option == "simulate_single":
+    #     # Only called in cloud mode (should move this back to container?)
+    #     # Kick off cosmos-sfincs workflow (which runs this script with prepare_single, and then runs the sfincs docker)
+    #     # So effectively, it does the same as run consecutively running prepare_single and run_single
+    #     subfolder = config["scenario"] + "/" + "models" + "/" + config["model"]
+    #     if config["ensemble"]:
+    #         subfolder += "/" + member
+    #     print("Submitting member in " + subfolder)    
+    #     w = Argo(config["cloud"]["host"], "sfincs-workflow")
+    #     w.submit_job(bucket_name="cosmos-scenarios",
+    #                  subfolder=subfolder,
+    #                  member=member)
+
+    elif option == "merge_ensemble":
+        # Merge his and map files from ensemble members
+        merge_ensemble(config)
+
+    elif option == "map_tiles":
+        # Make flood map tiles
+        map_tiles(config)
+
+    elif option == "clean_up":
+        # Remove all ensemble members
+        clean_up(config)
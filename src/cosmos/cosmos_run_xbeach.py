@@ -3,7 +3,6 @@
 import os
 import xarray as xr
 import sys
-import boto3
 import datetime
 import numpy as np
 import platform
@@ -14,15 +13,10 @@ from cht_utils.misc_tools import yaml2dict
 from cht_nestingp import nest2
 from cht_tiling import TiledWebMap
 from cht_xbeach.xbeach import XBeach
-
-def get_s3_client(config):
-    # Create an S3 client
-    session = boto3.Session(
-        aws_access_key_id=config["cloud"]["access_key"],
-        aws_secret_access_key=config["cloud"]["secret_key"],
-        region_name=config["cloud"]["region"]
-    )
-    return session.client('s3')
+# S3 helpers (cosmos_s3.py is copied next to this script)
+from cosmos_s3 import get_s3_client, get_nr_transfer_threads, download_s3_folder
+# Map tile helpers (cosmos_tiles.py is copied next to this script)
+from cosmos_tiles import finish_tiles, get_tile_options, tile_folder_lock
 
 def prepare_single(config):
     # Copying, nesting
@@ -35,18 +29,9 @@ def prepare_single(config):
         # Copy base input folder
         s3_key = config["scenario"] + "/" + "models" + "/" + config["model"] + "/"
         local_file_path = f'/input/'  # Replace with the local path where you want to save the file
-        objects = s3_client.list_objects(Bucket=bucket_name, Prefix=s3_key)
-        if "Contents" in objects:
-            for object in objects['Contents']:
-                key = object['Key']
-                # Only download files in main folder, not in subfolders
-                if key[-1] == "/":
-                    continue
-                if "/" in key.replace(s3_key, ""):
-                    continue
-                local_path = os.path.join(local_file_path, os.path.basename(key))
-                print("Copying " + key + " to " + local_path) 
-                s3_client.download_file(bucket_name, key, local_path)
+        # Only download files in main folder, not in subfolders
+        download_s3_folder(s3_client, bucket_name, s3_key, local_file_path,
+                           nr_threads=get_nr_transfer_threads(config))
 
     # Read XBeach model (necessary for nesting)
     xb = XBeach(input_file = "params.txt", get_boundary_coordinates=False)
@@ -186,27 +171,31 @@ def make_sedero_tiles(config, sedero, index_path, sedero_map_path):
 
     color_values = config["sedero_map"]["color_map"]["contours"]
 
-    twm = TiledWebMap(sedero_map_path,
-                      data=sedero,
-                      type="rgba",
-                      parameter="sedero",
-                      color_values=color_values,
-                      index_path=index_path,
-                      quiet=True)
-    twm.make()
+    with tile_folder_lock(sedero_map_path, shared=config.get("run_mode") != "cloud"):
+        twm = TiledWebMap(sedero_map_path,
+                          data=sedero,
+                          type="rgba",
+                          parameter="sedero",
+                          color_values=color_values,
+                          index_path=index_path,
+                          quiet=True)
+        twm.make()
+        finish_tiles(sedero_map_path, *get_tile_options(config))
         
 def make_bedlevel_tiles(config, bedlevel, index_path, bedlevel_map_path):
 
     color_values = config["sedero_map"]["color_map_zb"]["contours"]
     
-    twm = TiledWebMap(bedlevel_map_path,
-                      data=bedlevel,
-                      type="rgba",
-                      parameter="bed_level",
-                      color_values=color_values,
-                      index_path=index_path,
-                      quiet=True)
-    twm.make()
+    with tile_folder_lock(bedlevel_map_path, shared=config.get("run_mode") != "cloud"):
+        twm = TiledWebMap(bedlevel_map_path,
+                          data=bedlevel,
+                          type="rgba",
+                          parameter="bed_level",
+                          color_values=color_values,
+                          index_path=index_path,
+                          quiet=True)
+        twm.make()
+        finish_tiles(bedlevel_map_path, *get_tile_options(config))
 
 # XBEACH job script
 
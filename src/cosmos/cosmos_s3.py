@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+S3 helpers for the job scripts (run_job_2.py and merge_tiles.py).
+
+This module does not use the cosmos package, as the job containers in the cloud do not have it. It is
+copied (as cosmos_s3.py) into every job folder, next to the job script.
+"""
+
+import os
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+# Files larger than this are transferred in parts (multipart)
+multipart_threshold = 64 * 1024 * 1024
+# Number of parts of a large file that are transferred at the same time
+max_concurrency = 8
+
+# S3 client that is shared by all transfers in this job
+shared_s3_client = None
+
+def get_nr_transfer_threads(config):
+    # Number of files that are transferred at the same time (nr_transfer_threads in the cloud configuration)
+    return config.get("cloud", {}).get("nr_transfer_threads", 8) or 8
+
+def get_s3_client(config):
+    # Create an S3 client (only once: the client is thread safe and keeps a pool of connections that is
+    # reused by all uploads, downloads and deletes in this job). Every transfer thread may transfer
+    # max_concurrency parts of a large file at the same time, so the pool has a connection for each of these.
+    global shared_s3_client
+    if shared_s3_client is None:
+        import boto3
+        from botocore.config import Config
+        session = boto3.Session(
+            aws_access_key_id=config["cloud"]["access_key"],
+            aws_secret_access_key=config["cloud"]["secret_key"],
+            region_name=config["cloud"]["region"]
+        )
+        max_pool_connections = get_nr_transfer_threads(config) * max_concurrency
+        shared_s3_client = session.client('s3',
+                                          config=Config(max_pool_connections=max_pool_connections,
+                                                        retries={"max_attempts": 5, "mode": "standard"}))
+    return shared_s3_client
+
+def download_s3_folder(s3_client, bucket_name, s3_folder, local_folder, include=None, exclude=None,
+                       subfolders=False, nr_threads=8, quiet=False):
+    # Download files in an S3 folder to a local folder. Objects are listed with pagination and downloaded
+    # concurrently. Only files with names that match one of the include patterns (e.g. "*.nc") and none of
+    # the exclude patterns are downloaded. Files in subfolders are skipped, unless subfolders=True.
+    # Large files are downloaded in parts (multipart), small files in one request. Returns the number of downloaded files.
+    from boto3.s3.transfer import TransferConfig
+    large_file_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                       multipart_chunksize=16 * 1024 * 1024,
+                                       max_concurrency=max_concurrency)
+    small_file_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                       use_threads=False)
+    if not s3_folder.endswith("/"):
+        s3_folder = s3_folder + "/"
+    os.makedirs(local_folder, exist_ok=True)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    futures = []
+    with ThreadPoolExecutor(max_workers=nr_threads) as pool:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if key[-1] == "/":
+                    continue
+                if not subfolders and "/" in key[len(s3_folder):]:
+                    continue
+                file_name = key.split("/")[-1]
+                if include and not any(fnmatch.fnmatch(file_name, pattern) for pattern in include):
+                    continue
+                if exclude and any(fnmatch.fnmatch(file_name, pattern) for pattern in exclude):
+                    continue
+                local_file = os.path.join(local_folder, file_name)
+                if not quiet:
+                    print("Copying " + key + " to " + local_folder)
+                if obj["Size"] >= multipart_threshold:
+                    transfer_config = large_file_config
+                else:
+                    transfer_config = small_file_config
+                futures.append(pool.submit(s3_client.download_file, bucket_name, key, local_file, Config=transfer_config))
+    for future in futures:
+        future.result()
+    return len(futures)
+
+def delete_s3_folder(s3_client, bucket_name, s3_folder, keep_files=None, nr_threads=8):
+    # Delete all objects in an S3 folder (except files with names in keep_files). Objects are listed with
+    # pagination, and deleted in batches of up to 1000 keys (the maximum for delete_objects) that are sent concurrently.
+    if not s3_folder.endswith("/"):
+        s3_folder = s3_folder + "/"
+    keep_files = keep_files or []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    futures = []
+    with ThreadPoolExecutor(max_workers=nr_threads) as pool:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+            keys = [{"Key": obj["Key"]} for obj in page.get("Contents", []) if obj["Key"].split("/")[-1] not in keep_files]
+            if keys:
+                futures.append(pool.submit(s3_client.delete_objects, Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True}))
+    for future in futures:
+        for error in future.result().get("Errors", []):
+            print("Could not delete " + error["Key"] + " : " + error.get("Message", ""))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Dependency graph scheduler for the model loop.
+"""
+
+import os
+import time
+import toml
+
+from .cosmos_main import cosmos
+from .cosmos_cluster import cluster_dict as cluster
+
+class Scheduler:
+    """Decide which models can run next.
+
+    The dependency graph (a model depends on the models it is nested in, and on its tide-only model)
+    is built once per cycle. Models that are ready to run are dispatched in critical path order, i.e.
+    models with the longest chain of (expected) runtimes below them are started first. Expected runtimes
+    are taken from previous cycles (stored in runtimes.toml in the scenario folder). If no runtimes are
+    available, all models get the same runtime, so that the longest nesting chains go first. Ties are
+    broken by the model priority.
+
+    See Also
+    --------
+    cosmos.cosmos_model_loop.ModelLoop
+    """
+    def __init__(self):
+        self.parents    = {}
+        self.children   = {}
+        self.rank       = {}
+        self.order      = []
+        self.runtime    = {}
+        self.runtime_file = os.path.join(cosmos.scenario.path, "runtimes.toml")
+
+    def build(self):
+        """Build dependency graph and critical path order for all models in the scenario."""
+
+        self.read_runtimes()
+
+        models = cosmos.scenario.model
+
+        self.parents  = {}
+        self.children = {}
+        for model in models:
+            self.parents[model.name]  = []
+            self.children[model.name] = []
+        for model in models:
+            # We always want to run the tide only model first!
+            for parent in [model.flow_nested, model.wave_nested, model.bw_nested, model.tide_only_model]:
+                if parent and parent.name in self.parents and parent not in self.parents[model.name]:
+                    self.parents[model.name].append(parent)
+                    self.children[parent.name].append(model)
+
+        # Default runtime for models that have not run before
+        if self.runtime:
+            default_runtime = sum(self.runtime.values()) / len(self.runtime)
+        else:
+            default_runtime = 1.0
+
+        # Upward rank : expected runtime of the model plus the longest chain of nested models below it
+        self.rank = {}
+        def get_rank(model):
+            if model.name not in self.rank:
+                rank = 0.0
+                for child in self.children[model.name]:
+                    rank = max(rank, get_rank(child))
+                self.rank[model.name] = max(self.runtime.get(model.name, default_runtime), 1.0e-3) + rank
+            return self.rank[model.name]
+        for model in models:
+            get_rank(model)
+
+        # Parents always have a higher rank than their children, so this is also a topological order
+        self.order = sorted(models,
+                            key=lambda x: (self.rank[x.name], x.priority),
+                            reverse=True)
+
+    def get_ready_models(self):
+        """Return list with waiting models that are ready to run, in critical path order."""
+
+        # Check for all clusters if they are ready to run (this may remove models from the scenario)
+        for cl in cluster.values():
+            cl.check_ready_to_run()
+
+        ready_list = []
+
+        for model in self.order:
+
+            if model.status != "waiting":
+                continue
+
+            if model not in cosmos.scenario.model:
+                # Removed from scenario by cluster
+                continue
+
+            okay = True
+            for parent in self.parents[model.name]:
+                if parent.status == "failed":
+                    # Parents come first in the order, so this propagates down the whole chain
+                    model.status = "failed"
+                    okay = False
+                    break
+                if parent.status not in ["simulation_finished", "finished"]:
+                    # Parent has not been moved yet (post-processing of the parent does not need to be done)
+                    okay = False
+
+            if okay and model.cluster:
+                # Model appears ready to run, and is member of a cluster
+                if not cluster[model.cluster].ready:
+                    # This model sits in a cluster that is not ready to run
+                    okay = False
+
+            if okay:
+                ready_list.append(model)
+
+        return ready_list
+
+    def get_descendants(self, model):
+        """Return list with all models that (directly or indirectly) depend on a model."""
+        descendants = []
+        for child in self.children.get(model.name, []):
+            if child not in descendants:
+                descendants.append(child)
+            for mdl in self.get_descendants(child):
+                if mdl not in descendants:
+                    descendants.append(mdl)
+        return descendants
+
+    def submitted(self, model):
+        """Reset start time of model that is about to be submitted (it is set when the job actually starts)."""
+        model.run_start_time = None
+
+    def finished(self, model):
+        """Store runtime of model that just finished successfully.
+
+        The runtime is measured from the moment the job process started (set by the local executor, or
+        written to started.txt by run_job.bat / run_job.sh), so that time spent waiting in a queue or on
+        staging is not included. If the start time is not known (e.g. in cloud mode), or the simulation
+        was skipped, nothing is stored.
+        """
+        if model.cached:
+            return
+        start_time = model.run_start_time
+        if start_time is None:
+            file_name = os.path.join(model.job_path, "started.txt")
+            try:
+                with open(file_name, "r") as fid:
+                    start_time = float(fid.read().strip())
+            except Exception:
+                return
+        self.runtime[model.name] = max(time.time() - start_time, 0.0)
+        self.write_runtimes()
+
+    def read_runtimes(self):
+        self.runtime = {}
+        if os.path.exists(self.runtime_file):
+            try:
+                self.runtime = toml.load(self.runtime_file)
+            except Exception:
+                print("Could not read " + self.runtime_file)
+
+    def write_runtimes(self):
+        try:
+            with open(self.runtime_file, "w") as fid:
+                toml.dump(self.runtime, fid)
+        except Exception:
+            print("Could not write " + self.runtime_file)
@@ -16,6 +16,8 @@ from cht_nesting import nest1
 
 from .cosmos_main import cosmos
 from .cosmos_model import Model
+from .cosmos_staging import stage_file
+from .cosmos_restart_catalogue import get_restart_catalogue
 
 class CoSMoS_SFINCS(Model):
     """Cosmos class for SFINCS model.
@@ -45,6 +47,12 @@ class CoSMoS_SFINCS(Model):
         """         
         # Read in the SFINCS model                        
         self.domain = SFINCS(root=os.path.join(self.path, "input"), crs=self.crs, mode="r", read_grid_data=False)
+        if self.static_inputs is None:
+            # Grid and sub-grid files are never changed by pre-processing
+            self.static_inputs = ["sfincs.sbg", "sfincs_subgrid.nc", "sfincs.ind", "sfincs.msk", "sfincs.dep"]
+        if self.output_patterns is None:
+            # Files that move picks up (merged ensemble outputs have the same names)
+            self.output_patterns = ["sfincs_map.nc", "sfincs_his.nc", "sfincs.log", "*.rst"]
         # # Copy some attributes to the model domain (needed for nesting)
         # self.domain.type  = self.type # why?
         # self.domain.name  = self.name # why?
@@ -200,7 +208,8 @@ class CoSMoS_SFINCS(Model):
                                self.flow_restart_file)
             dst = os.path.join(self.job_path,
                                "sfincs.rst")
-            fo.copy_file(src, dst)
+            # Restart file is only read
+            stage_file(src, dst, link=cosmos.config.run.link_static_inputs)
             self.domain.input.variables.rstfile = "sfincs.rst"
             self.domain.input.variables.tspinup = 0.0
 
@@ -297,6 +306,8 @@ class CoSMoS_SFINCS(Model):
         pth = os.path.dirname(__file__)
         # Keep calling it run_job_2.py for now, otherwise the cloud workflow will not work
         fo.copy_file(os.path.join(pth, "cosmos_run_sfincs.py"), os.path.join(self.job_path, "run_job_2.py"))
+        # Helper modules that are used by the run script
+        self.copy_job_helpers()
 
         # If there is an associated tide_only model, copy its map file to the job folder. It is used
         # to make storm surge maps.
@@ -329,7 +340,8 @@ class CoSMoS_SFINCS(Model):
                 else:
                     fid = open(batch_file, "w")
                     fid.write("@ echo off\n")
-                    fid.write(f"set OMP_NUM_THREADS={self.omp_num_threads}\n")
+                    # Do not overwrite OMP_NUM_THREADS if it has already been set (e.g. for ensemble members that run simultaneously)
+                    fid.write(f"if not defined OMP_NUM_THREADS set OMP_NUM_THREADS={self.omp_num_threads}\n")
                     exe_path = os.path.join(cosmos.config.executables.sfincs_path, "sfincs.exe")
                     fid.write(exe_path + "\n")
                     fid.close()
@@ -338,7 +350,8 @@ class CoSMoS_SFINCS(Model):
                 fid = open(batch_file, "w")
                 fid.write("#!/bin/bash\n")
                 fid.write("unset LD_LIBRARY_PATH\n")
-                fid.write(f"export OMP_NUM_THREADS={self.omp_num_threads}\n")
+                # Do not overwrite OMP_NUM_THREADS if it has already been set (e.g. for ensemble members that run simultaneously)
+                fid.write(f"export OMP_NUM_THREADS=${{OMP_NUM_THREADS:-{self.omp_num_threads}}}\n")
                 fid.write("export PATH=" + cosmos.config.executables.sfincs_path + ":$PATH\n")
                 fid.write(os.path.join(cosmos.config.executables.sfincs_path, "sfincs\n"))
                 fid.close()
@@ -363,7 +376,9 @@ class CoSMoS_SFINCS(Model):
         # Restart file used in simulation        
         fo.move_file(os.path.join(self.job_path, "sfincs.rst"), input_path)
         # Restart files created during simulation
-        fo.move_file(os.path.join(self.job_path, "*.rst"), restart_path)
+        catalogue = get_restart_catalogue(restart_path)
+        for file_name in fo.list_files(os.path.join(self.job_path, "*.rst")):
+            catalogue.move_in(file_name)
         # Input (all the rest)
         fo.move_file(os.path.join(self.job_path, "*.*"), input_path)
         
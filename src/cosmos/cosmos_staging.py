@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Stage model inputs and restart files into job folders without copying them where possible.
+
+This module does not use the cosmos package, as it is also used by the job scripts (e.g. to stage the
+inputs of ensemble members). It is copied (as cosmos_staging.py) into every job folder, next to the job script.
+"""
+
+import os
+import shutil
+import fnmatch
+import hashlib
+import platform
+import threading
+
+# ioctl request that clones a file (copy-on-write) on Linux file systems that support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Content hashes of staged files, with the size and modification time of the file when it was hashed
+file_hashes = {}
+file_hashes_lock = threading.Lock()
+
+def reflink(src, dst):
+    """Make a copy-on-write clone of a file. Raises OSError if the file system does not support this."""
+    if platform.system() != "Linux":
+        raise OSError("Reflinks are only supported on Linux")
+    import fcntl
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                fdst.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+def stage_file(src, dst, link=False):
+    """Put a file in a job folder.
+
+    A copy-on-write clone (reflink) is made where the file system supports it, as the job may then
+    safely change the file. With link=True, the file is hard linked instead. This must only be done for
+    files that are never changed in the job folder, as changes would end up in the original file. If
+    none of this works (e.g. the job folder is on another file system), the file is copied. Symbolic
+    links are not used, as their target is not available on parallel worker nodes and in archived
+    cycle folders.
+
+    Parameters
+    ----------
+    src : str
+        Source file
+    dst : str
+        Destination file (an existing file is replaced)
+    link : bool
+        Hard link the file if it cannot be cloned
+
+    Returns
+    -------
+    str
+        How the file was staged ("reflink", "link" or "copy")
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    if link:
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+def stage_folder(src, dst, static_inputs=None, link=False):
+    """Put all files in a folder (including sub folders) in a job folder.
+
+    Files that match one of the static_inputs patterns are linked (if link=True), all other files
+    are cloned or copied.
+
+    Parameters
+    ----------
+    src : str
+        Source folder
+    dst : str
+        Destination folder
+    static_inputs : list
+        File name patterns of files that are never changed in the job folder
+    link : bool
+        Link static inputs rather than copying them
+
+    Returns
+    -------
+    dict
+        Number of files per staging method ("reflink", "link" or "copy")
+
+    See Also
+    --------
+    cosmos.cosmos_staging.stage_file
+    """
+    static_inputs = static_inputs or []
+    count = {}
+    for root, dirs, files in os.walk(src):
+        dst_path = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_path, exist_ok=True)
+        for file_name in files:
+            static = any(fnmatch.fnmatch(file_name, p) for p in static_inputs)
+            method = stage_file(os.path.join(root, file_name),
+                                os.path.join(dst_path, file_name),
+                                link=link and static)
+            count[method] = count.get(method, 0) + 1
+    return count
+
+def get_file_hash(file_name, key):
+    """Return the sha256 content hash of a file.
+
+    The hash is only computed again if the size or modification time of the file has changed since the
+    last call with the same key. Inputs that are staged into the job folders with their original
+    modification time (copies, clones and links) are therefore only read once.
+
+    Parameters
+    ----------
+    file_name : str
+        File
+    key : tuple
+        Key of the file (e.g. model name and path in the job folder)
+
+    Returns
+    -------
+    str
+        Hexadecimal sha256 hash
+    """
+    st = os.stat(file_name)
+    with file_hashes_lock:
+        entry = file_hashes.get(key)
+    if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+    h = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    with file_hashes_lock:
+        file_hashes[key] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+    return h.hexdigest()
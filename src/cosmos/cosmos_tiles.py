@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Map tile helpers for the job scripts (run_job_2.py and merge_tiles.py) and the web viewer.
+
+This module does not use the cosmos package, as the job containers in the cloud do not have it. It is
+copied (as cosmos_tiles.py) into every job folder, next to the job script.
+"""
+
+import os
+import io
+import json
+import hashlib
+import platform
+import numpy as np
+from PIL import Image
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+
+def save_palette_png(rgba, file_name):
+    # Save RGBA array as 8-bit palette PNG (lossless, only if the tile has at most 256 different colours).
+    # Map tiles use the small discrete colour table of the contours in map_contours.toml, so this is nearly always the case.
+    # Returns False if the tile has too many colours (nothing is written).
+    colors, index = np.unique(rgba.reshape(-1, 4), axis=0, return_inverse=True)
+    if len(colors) > 256:
+        return False
+    im = Image.fromarray(index.reshape(rgba.shape[:2]).astype(np.uint8), mode="P")
+    im.putpalette(colors[:, 0:3].flatten().tolist())
+    im.save(file_name, optimize=True, transparency=bytes(colors[:, 3].tolist()))
+    return True
+
+def encode_palette_tiles(path):
+    # Rewrite RGBA tiles in a tile folder as 8-bit palette PNGs. Tiles of other models are merged into
+    # existing RGBA tiles, so this must only be done when no more tiles are written to the folder.
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            if not file_name.endswith(".png"):
+                continue
+            full_name = os.path.join(root, file_name)
+            with Image.open(full_name) as im:
+                if im.mode != "RGBA":
+                    continue
+                rgba = np.array(im)
+            save_palette_png(rgba, full_name)
+
+def optimize_tiles(path):
+    # Remove fully transparent tiles (the web viewer shows a missing tile as transparent) and replace
+    # identical tiles by hard links to a single copy. The content hash of every remaining tile is written to
+    # tiles.json in the tile folder, so that identical tiles can also be recognized after the folder is copied.
+    # As linked tiles share their contents, this must only be done when no more tiles are written to the folder.
+    # Returns the number of removed and linked tiles.
+    manifest = {}
+    unique_tiles = {}
+    nr_removed = 0
+    nr_linked  = 0
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            if not file_name.endswith(".png"):
+                continue
+            full_name = os.path.join(root, file_name)
+            with open(full_name, "rb") as fid:
+                data = fid.read()
+            with Image.open(io.BytesIO(data)) as im:
+                if im.mode == "RGBA" or "transparency" in im.info:
+                    if im.convert("RGBA").getchannel("A").getextrema()[1] == 0:
+                        os.remove(full_name)
+                        nr_removed += 1
+                        continue
+            tile_hash = hashlib.sha1(data).hexdigest()
+            manifest[os.path.relpath(full_name, path).replace("\\", "/")] = tile_hash
+            if tile_hash in unique_tiles:
+                try:
+                    os.remove(full_name)
+                    os.link(unique_tiles[tile_hash], full_name)
+                    nr_linked += 1
+                except Exception:
+                    # File system does not support hard links, keep a copy
+                    with open(full_name, "wb") as fid:
+                        fid.write(data)
+            else:
+                unique_tiles[tile_hash] = full_name
+    if os.path.exists(path):
+        with open(os.path.join(path, "tiles.json"), "w") as fid:
+            json.dump(manifest, fid)
+    return nr_removed, nr_linked
+
+def finish_tiles(path, optimize=False, encoding="rgba"):
+    # PNG encoding of the tiles in a tile folder (rgba or palette), and skip empty tiles and link identical tiles
+    if encoding == "palette":
+        encode_palette_tiles(path)
+    if optimize:
+        nr_removed, nr_linked = optimize_tiles(path)
+        print("Removed " + str(nr_removed) + " empty tiles and linked " + str(nr_linked) + " identical tiles in " + path)
+
+def get_tile_options(config):
+    # Returns optimize and encoding of the tiles of a job. Only in cloud mode, where the tiles are written to the
+    # output folder of the job. Otherwise, they are written to the web viewer folder that is shared with other
+    # models (that may still merge their tiles into them), and the web viewer does this once all models have finished.
+    if config.get("run_mode") != "cloud":
+        return False, "rgba"
+    return config.get("optimize_tiles", False), config.get("tile_encoding", "rgba")
+
+@contextmanager
+def tile_folder_lock(path, shared=True):
+    # Exclusive lock on a tile folder. In serial and parallel mode, the tiles of overlapping models are merged into
+    # the same folder of the web viewer, so jobs that run at the same time wait for each other. The lock (on the file
+    # <path>.lock next to the folder) is released by the operating system if the job dies. Lock files are removed by
+    # the web viewer once all models have finished. Nothing is locked if the folder is not shared (cloud mode).
+    if not shared:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "a+") as fid:
+        fid.seek(0)
+        if platform.system() == "Windows":
+            import msvcrt
+            while True:
+                try:
+                    # Retries for 10 seconds before raising
+                    msvcrt.locking(fid.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                fid.seek(0)
+                msvcrt.locking(fid.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fid.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fid.fileno(), fcntl.LOCK_UN)
+
+def make_tiles(tile, optimize=False, encoding="rgba", shared=False):
+    # Make tiles for one map product and time interval (called in worker processes)
+    from cht_tiling import TiledWebMap
+    tile = dict(tile)
+    png_path = tile.pop("png_path")
+    with tile_folder_lock(png_path, shared):
+        twm = TiledWebMap(png_path, **tile)
+        twm.make()
+        finish_tiles(png_path, optimize, encoding)
+
+class TileRenderer:
+    # Makes tiles for (product, interval) pairs in a pool of processes while the data is still being read.
+    # A pair is submitted as soon as its data has been read, and at most nr_workers pairs are in the pool at
+    # the same time, so that only a few maps are kept in memory (and sent to the workers) at once.
+    # Every pair writes to its own folder (png_path) in the tile tree, so the workers never write the same files
+    # (jobs of other models that write to the same folder wait for the lock on the folder).
+    def __init__(self, config):
+        nr_workers = config.get("nr_tile_workers", 0)
+        if not nr_workers or nr_workers <= 0:
+            # Use the cores of this job
+            nr_workers = config.get("nr_cores", 0) or os.cpu_count() or 1
+        self.nr_workers = nr_workers
+        self.optimize, self.encoding = get_tile_options(config)
+        # Tile folders are shared with other jobs, except in cloud mode
+        self.shared   = config.get("run_mode") != "cloud"
+        self.pool     = None
+        self.futures  = {}
+        self.nr_tiles = 0
+
+    def submit(self, tile):
+        self.nr_tiles += 1
+        if self.nr_workers == 1:
+            try:
+                make_tiles(tile, self.optimize, self.encoding, self.shared)
+            except Exception as e:
+                print("An error occured while making tiles in " + tile["png_path"] + ": " + str(e))
+            return
+        if self.pool is None:
+            print("Making tiles with " + str(self.nr_workers) + " processes ...")
+            self.pool = ProcessPoolExecutor(max_workers=self.nr_workers)
+        # Wait for a free worker
+        while len(self.futures) >= self.nr_workers:
+            self.collect(FIRST_COMPLETED)
+        self.futures[self.pool.submit(make_tiles, tile, self.optimize, self.encoding, self.shared)] = tile["png_path"]
+
+    def collect(self, return_when=ALL_COMPLETED):
+        done, not_done = wait(self.futures, return_when=return_when)
+        for future in done:
+            png_path = self.futures.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                print("An error occured while making tiles in " + png_path + ": " + str(e))
+
+    def close(self):
+        if self.pool is not None:
+            self.collect()
+            self.pool.shutdown()
+            self.pool = None
+        print("Made tiles for " + str(self.nr_tiles) + " maps")
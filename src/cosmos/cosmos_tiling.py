@@ -7,6 +7,8 @@ Created on Mon Sep 20 12:17:22 2021
 import numpy as np
 
 from .cosmos_main import cosmos
+# Tile helpers that are shared with the job scripts
+from .cosmos_tiles import save_palette_png, encode_palette_tiles, optimize_tiles
 from cht_tiling.tiling import make_png_tiles
 from cht_tiling.tiling import make_floodmap_tiles
 
@@ -19,6 +19,7 @@ import copy
 
 from .cosmos_argo import Argo
 from .cosmos_main import cosmos
+from .cosmos_tiling import encode_palette_tiles, optimize_tiles
 
 from cht_meteo import MeteoDataset
 import cht_utils.fileops as fo
@@ -99,6 +100,9 @@ class WebViewer:
         if cosmos.config.run.run_mode == "cloud":
             # Merge the map tiles of the different models
             self.merge_map_tiles()
+        else:
+            # All models have now added their map tiles
+            self.finish_map_tiles()
 
         # Map tiles
         cosmos.log("Adding tile layers ...")                
@@ -1168,6 +1172,39 @@ class WebViewer:
             cosmos.log("An error occurred while uploading !")
             cosmos.log(str(e))
 
+    def finish_map_tiles(self):
+        """Encode the map tiles of this cycle as palette PNGs (tile_encoding = palette), and remove empty tiles
+        and link identical tiles (optimize_tiles).
+
+        In serial and parallel mode, all models write their map tiles to the same folders, and the tiles
+        of overlapping models are merged into the existing (RGBA) tiles. This can therefore only be done once
+        all models of the cycle have finished (in cloud mode, it is done in the map_tiles jobs). The lock files
+        of the tile folders (see cosmos_tiles.tile_folder_lock) are removed as well.
+        """
+        if os.path.isdir(self.cycle_path):
+            for name in os.listdir(self.cycle_path):
+                layer_path = os.path.join(self.cycle_path, name)
+                if os.path.isdir(layer_path):
+                    for lock_file in fo.list_files(os.path.join(layer_path, "*.lock"), full_path=True):
+                        os.remove(lock_file)
+        palette = cosmos.config.run.tile_encoding == "palette"
+        if not (palette or cosmos.config.run.optimize_tiles) or not os.path.isdir(self.cycle_path):
+            return
+        cosmos.log("Finishing map tiles ...")
+        for name in sorted(os.listdir(self.cycle_path)):
+            layer_path = os.path.join(self.cycle_path, name)
+            if name == "timeseries" or not os.path.isdir(layer_path):
+                continue
+            for folder in sorted(os.listdir(layer_path)):
+                tile_path = os.path.join(layer_path, folder)
+                if not os.path.isdir(tile_path):
+                    continue
+                if palette:
+                    encode_palette_tiles(tile_path)
+                if cosmos.config.run.optimize_tiles:
+                    nr_removed, nr_linked = optimize_tiles(tile_path)
+                    cosmos.log("Removed " + str(nr_removed) + " empty tiles and linked " + str(nr_linked) + " identical tiles in " + tile_path)
+
     def merge_map_tiles(self):
         """Merge output map-tiles from different models for web viewer. 
         For now only used in run_mode==cloud"""
@@ -1202,6 +1239,8 @@ class WebViewer:
         config["cloud"]["region"] = cosmos.config.cloud_config.region
         config["cloud"]["token"] = cosmos.config.cloud_config.token
         config["cloud"]["namespace"] = cosmos.config.cloud_config.namespace
+        # Number of files that are transferred at the same time
+        config["cloud"]["nr_transfer_threads"] = cosmos.config.cloud_config.nr_transfer_threads
         
         # settings
         config["cloud"]["s3_bucket"] = bucket_name
@@ -1209,6 +1248,8 @@ class WebViewer:
         config["cloud"]["webviewer_folder"] = cosmos.config.webviewer.name + "/data"
         config["cloud"]["scenario"] = cosmos.scenario_name
         config["cloud"]["cycle"] = cosmos.cycle_string
+        # PNG encoding of the merged tiles
+        config["tile_encoding"] = cosmos.config.run.tile_encoding
 
         # make a list of jobs
         jobs = []
@@ -1227,6 +1268,11 @@ class WebViewer:
                 os.path.join(os.path.dirname(__file__), "cosmos_merge_tiles.py"),
                 os.path.join(job_path, "merge_tiles.py")
                 )
+            for file_name in ["cosmos_s3.py", "cosmos_tiles.py"]:
+                fo.copy_file(
+                    os.path.join(os.path.dirname(__file__), file_name),
+                    os.path.join(job_path, file_name)
+                    )
 
             # Upload "jobs" to s3
             s3key = cosmos.scenario.name + "/" + "tile_jobs" + "/" + variable
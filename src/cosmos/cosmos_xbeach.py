@@ -49,6 +49,9 @@ class CoSMoS_XBeach(Model):
         # Now read in the domain data
         input_file  = os.path.join(self.path, "input", "params.txt")
         self.domain = XBeach(input_file=input_file, get_boundary_coordinates=False)
+        if self.output_patterns is None:
+            # Files that move picks up
+            self.output_patterns = ["*.nc"]
         
         mdl_dict = toml.load(self.file_name)
         if "flow_nesting_points" in mdl_dict:
@@ -69,6 +72,9 @@ class CoSMoS_XBeach(Model):
 
         if "zb_deshoal" in mdl_dict:
             self.domain.zb_deshoal = mdl_dict["zb_deshoal"]
+
+        if not self.nr_mpi_processes:
+            self.nr_mpi_processes = 5
             
         # Copy some attributes to the model domain (needed for nesting)
         self.domain.crs   = self.crs
@@ -142,6 +148,8 @@ class CoSMoS_XBeach(Model):
         # Copy the correct run script to run_job.py
         pth = os.path.dirname(__file__)
         fo.copy_file(os.path.join(pth, "cosmos_run_xbeach.py"), os.path.join(self.job_path, "run_job_2.py"))
+        # Helper modules that are used by the run script
+        self.copy_job_helpers()
 
         # Write config.yml file to be used in job
         self.write_config_yml()
@@ -162,7 +170,7 @@ class CoSMoS_XBeach(Model):
                 fid.write('set mpidir="c:\\Program Files\\MPICH2\\bin"\n')
                 fid.write("set PATH=%xbeachdir%;%PATH%\n")
                 fid.write("set PATH=%mpidir%;%PATH%\n")
-                fid.write("mpiexec.exe -n 5 -mapall %xbeachdir%\\xbeach.exe\n")
+                fid.write(f"mpiexec.exe -n {self.nr_mpi_processes} -mapall %xbeachdir%\\xbeach.exe\n")
                 fid.write("del q_*\n")
                 fid.write("del E_*\n")
                 fid.close()
@@ -173,7 +181,7 @@ class CoSMoS_XBeach(Model):
                 fid.write("unset LD_LIBRARY_PATH\n")
                 fid.write("export PATH=$PATH:" + cosmos.config.executables.xbeach_path + "\n")
                 fid.write("export PATH=$PATH:/usr/lib/mpich/bin\n")
-                fid.write("mpirun -np 5 xbeach\n")
+                fid.write(f"mpirun -np {self.nr_mpi_processes} xbeach\n")
                 fid.write("rm q_*\n")
                 fid.write("rm E_*\n")
                 fid.close()